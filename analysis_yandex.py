@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+# analysis_yandex.py
+# Объединённый этап анализа: NER + классификатор + LLM1 одним запросом.
+# Письмо отправляется в модель один раз, ответ раскладывается на те же три
+# артефакта (ner_output.json, classification_output.json, llm1_output.json),
+# поэтому RAG1 / LLM2 и дальше ничего не замечают.
+import json
+from llm_client import MODEL, get_client
+from json_extract import extract_json
+from prompt_builder import Prompt
+from chunking import split_letter, section_title, chunk_requests, create_all, acreate_all, merge_classification, merge_llm1
+import metrics
+from ner_rules import extract_rules, merge
+from ner_yandex import normalize_ner, safe_obj
+from app_final_yandex import TYPE_CATEGORIES, DEPARTMENT_CATEGORIES_EXPANDED, DEFAULT_CLASSIFICATION
+
+client = get_client("analysis")
+
+DEFAULT_LLM1 = {
+    "core_request": None,
+    "requirements": None,
+    "expectations": None
+}
+
+# -----------------------------
+# PROMPT
+# -----------------------------
+ANALYSIS_PROMPT = Prompt("""
+Ты — эксперт по анализу официальной деловой переписки банка.
+По тексту письма заполни ТРИ раздела одного JSON.
+
+1) "ner" — извлечение сущностей:
+- contract_numbers: номера договоров/соглашений;
+- deadlines: объекты {{ "text": ..., "date": "... или null", "type": "relative или absolute" }};
+- law_refs: упоминания нормативных актов;
+- contacts: {{ "emails": [...], "phones": [...], "persons": [...] }};
+- organizations: названия организаций.
+Если информации нет — пустые списки. Ничего не придумывай.
+
+2) "classification" — классификация письма:
+- type — одна из категорий:
+{categories}
+- urgency — «очень срочно», «средне срочно» или «не срочно»;
+- formality — «официальный» или «неофициальный»;
+- departments — массив подразделений ИЗ списка:
+{deps}
+- legal_risk — «есть» или «нет».
+
+3) "llm1" — суть письма:
+- core_request — суть запроса в одном-двух предложениях;
+- requirements — конкретные действия, которые должен выполнить адресат (сроки, суммы, документы);
+- expectations — что отправитель рассчитывает получить по итогам.
+Если какой-то части явно нет в тексте — null.
+
+Формат ответа строго JSON, без текста вне JSON:
+{{
+  "ner": {{
+    "contract_numbers": [],
+    "deadlines": [],
+    "law_refs": [],
+    "contacts": {{ "emails": [], "phones": [], "persons": [] }},
+    "organizations": []
+  }},
+  "classification": {{
+    "type": "...",
+    "urgency": "...",
+    "formality": "...",
+    "departments": ["..."],
+    "legal_risk": "..."
+  }},
+  "llm1": {{
+    "core_request": "...",
+    "requirements": "...",
+    "expectations": "..."
+  }}
+}}
+""".format(
+    categories="\n".join(f"  • {c}" for c in TYPE_CATEGORIES),
+    deps="\n".join(f"  • {d}" for d in DEPARTMENT_CATEGORIES_EXPANDED),
+))
+
+
+def build_request(letter_text: str, part=None) -> dict:
+    """Один запрос вместо трёх: NER, классификатор и LLM1 (part=(i, n) — фрагмент длинного письма)."""
+    return {
+        "model": MODEL,
+        **ANALYSIS_PROMPT.render((section_title(part), letter_text)),
+        "max_output_tokens": 1200,
+        "temperature": 0.0,
+    }
+
+
+def parse_output(raw: str) -> dict:
+    """Раскладывает ответ на ner / classification / llm1; недостающее — по умолчанию."""
+    data = extract_json(raw, keys={"ner", "classification", "llm1"})
+    if data is None:
+        metrics.note("fallbacks")
+    data = safe_obj(data)
+
+    return {
+        "ner": normalize_ner(safe_obj(data.get("ner"))),
+        "classification": {**DEFAULT_CLASSIFICATION, **safe_obj(data.get("classification"))},
+        "llm1": {**DEFAULT_LLM1, **safe_obj(data.get("llm1"))},
+    }
+
+
+def finalize(letter_text: str, result: dict) -> dict:
+    # Правила NER дешёвые — дополняем ими то, что модель могла пропустить
+    result["ner"] = merge(extract_rules(letter_text), result["ner"])
+    return result
+
+
+def merge_chunks(raws: list) -> dict:
+    """Анализы фрагментов длинного письма → один результат в тех же трёх схемах."""
+    results = [parse_output(raw) for raw in raws]
+    if len(results) == 1:
+        return results[0]
+    ner = results[0]["ner"]
+    for result in results[1:]:
+        ner = merge(ner, result["ner"])
+    return {
+        "ner": ner,
+        "classification": merge_classification([r["classification"] for r in results], DEFAULT_CLASSIFICATION),
+        "llm1": merge_llm1([r["llm1"] for r in results]),
+    }
+
+
+def run_analysis(letter_text: str) -> dict:
+    """Возвращает {"ner": ..., "classification": ..., "llm1": ...}."""
+    raws = create_all(client, chunk_requests(build_request, split_letter(letter_text)))
+    return finalize(letter_text, merge_chunks(raws))
+
+
+async def arun(call, letter_text: str) -> dict:
+    """run_analysis для пакетного режима."""
+    raws = await acreate_all(call, chunk_requests(build_request, split_letter(letter_text)))
+    return finalize(letter_text, merge_chunks(raws))
+
+
+# -----------------------------
+# ЗАПУСК КАК СКРИПТА
+# -----------------------------
+if __name__ == "__main__":
+    with open("letter.txt", "r", encoding="utf-8") as f:
+        letter_text = f.read().strip()
+
+    result = run_analysis(letter_text)
+
+    for name, file_name in [("ner", "ner_output.json"),
+                            ("classification", "classification_output.json"),
+                            ("llm1", "llm1_output.json")]:
+        with open(file_name, "w", encoding="utf-8") as f:
+            json.dump(result[name], f, ensure_ascii=False, indent=2)
+        print(f"Файл сохранён → {file_name}")
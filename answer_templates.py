@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+# answer_templates.py
+# Кэш одобренных ответов: ответы LLM3, прошедшие комплаенс-проверку, как шаблоны для похожих писем.
+#
+# Запись кэша — тип письма и подразделения (классификатор), суть запроса (LLM1.core_request)
+# и четыре ответа LLM3. Для нового письма ищется запись того же типа с тем же набором
+# подразделений, у которой косинусное сходство эмбеддингов core_request (vector_store.get_embedder)
+# не ниже ANSWER_TEMPLATE_THRESHOLD. Найденный шаблон LLM2 не пишет заново, а приспосабливает
+# к письму: модель возвращает только список замен (имена, номера, даты, суммы),
+# бюджет ответа — ADAPT_MAX_OUTPUT_TOKENS вместо 1500.
+#
+# Записи помечены версией политик: промпты LLM2 / LLM3 и корпус документов (doc_index.corpus_signature).
+# Поменялись промпты или регламенты в DOCS_DIR — старые записи удаляются при следующем поиске.
+# Подпись корпуса берётся из кэша doc_index: заново он обходится при смене mtime каталога DOCS_DIR
+# или раз в DOCS_RESCAN секунд.
+#
+# В записи хранятся и сущности письма-источника (NER: договоры, контакты, организации, даты). Если после
+# замен какая-то из них, которой нет в новом письме, осталась в ответах, адаптация отклоняется.
+#
+# В кэш ответ попадает после одобрения: python answer_templates.py approve <letter_id>,
+# или сразу после пайплайна, если ANSWER_TEMPLATES_AUTO=1 и у LLM3 нет замечаний ни по одному стилю.
+#
+#   ANSWER_TEMPLATES=1 (0 — выключить), ANSWER_TEMPLATES_PATH=answer_templates.jsonl,
+#   ANSWER_TEMPLATE_THRESHOLD=0.85, ANSWER_TEMPLATES_AUTO=0, ANSWER_TEMPLATES_MAX=1000
+#
+#   python answer_templates.py approve <letter_id> [--letters letters]
+#   python answer_templates.py list
+#   python answer_templates.py evict (--letter ID | --type ТИП | --stale | --all)
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import threading
+from pathlib import Path
+
+import numpy as np
+
+from artifact_store import read_letter_dir
+
+ANSWER_TEMPLATES          = os.getenv("ANSWER_TEMPLATES", "1") == "1"
+ANSWER_TEMPLATES_PATH     = os.getenv("ANSWER_TEMPLATES_PATH", "answer_templates.jsonl")
+ANSWER_TEMPLATE_THRESHOLD = float(os.getenv("ANSWER_TEMPLATE_THRESHOLD", 0.85))
+ANSWER_TEMPLATES_AUTO     = os.getenv("ANSWER_TEMPLATES_AUTO", "0") == "1"
+ANSWER_TEMPLATES_MAX      = int(os.getenv("ANSWER_TEMPLATES_MAX", 1000))
+
+STYLES = ["official", "business", "client_friendly", "simple"]
+
+
+_policy_cache = (None, None)    # (подпись корпуса, версия)
+
+
+def policy_version(refresh=False) -> str:
+    """Промпты, по которым ответы пишутся и проверяются, и корпус регламентов (refresh=True — обойти корпус сейчас)."""
+    global _policy_cache
+    from doc_index import corpus_signature
+    signature = corpus_signature(refresh=refresh)
+    if _policy_cache[0] == signature and _policy_cache[1] is not None:
+        return _policy_cache[1]
+    import llm2_yandex
+    import llm3_yandex
+    parts = [llm2_yandex.LLM2_PROMPT.instructions, llm2_yandex.STYLE_PROMPT.instructions,
+             llm3_yandex.LLM3_PROMPT.instructions, llm3_yandex.STYLE_PROMPT.instructions, signature]
+    version = hashlib.sha1("\n".join(parts).encode("utf-8")).hexdigest()[:16]
+    _policy_cache = (signature, version)
+    return version
+
+
+def entities(ner_result: dict) -> list:
+    """Значения сущностей письма из NER, которые не должны перейти в ответ на другое письмо."""
+    ner_result = ner_result or {}
+    contacts = ner_result.get("contacts") or {}
+    values = (list(ner_result.get("contract_numbers") or []) + list(ner_result.get("organizations") or [])
+              + [value for key in ("emails", "phones", "persons") for value in contacts.get(key) or []]
+              + [d.get("date") for d in ner_result.get("deadlines") or [] if isinstance(d, dict)])
+    return sorted({" ".join(v.split()) for v in values if isinstance(v, str) and len(v.strip()) >= 3})
+
+
+def leftovers(template: dict, letter_text: str, answers: dict) -> list:
+    """Сущности письма-источника шаблона, оставшиеся в ответах, хотя в новом письме их нет."""
+    letter = " ".join((letter_text or "").split()).lower()
+    texts = [" ".join(text.split()).lower() for text in answers.values() if isinstance(text, str)]
+    return [value for value in template.get("entities") or []
+            if value.lower() not in letter and any(value.lower() in text for text in texts)]
+
+
+def group_key(classification: dict) -> tuple:
+    classification = classification or {}
+    departments = classification.get("departments") or []
+    return (classification.get("type") or "", tuple(sorted(d for d in departments if isinstance(d, str))))
+
+
+def approvable(llm3_result: dict) -> bool:
+    """Все четыре ответа есть и ни по одному нет замечаний LLM3."""
+    answers = (llm3_result or {}).get("answers") or {}
+    issues = (llm3_result or {}).get("issues") or {}
+    return all(answers.get(style) for style in STYLES) and not any(issues.get(style) for style in STYLES)
+
+
+class AnswerTemplates:
+    """
+    Одобренные ответы с поиском по (type, departments, core_request).
+
+    templates = AnswerTemplates("answer_templates.jsonl")
+    templates.add(letter_id, classification, llm1, llm3)
+    templates.match(classification, llm1)      # запись шаблона или None
+    """
+
+    def __init__(self, path=None, embedder=None, threshold=None):
+        self.path = Path(path) if path else None
+        self.threshold = ANSWER_TEMPLATE_THRESHOLD if threshold is None else threshold
+        self._embedder = embedder
+        self.entries = []
+        self._vectors = None
+        self._policy = None
+        self._lock = threading.Lock()
+        self.counters = {"lookups": 0, "hits": 0, "added": 0, "evicted": 0}
+        if self.path is not None and self.path.exists():
+            with self.path.open("r", encoding="utf-8") as f:
+                self.entries = [json.loads(line) for line in f if line.strip()]
+
+    @property
+    def embedder(self):
+        if self._embedder is None:
+            from vector_store import get_embedder
+            self._embedder = get_embedder()
+        return self._embedder
+
+    def _embed(self, texts) -> np.ndarray:
+        from vector_store import normalize
+        return normalize(self.embedder.embed(list(texts), kind="query"))
+
+    def _save(self):
+        if self.path is None:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(self.path.suffix + ".tmp")
+        with tmp.open("w", encoding="utf-8") as f:
+            for entry in self.entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        tmp.replace(self.path)
+
+    def _remove(self, keep):
+        """Оставляет записи, для которых keep(entry) истинно; возвращает число удалённых."""
+        before = len(self.entries)
+        self.entries = [entry for entry in self.entries if keep(entry)]
+        removed = before - len(self.entries)
+        if removed:
+            self._vectors = None
+            self.counters["evicted"] += removed
+            self._save()
+        return removed
+
+    def _evict_stale(self, refresh=False):
+        policy = policy_version(refresh)
+        if policy != self._policy:
+            self._policy = policy
+            self._remove(lambda entry: entry.get("policy") == policy)
+
+    # ------------------------
+    # Поиск
+    # ------------------------
+    def match(self, classification: dict, llm1_result: dict, count=True):
+        """Самая похожая запись того же типа и подразделений или None (count=False — не учитывать в stats)."""
+        core = ((llm1_result or {}).get("core_request") or "").strip()
+        with self._lock:
+            self.counters["lookups"] += count
+            if not core or not self.entries:
+                return None
+            self._evict_stale()
+            group = group_key(classification)
+            rows = [n for n, entry in enumerate(self.entries)
+                    if (entry["type"], tuple(entry["departments"])) == group]
+            if not rows:
+                return None
+            if self._vectors is None:
+                self._vectors = self._embed(entry["core_request"] for entry in self.entries)
+            scores = self._vectors[rows] @ self._embed([core])[0]
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                return None
+            entry = self.entries[rows[best]]
+            self.counters["hits"] += count
+            return {**entry, "similarity": round(float(scores[best]), 3)}
+
+    # ------------------------
+    # Пополнение и удаление
+    # ------------------------
+    def add(self, letter_id, classification: dict, llm1_result: dict, llm3_result: dict, ner_result=None,
+            dedupe=False) -> bool:
+        """
+        Одобренный ответ письма → запись кэша (запись того же письма заменяется).
+        ner_result — NER письма: его сущности при адаптации не должны остаться в ответе.
+        dedupe=True — не добавлять, если похожий шаблон уже есть (например, ответ из него и получен).
+        """
+        core = ((llm1_result or {}).get("core_request") or "").strip()
+        answers = (llm3_result or {}).get("answers") or {}
+        if not core or not all(answers.get(style) for style in STYLES):
+            return False
+        if dedupe and self.match(classification, llm1_result, count=False) is not None:
+            return False
+        type_, departments = group_key(classification)
+        with self._lock:
+            self._evict_stale()
+            self.entries = [entry for entry in self.entries if entry["letter_id"] != letter_id]
+            self.entries.append({
+                "letter_id": letter_id, "type": type_, "departments": list(departments), "core_request": core,
+                "answers": {style: answers[style] for style in STYLES}, "entities": entities(ner_result),
+                "policy": self._policy, "ts": round(time.time(), 3),
+            })
+            self.entries = sorted(self.entries, key=lambda entry: entry["ts"])[-ANSWER_TEMPLATES_MAX:]
+            self._vectors = None
+            self.counters["added"] += 1
+            self._save()
+        return True
+
+    def evict(self, letter_id=None, type_=None, everything=False) -> int:
+        with self._lock:
+            if everything:
+                return self._remove(lambda entry: False)
+            return self._remove(lambda entry: not ((letter_id and entry["letter_id"] == letter_id)
+                                                   or (type_ and entry["type"] == type_)))
+
+    def evict_stale(self) -> int:
+        with self._lock:
+            before = self.counters["evicted"]
+            self._policy = None
+            self._evict_stale(refresh=True)
+            return self.counters["evicted"] - before
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"entries": len(self.entries), **self.counters}
+
+
+_templates = None
+_templates_lock = threading.Lock()
+
+
+def get_templates() -> AnswerTemplates:
+    global _templates
+    with _templates_lock:
+        if _templates is None:
+            _templates = AnswerTemplates(ANSWER_TEMPLATES_PATH)
+        return _templates
+
+
+def find(classification: dict, llm1_result: dict, count=True):
+    """Шаблон для письма (для LLM2) или None, если кэш выключен или похожего нет."""
+    if not ANSWER_TEMPLATES:
+        return None
+    return get_templates().match(classification, llm1_result, count=count)
+
+
+def offer(letter_id, artifacts: dict) -> bool:
+    """После пайплайна: при ANSWER_TEMPLATES_AUTO=1 ответ без замечаний LLM3 сразу становится шаблоном."""
+    if not (ANSWER_TEMPLATES and ANSWER_TEMPLATES_AUTO and approvable(artifacts.get("llm3"))):
+        return False
+    return get_templates().add(letter_id, artifacts.get("classification"), artifacts.get("llm1"),
+                               artifacts["llm3"], artifacts.get("ner"), dedupe=True)
+
+
+def stats() -> dict:
+    return get_templates().snapshot() if _templates is not None else {}
+
+
+# ------------------------
+# CLI
+# ------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Кэш одобренных ответов")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_approve = sub.add_parser("approve", help="одобрить ответ LLM3 письма как шаблон")
+    p_approve.add_argument("letter_id")
+    p_approve.add_argument("--letters", default="letters")
+    sub.add_parser("list", help="записи кэша")
+    p_evict = sub.add_parser("evict", help="удалить записи")
+    group = p_evict.add_mutually_exclusive_group(required=True)
+    group.add_argument("--letter")
+    group.add_argument("--type")
+    group.add_argument("--stale", action="store_true", help="записи со старой версией промптов / регламентов")
+    group.add_argument("--all", action="store_true")
+    args = parser.parse_args()
+
+    if args.command != "list":
+        # запросов к API нет, ключи нужны только чтобы импортировать модули этапов (policy_version)
+        os.environ.setdefault("api_key", "-")
+        os.environ.setdefault("folder_id", "-")
+    templates = get_templates()
+
+    if args.command == "approve":
+        artifacts = read_letter_dir(Path(args.letters) / args.letter_id)
+        missing = [name for name in ("classification", "llm1", "llm3") if name not in artifacts]
+        if missing:
+            sys.exit(f"Нет результатов {missing} в {args.letters}/{args.letter_id}/")
+        if not templates.add(args.letter_id, artifacts["classification"], artifacts["llm1"], artifacts["llm3"],
+                             artifacts.get("ner")):
+            sys.exit("Не добавлено: нет core_request или одного из четырёх ответов")
+        print(f"Шаблон добавлен, записей: {len(templates.entries)}")
+    elif args.command == "list":
+        for entry in templates.entries:
+            print(f"{entry['letter_id']}\t{entry['type']}\t{', '.join(entry['departments'])}\t{entry['core_request']}")
+    elif args.stale:
+        print(f"Удалено: {templates.evict_stale()}")
+    else:
+        print(f"Удалено: {templates.evict(letter_id=args.letter, type_=args.type, everything=args.all)}")
@@ -1,23 +1,11 @@
-import os
 import json
-from dotenv import load_dotenv
-from openai import OpenAI
+from llm_client import MODEL, get_client
+from json_extract import extract_json
+from prompt_builder import Prompt
+from chunking import split_letter, section_title, chunk_requests, create_all, acreate_all, merge_classification
+import metrics
 
-# ===========================================
-# Загружаем ключи
-# ===========================================
-load_dotenv()
-
-folder_id = os.getenv("folder_id")
-api_key   = os.getenv("api_key")
-
-MODEL = f"gpt://{folder_id}/qwen3-235b-a22b-fp8/latest"
-
-client = OpenAI(
-    base_url="https://rest-assistant.api.cloud.yandex.net/v1",
-    api_key=api_key,
-    project=folder_id
-)
+client = get_client("classifier")
 
 # ===========================================
 # ВХОД: Просто строка
@@ -28,10 +16,6 @@ client = OpenAI(
 # Просим предоставить разъяснения.
 # """  # ← Можешь менять или подгружать из файла
 
-# Загрузка текста письма
-with open("letter.txt", "r", encoding="utf-8") as f:
-    letter_text = f.read().strip()
-
 # ===========================================
 # Параметры классификатора
 # ===========================================
@@ -61,12 +45,17 @@ DEPARTMENT_CATEGORIES_EXPANDED = [
     "Юридический блок / Корпоративное управление и органы банка",
 ]
 
+# Ответ, если модель вернула невалидный JSON
+DEFAULT_CLASSIFICATION = {
+    "type": "Уведомление или информирование",
+    "urgency": "не срочно",
+    "formality": "официальный",
+    "departments": [],
+    "legal_risk": "нет"
+}
 
-def build_prompt(text: str) -> str:
-    categories = "\n".join(f"- {c}" for c in TYPE_CATEGORIES)
-    deps       = "\n".join(f"- {d}" for d in DEPARTMENT_CATEGORIES)
 
-    return f"""
+CLASSIFIER_PROMPT = Prompt("""
 Классифицируй входящее письмо.
 
 1) type — одна из категорий:
@@ -85,57 +74,61 @@ def build_prompt(text: str) -> str:
 5) legal_risk — есть/нет
 
 Формат ответа строго JSON:
-{{
- "type": "...",
- "urgency": "...",
- "formality": "...",
- "departments": ["...", "..."],
- "legal_risk": "..."
-}}
-
-ТЕКСТ:
-{text}
-""".strip()
+{{"type": "...", "urgency": "...", "formality": "...", "departments": ["..."], "legal_risk": "..."}}
+""".format(
+    categories="\n".join(f"- {c}" for c in TYPE_CATEGORIES),
+    deps="\n".join(f"- {d}" for d in DEPARTMENT_CATEGORIES_EXPANDED),
+))
 
 # ===========================================
 # Основная функция
 # ===========================================
+def build_request(text: str, part=None) -> dict:
+    """Запрос классификатора для client.responses.create (part=(i, n) — фрагмент длинного письма)."""
+    return {
+        "model": MODEL,
+        **CLASSIFIER_PROMPT.render(("ТЕКСТ" if part is None else section_title(part), text)),
+        "max_output_tokens": 300,
+        "temperature": 0.0,
+    }
+
+
+def parse_output(raw: str) -> dict:
+    """Разбирает JSON классификатора; при ошибке — класс по умолчанию."""
+    data = extract_json(raw, keys=set(DEFAULT_CLASSIFICATION))
+    if data is None:
+        metrics.note("fallbacks")
+        return dict(DEFAULT_CLASSIFICATION)
+    return data
+
+
+def merge_chunks(raws: list) -> dict:
+    results = [parse_output(raw) for raw in raws]
+    return results[0] if len(results) == 1 else merge_classification(results, DEFAULT_CLASSIFICATION)
+
+
 def classify_letter(text: str) -> dict:
-    prompt = build_prompt(text)
-
-    response = client.responses.create(
-        model=MODEL,
-        input=prompt,
-        max_output_tokens=300,
-        temperature=0.0
-    )
-
-    raw = response.output_text.strip()
-
-    if raw.startswith("```"):
-        raw = raw.strip("`")
-        if raw.startswith("json"):
-            raw = raw[4:].strip()
-
-    try:
-        return json.loads(raw)
-    except Exception:
-        return {
-            "type": "Уведомление или информирование",
-            "urgency": "не срочно",
-            "formality": "официальный",
-            "departments": [],
-            "legal_risk": "нет"
-        }
+    return merge_chunks(create_all(client, chunk_requests(build_request, split_letter(text))))
+
+
+async def arun(call, text: str) -> dict:
+    """classify_letter для пакетного режима."""
+    return merge_chunks(await acreate_all(call, chunk_requests(build_request, split_letter(text))))
+
 
 # ===========================================
 # Запуск
 # ===========================================
-result = classify_letter(letter_text)
+if __name__ == "__main__":
+    # Загрузка текста письма
+    with open("letter.txt", "r", encoding="utf-8") as f:
+        letter_text = f.read().strip()
+
+    result = classify_letter(letter_text)
 
-print(json.dumps(result, ensure_ascii=False, indent=2))
+    print(json.dumps(result, ensure_ascii=False, indent=2))
 
-with open("classification_output.json", "w", encoding="utf-8") as f:
-    json.dump(result, f, ensure_ascii=False, indent=2)
+    with open("classification_output.json", "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
 
-print("Файл сохранён → classification_output.json")
\ No newline at end of file
+    print("Файл сохранён → classification_output.json")
@@ -0,0 +1,124 @@
+# artifact_store.py
+# Хранилище артефактов пайплайна с ключом letter_id.
+# Этапы обмениваются результатами в памяти; на диск — только по желанию:
+#   - root    → папка на письмо: <root>/<letter_id>/ner_output.json и т.д.
+#   - journal → один append-only JSONL-файл: {"letter_id", "name", "value", "ts"} на строку.
+import json
+import time
+import hashlib
+import threading
+from pathlib import Path
+
+# Артефакт → имя файла (те же имена, что читают CLI-скрипты этапов)
+FILE_NAMES = {
+    "letter_text":    "letter.txt",
+    "ner":            "ner_output.json",
+    "classification": "classification_output.json",
+    "llm1":           "llm1_output.json",
+    "rag_docs":       "rag_docs_output.json",
+    "llm2":           "llm2_output.json",
+    "rag_usage":      "rag_usage_output.json",
+    "llm3":           "llm3_output.json",
+    "stage_keys":     "stage_keys.json",     # ключи входов этапов (stage_memo.py)
+}
+
+
+def make_letter_id(letter_text: str) -> str:
+    """Детерминированный id письма по его тексту."""
+    return hashlib.sha1(letter_text.strip().encode("utf-8")).hexdigest()[:12]
+
+
+def read_letter_dir(path) -> dict:
+    """Читает артефакты одного письма из папки (в т.ч. старый формат — файлы в рабочей папке)."""
+    path = Path(path)
+    artifacts = {}
+    for name, file_name in FILE_NAMES.items():
+        file_path = path / file_name
+        if not file_path.exists():
+            continue
+        with file_path.open("r", encoding="utf-8") as f:
+            artifacts[name] = f.read().strip() if name == "letter_text" else json.load(f)
+    return artifacts
+
+
+class ArtifactStore:
+    """
+    Артефакты писем в памяти с необязательной записью на диск.
+
+    store = ArtifactStore(root="letters")          # папка на каждое письмо
+    store = ArtifactStore(journal="journal.jsonl")  # append-only журнал
+    store = ArtifactStore()                         # только память
+    """
+
+    def __init__(self, root=None, journal=None):
+        self.root = Path(root) if root else None
+        self.journal = Path(journal) if journal else None
+        self._data = {}
+        self._lock = threading.Lock()
+
+    # ------------------------
+    # Запись
+    # ------------------------
+    def put(self, letter_id, name, value):
+        with self._lock:
+            self._data.setdefault(letter_id, {})[name] = value
+            if self.root is not None:
+                self._write_file(letter_id, name, value)
+            if self.journal is not None:
+                self._append_journal(letter_id, name, value)
+
+    def _write_file(self, letter_id, name, value):
+        letter_dir = self.root / str(letter_id)
+        letter_dir.mkdir(parents=True, exist_ok=True)
+        with (letter_dir / FILE_NAMES.get(name, f"{name}.json")).open("w", encoding="utf-8") as f:
+            if name == "letter_text":
+                f.write(value)
+            else:
+                json.dump(value, f, ensure_ascii=False, indent=2)
+
+    def _append_journal(self, letter_id, name, value):
+        self.journal.parent.mkdir(parents=True, exist_ok=True)
+        record = {"letter_id": letter_id, "name": name, "value": value, "ts": time.time()}
+        with self.journal.open("a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    # ------------------------
+    # Чтение
+    # ------------------------
+    def get(self, letter_id, name, default=None):
+        return self.letter(letter_id).get(name, default)
+
+    def letter(self, letter_id) -> dict:
+        """Все артефакты письма; если их нет в памяти — подгружает с диска."""
+        with self._lock:
+            if letter_id not in self._data:
+                loaded = self._load(letter_id)
+                if not loaded:
+                    return {}
+                self._data[letter_id] = loaded
+            return dict(self._data[letter_id])
+
+    def _load(self, letter_id) -> dict:
+        artifacts = {}
+        if self.journal is not None and self.journal.exists():
+            with self.journal.open("r", encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    if record["letter_id"] == letter_id:
+                        artifacts[record["name"]] = record["value"]
+        if self.root is not None and (self.root / str(letter_id)).is_dir():
+            artifacts.update(read_letter_dir(self.root / str(letter_id)))
+        return artifacts
+
+    def letters(self):
+        """Известные id писем: из памяти и с диска."""
+        with self._lock:
+            ids = set(self._data)
+        if self.root is not None and self.root.is_dir():
+            ids.update(p.name for p in self.root.iterdir() if p.is_dir())
+        if self.journal is not None and self.journal.exists():
+            with self.journal.open("r", encoding="utf-8") as f:
+                ids.update(json.loads(line)["letter_id"] for line in f if line.strip())
+        return sorted(ids)
@@ -0,0 +1,141 @@
+# batch.py
+# Пакетный режим: много писем в одном цикле событий.
+# Все письма идут через один AsyncOpenAI-клиент (llm_client.py), число одновременных запросов
+# к Yandex responses ограничено, результат каждого письма отдаётся сразу по готовности.
+import asyncio
+import argparse
+import importlib
+from pathlib import Path
+
+from pipeline import get_stages
+from scheduler import Stage, run_graph_async
+from artifact_store import ArtifactStore
+from llm_cache import cache
+from llm_client import get_async_client
+import llm_retry
+import rate_limiter
+import prompt_builder
+import metrics
+
+
+def make_async_call(module, semaphore, stage_name=None):
+    """
+    Асинхронная версия этапа.
+
+    Если модуль этапа определяет arun(call, *args) (этап делает 0 или несколько
+    запросов), вызывается он; иначе — build_request / parse_output модуля.
+    """
+    async def call_llm(request):
+        started = asyncio.get_running_loop().time()
+        async with semaphore:
+            metrics.note("queue_wait", asyncio.get_running_loop().time() - started)
+            return await cache.acreate(get_async_client(stage_name), request)
+
+    async def call(*args):
+        if hasattr(module, "arun"):
+            return await module.arun(call_llm, *args)
+        return module.parse_output(await call_llm(module.build_request(*args)))
+    return call
+
+
+def build_async_stages(semaphore, fused=None):
+    """Тот же граф, что и в pipeline.py, но этапы — корутины."""
+    stages = []
+    for stage in get_stages(fused):
+        module = importlib.import_module(stage.func.__module__)
+        stages.append(Stage(stage.name, make_async_call(module, semaphore, stage.name.lower()),
+                            stage.inputs, stage.output))
+    return stages
+
+
+async def process_letter(letter_id, letter_text, stages, store=None):
+    """Прогоняет одно письмо через граф; ошибка не прерывает весь пакет."""
+    letter_text = letter_text.strip()
+
+    def on_stage_done(stage, result):
+        if store is not None:
+            for name, value in stage.artifacts(result):
+                store.put(letter_id, name, value)
+
+    if store is not None:
+        store.put(letter_id, "letter_text", letter_text)
+
+    try:
+        artifacts, timings = await run_graph_async(metrics.instrument(stages, letter_id),
+                                                   {"letter_text": letter_text}, on_stage_done)
+    except Exception as e:
+        return {"letter_id": letter_id, "result": None, "timings": {}, "error": repr(e)}
+
+    artifacts.pop("letter_text")
+    return {"letter_id": letter_id, "result": artifacts, "timings": timings, "error": None}
+
+
+async def run_batch(letters, concurrency=8, max_letters=None, store=None, fused=None):
+    """
+    Обрабатывает пакет писем и отдаёт результаты по мере готовности.
+
+    letters     — итерируемое из пар (letter_id, текст) или просто строк
+                  (тогда letter_id — порядковый номер).
+    concurrency — максимум одновременных запросов к LLM.
+    max_letters — сколько писем обрабатывается одновременно
+                  (по умолчанию равно concurrency), чтобы первые письма
+                  заканчивались раньше, а не все вместе в конце.
+    store       — ArtifactStore, куда складываются артефакты каждого письма.
+    fused       — объединённый этап анализа (см. pipeline.get_stages).
+
+    Пример:
+        async for item in run_batch(letters, concurrency=16):
+            print(item["letter_id"], item["error"])
+    """
+    request_semaphore = asyncio.Semaphore(concurrency)
+    letter_semaphore = asyncio.Semaphore(max_letters or concurrency)
+    stages = build_async_stages(request_semaphore, fused)
+
+    async def limited(letter_id, letter_text):
+        async with letter_semaphore:
+            return await process_letter(letter_id, letter_text, stages, store)
+
+    tasks = []
+    for n, item in enumerate(letters):
+        letter_id, letter_text = item if isinstance(item, tuple) else (n, item)
+        tasks.append(asyncio.ensure_future(limited(letter_id, letter_text)))
+
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+# ------------------------
+# Запуск как скрипта
+# ------------------------
+async def main(inbox, out_dir, journal, concurrency):
+    letters = [(p.stem, p.read_text(encoding="utf-8")) for p in sorted(Path(inbox).glob("*.txt"))]
+    store = ArtifactStore(root=None if journal else out_dir, journal=journal)
+
+    print(f"Писем в пакете: {len(letters)}, одновременных запросов: {concurrency}")
+
+    done = 0
+    async for item in run_batch(letters, concurrency=concurrency, store=store):
+        done += 1
+        status = "ошибка: " + item["error"] if item["error"] else "готово"
+        print(f"[{done}/{len(letters)}] {item['letter_id']} — {status}")
+
+    print(f"Кэш LLM: {cache.stats()}")
+    print(f"Вызовы LLM (повторы, хеджи, задержки): {llm_retry.stats()}")
+    print(f"Лимитер LLM: {rate_limiter.stats()}")
+    print(f"Промпты (токенов на запрос: префикс / данные, факт, доля кэша): {prompt_builder.stats()}")
+    metrics.write_prometheus()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Пакетная обработка писем из папки (*.txt)")
+    parser.add_argument("inbox", help="папка с письмами *.txt")
+    parser.add_argument("--out", default="letters", help="хранилище артефактов: папка на каждое письмо")
+    parser.add_argument("--journal", help="писать артефакты в append-only журнал вместо папок")
+    parser.add_argument("--concurrency", type=int, default=8, help="максимум одновременных запросов к LLM")
+    args = parser.parse_args()
+
+    asyncio.run(main(args.inbox, args.out, args.journal, args.concurrency))
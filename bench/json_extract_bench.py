@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+# bench/json_extract_bench.py
+# Проверка json_extract на корпусе испорченных ответов модели и замер скорости
+# в сравнении со старым разбором через re.findall(r"\{.*?\}").
+#
+# Большие битые ответы разбираются за линейное время: check_large сравнивает время на n и 4n
+# повторов (раньше каждая «{» разбиралась до конца текста заново — 24 с на 32 КБ).
+#
+#   python bench/json_extract_bench.py              # корпус + большие ответы + замер
+#   python bench/json_extract_bench.py --repeat 2000
+import os
+import re
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from json_extract import find_json  # noqa: E402
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "malformed_outputs.jsonl")
+
+
+def legacy_extract(raw, keys):
+    """Прежний разбор из llm1 / rag1 / rag2 — для сравнения."""
+    valid_objects = []
+    for js in re.findall(r"\{.*?\}", raw, flags=re.DOTALL):
+        try:
+            valid_objects.append(json.loads(js))
+        except Exception:
+            continue
+    for obj in valid_objects:
+        if any(k in obj for k in keys):
+            return obj
+    return valid_objects[0] if valid_objects else None
+
+
+def contains(actual, expected) -> bool:
+    """expected — подмножество actual (для словарей рекурсивно)."""
+    if isinstance(expected, dict):
+        return isinstance(actual, dict) and all(k in actual and contains(actual[k], v) for k, v in expected.items())
+    return actual == expected
+
+
+def load_corpus(path=CORPUS):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def check(corpus) -> int:
+    failed = 0
+    for case in corpus:
+        obj, status = find_json(case["raw"], keys=set(case["keys"]))
+        legacy = legacy_extract(case["raw"], case["keys"])
+        ok = status == case["status"] and (case["expect"] is None or contains(obj, case["expect"]))
+        legacy_ok = case["expect"] is not None and contains(legacy, case["expect"])
+        failed += not ok
+        print(f"{'OK  ' if ok else 'FAIL'} {case['name']:<30} status={status!s:<9} старый разбор: {'да' if legacy_ok else 'нет'}")
+    return failed
+
+
+# Битые ответы, которые раньше разбирались за квадрат
+LARGE_CASES = ['{"a": 1 ', '{"a": ', '{"a": [', '{"a": "x', '{"a": 1,] ', '{"x": 1} {']
+LARGE_BASE = 2000
+LARGE_MAX_SECONDS = 1.0
+
+
+def check_large(base=LARGE_BASE) -> int:
+    """Время разбора растёт линейно с размером: 4n повторов не дольше 8× от n, и не больше секунды."""
+    failed = 0
+    for piece in LARGE_CASES:
+        times = []
+        for n in (base, 4 * base):
+            start = time.perf_counter()
+            find_json(piece * n, keys={"answers"})
+            times.append(time.perf_counter() - start)
+        ok = times[1] <= max(8 * times[0], 0.05) and times[1] <= LARGE_MAX_SECONDS
+        failed += not ok
+        print(f"{'OK  ' if ok else 'FAIL'} {piece!r:<14} × {4 * base:<6} {times[0] * 1e3:7.1f} мс → {times[1] * 1e3:7.1f} мс")
+    return failed
+
+
+def bench(corpus, repeat):
+    groups = [("целые", [c for c in corpus if c["status"] == "ok"]),
+              ("битые", [c for c in corpus if c["status"] != "ok"])]
+    for name, func in [("json_extract", lambda c: find_json(c["raw"], keys=set(c["keys"]))),
+                       ("re.findall", lambda c: legacy_extract(c["raw"], c["keys"]))]:
+        for group, cases in groups:
+            start = time.perf_counter()
+            for _ in range(repeat):
+                for case in cases:
+                    func(case)
+            elapsed = time.perf_counter() - start
+            per_call = elapsed / (repeat * len(cases)) * 1e6
+            size = sum(len(c["raw"]) for c in cases)
+            print(f"{name:<14} {group:<6} {per_call:8.1f} мкс/ответ  {size * repeat / elapsed / 1e6:6.1f} МБ/с")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Корпус и микробенчмарк разбора JSON из ответов LLM")
+    parser.add_argument("--repeat", type=int, default=500)
+    args = parser.parse_args()
+
+    corpus = load_corpus()
+    failed = check(corpus)
+    print()
+    failed += check_large()
+    print()
+    bench(corpus, args.repeat)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+# bench/mock_yandex.py
+# Локальная замена Yandex responses API (OpenAI-совместимый POST /v1/responses) для замеров без ключей и сети.
+#
+# Ответ выбирается так:
+#   1. записанный ответ из recordings.jsonl по хешу запроса (тот же ключ, что у llm_cache);
+#   2. иначе — синтетический ответ нужной этапу схемы (этап определяется по промпту).
+# Задержка этапа — логнормальная (медиана, sigma); ошибки 429 / 500 / 503 и обрыв ответа
+# по max_output_tokens включаются с заданной вероятностью. Поддерживается stream=True (SSE).
+# Повторный префикс (instructions) отдаётся в usage как cached_tokens — как кэш префикса у провайдера.
+#
+#   python bench/mock_yandex.py serve --port 8011 --latency-scale 0.1 --error-rate 0.02 --truncate-rate 0.05
+#   LLM_BASE_URL=http://127.0.0.1:8011/v1 python pipeline.py
+#
+#   python bench/mock_yandex.py record --cache llm_cache.sqlite   # записанные ответы из кэша LLM
+import os
+import sys
+import json
+import math
+import time
+import random
+import sqlite3
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from llm_cache import ResponseCache  # noqa: E402
+
+RECORDINGS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "recordings.jsonl")
+
+# Медиана задержки, сек, и sigma логнормального распределения — порядок величин реального API
+DEFAULT_LATENCY = {
+    "ner": (1.5, 0.35), "ner_entities": (0.8, 0.3), "classifier": (1.0, 0.3), "llm1": (1.2, 0.3),
+    "analysis": (3.0, 0.35), "rag1": (2.5, 0.35), "rag2": (2.5, 0.4),
+    "llm2": (9.0, 0.4), "llm2_style": (4.0, 0.4), "llm2_adapt": (2.0, 0.3), "llm3": (9.0, 0.4), "llm3_style": (4.0, 0.4),
+    "unknown": (1.0, 0.3),
+}
+ERROR_STATUSES = {429: 0.5, 500: 0.25, 503: 0.25}
+
+# Этап по характерной фразе промпта (порядок важен: промпты LLM2 / RAG2 содержат JSON предыдущих этапов)
+STAGE_MARKERS = [
+    ("analysis",     "заполни ТРИ раздела"),
+    ("rag2",         "Список документов, которые система RAG"),
+    ("llm3_style",   "скорректированный текст ответа"),
+    ("llm3",         "комплаенс-эксперт"),
+    ("llm2_style",   "Подготовь ОДИН вариант ответа"),
+    ("llm2_adapt",   "Приспособь их к текущему письму"),
+    ("llm2",         "по подготовке деловой переписки"),
+    ("rag1",         "эксперт по внутренним документам"),
+    ("ner_entities", "ФИО людей и названия организаций"),
+    ("ner",          "(NER)"),
+    ("classifier",   "Классифицируй"),
+    ("llm1",         "Суть запроса"),
+]
+
+STYLES = ["official", "business", "client_friendly", "simple"]
+ANSWER = ("Уважаемый клиент! Благодарим за обращение. Ваше письмо зарегистрировано и передано "
+          "в профильное подразделение. Мы проверим изложенные обстоятельства и сообщим о результатах "
+          "в установленный срок. ")
+
+
+def detect_stage(prompt_text: str) -> str:
+    for stage, marker in STAGE_MARKERS:
+        if marker in prompt_text:
+            return stage
+    return "unknown"
+
+
+def synthetic_output(stage: str) -> str:
+    """Правдоподобный ответ в схеме этапа (для запросов, которых нет в записях)."""
+    answers = {style: ANSWER * 3 for style in STYLES}
+    outputs = {
+        "ner": {"contract_numbers": ["45-ПСБ"], "deadlines": [{"text": "в течение 10 рабочих дней", "date": None,
+                                                             "type": "relative"}],
+                "law_refs": ["ст. 395 ГК РФ"], "contacts": {"emails": [], "phones": [], "persons": []},
+                "organizations": ['ООО "Кредитор"']},
+        "ner_entities": {"contacts": {"persons": []}, "organizations": ['ООО "Кредитор"']},
+        "classifier": {"type": "Официальная жалоба или претензия", "urgency": "средне срочно",
+                       "formality": "официальный", "departments": ["Юридический блок / Договорное право"],
+                       "legal_risk": "есть"},
+        "llm1": {"core_request": "Погасить задолженность по договору", "requirements": "Оплатить долг и проценты",
+                 "expectations": "Досудебное урегулирование"},
+        "rag1": {"valid_docs": [{"code": "POLICY_COMPLAINTS", "kind": "policy", "name": "Регламент рассмотрения претензий",
+                                 "reason": "претензия по договору", "priority": "high"}],
+                 "recommended_docs": [{"code": "TEMPLATE_CLAIM_REPLY", "kind": "template",
+                                       "name": "Шаблон ответа на претензию", "reason": "ответ клиенту",
+                                       "priority": "medium"}]},
+        "llm2": {"answers": answers},
+        "llm3": {"answers": answers, "issues": {style: [] for style in STYLES}},
+        "llm3_style": {"answer": ANSWER * 3, "issues": []},
+        "llm2_adapt": {"fits": True, "replacements": [{"find": "Уважаемый клиент!", "replace": "Уважаемые коллеги!"}]},
+        "rag2": {"analysis": {style: {"used_docs": ["POLICY_COMPLAINTS"], "missing_docs": [], "hallucinated_refs": [],
+                                      "comment": "опирается на регламент"} for style in STYLES}},
+    }
+    outputs["analysis"] = {"ner": outputs["ner"], "classification": outputs["classifier"], "llm1": outputs["llm1"]}
+    if stage == "llm2_style":
+        return ANSWER * 3
+    return "```json\n" + json.dumps(outputs.get(stage, {}), ensure_ascii=False, indent=2) + "\n```"
+
+
+def load_recordings(path=RECORDINGS) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return {r["key"]: r["output_text"] for r in (json.loads(line) for line in f if line.strip())}
+
+
+# ------------------------
+# Поведение стенда
+# ------------------------
+class MockBehavior:
+    def __init__(self, latency=None, latency_scale=1.0, error_rate=0.0, truncate_rate=0.0,
+                 recordings=None, seed=None):
+        self.latency = {**DEFAULT_LATENCY, **(latency or {})}
+        self.latency_scale = latency_scale
+        self.error_rate = error_rate
+        self.truncate_rate = truncate_rate
+        self.recordings = recordings if recordings is not None else load_recordings()
+        self.random = random.Random(seed)
+        self.stats = {}
+        self._prefixes = set()
+        self._lock = threading.Lock()
+
+    def count(self, stage, outcome):
+        with self._lock:
+            by_stage = self.stats.setdefault(stage, {})
+            by_stage[outcome] = by_stage.get(outcome, 0) + 1
+
+    def delay(self, stage) -> float:
+        median, sigma = self.latency.get(stage, self.latency["unknown"])
+        with self._lock:
+            z = self.random.gauss(0, 1)
+        return median * math.exp(sigma * z) * self.latency_scale
+
+    def error(self):
+        with self._lock:
+            if self.random.random() >= self.error_rate:
+                return None
+            roll, acc = self.random.random(), 0.0
+        for status, share in ERROR_STATUSES.items():
+            acc += share
+            if roll < acc:
+                return status
+        return 500
+
+    def cached_tokens(self, request: dict) -> int:
+        """Кэш префикса, как у провайдера: повторные instructions считаются кэшированными."""
+        instructions = request.get("instructions") or ""
+        with self._lock:
+            seen = instructions in self._prefixes
+            self._prefixes.add(instructions)
+        return len(instructions) // 3 if seen else 0
+
+    def respond(self, request: dict):
+        """(этап, текст ответа, оборван ли ответ)."""
+        prompt_text = json.dumps([request.get("instructions"), request.get("input")], ensure_ascii=False)
+        stage = detect_stage(prompt_text)
+        key = ResponseCache.key({k: v for k, v in request.items() if k != "stream"})
+        text = self.recordings.get(key)
+        if text is None:
+            text = synthetic_output(stage)
+        with self._lock:
+            truncated = self.random.random() < self.truncate_rate
+            cut = self.random.uniform(0.3, 0.9)
+        if truncated:
+            text = text[:int(len(text) * cut)]
+        return stage, text, truncated
+
+
+def response_object(request, text, truncated, cached_tokens=0) -> dict:
+    input_tokens = (len(request.get("instructions") or "") + len(json.dumps(request.get("input"), ensure_ascii=False))) // 3
+    output_tokens = max(1, len(text) // 3)
+    return {
+        "id": f"resp_{random.getrandbits(48):012x}",
+        "object": "response",
+        "created_at": int(time.time()),
+        "model": request.get("model"),
+        "status": "incomplete" if truncated else "completed",
+        "incomplete_details": {"reason": "max_output_tokens"} if truncated else None,
+        "output": [{
+            "type": "message", "id": "msg_0", "status": "completed", "role": "assistant",
+            "content": [{"type": "output_text", "text": text, "annotations": []}],
+        }],
+        "parallel_tool_calls": False, "tool_choice": "auto", "tools": [],
+        "usage": {
+            "input_tokens": input_tokens, "input_tokens_details": {"cached_tokens": cached_tokens},
+            "output_tokens": output_tokens, "output_tokens_details": {"reasoning_tokens": 0},
+            "total_tokens": input_tokens + output_tokens,
+        },
+    }
+
+
+# ------------------------
+# HTTP
+# ------------------------
+class Handler(BaseHTTPRequestHandler):
+    behavior: MockBehavior = None
+    protocol_version = "HTTP/1.1"     # keep-alive, как у настоящего API
+
+    def log_message(self, format, *args):
+        pass
+
+    def _json(self, status, value, headers=()):
+        body = json.dumps(value, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/stats":
+            return self._json(200, self.behavior.stats)
+        self._json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/responses"):
+            return self._json(404, {"error": {"message": "not found"}})
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        stage, text, truncated = self.behavior.respond(request)
+        delay = self.behavior.delay(stage)
+
+        status = self.behavior.error()
+        if status is not None:
+            time.sleep(delay * 0.2)
+            self.behavior.count(stage, str(status))
+            headers = [("Retry-After", "1")] if status == 429 else []
+            return self._json(status, {"error": {"message": f"mock error {status}", "code": status}}, headers)
+
+        self.behavior.count(stage, "truncated" if truncated else "ok")
+        response = response_object(request, text, truncated, self.behavior.cached_tokens(request))
+        if request.get("stream"):
+            return self._stream(response, text, delay)
+        time.sleep(delay)
+        self._json(200, response)
+
+    def _stream(self, response, text, delay):
+        """SSE: response.created, дельты текста равномерно за время delay, response.completed."""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def send(event):
+            self.wfile.write(f"event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        seq = 0
+        send({"type": "response.created", "sequence_number": seq, "response": {**response, "status": "in_progress"}})
+        chunks = [text[i:i + 40] for i in range(0, len(text), 40)] or [""]
+        for chunk in chunks:
+            time.sleep(delay / len(chunks))
+            seq += 1
+            send({"type": "response.output_text.delta", "sequence_number": seq, "item_id": "msg_0",
+                  "output_index": 0, "content_index": 0, "delta": chunk, "logprobs": []})
+        send({"type": "response.completed", "sequence_number": seq + 1, "response": response})
+
+
+class MockServer:
+    """Стенд в фоновом потоке: with MockServer(...) as mock: os.environ["LLM_BASE_URL"] = mock.base_url."""
+
+    def __init__(self, behavior=None, host="127.0.0.1", port=0):
+        handler = type("BoundHandler", (Handler,), {"behavior": behavior or MockBehavior()})
+        self.behavior = handler.behavior
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self.base_url = f"http://{host}:{self.httpd.server_address[1]}/v1"
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def record_from_cache(cache_path, out_path=RECORDINGS) -> int:
+    """Выгружает ответы из llm_cache.sqlite в recordings.jsonl (ключ — хеш запроса)."""
+    conn = sqlite3.connect(cache_path)
+    rows = conn.execute("SELECT key, output_text FROM responses").fetchall()
+    conn.close()
+    with open(out_path, "w", encoding="utf-8") as f:
+        for key, output_text in rows:
+            f.write(json.dumps({"key": key, "output_text": output_text}, ensure_ascii=False) + "\n")
+    return len(rows)
+
+
+def load_profile(path) -> dict:
+    """JSON: {"latency": {"llm2": [9.0, 0.4], ...}, "error_rate": 0.02, "truncate_rate": 0.05}."""
+    if not path:
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        profile = json.load(f)
+    profile["latency"] = {stage: tuple(v) for stage, v in profile.get("latency", {}).items()}
+    return profile
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Локальная замена Yandex responses API")
+    sub = parser.add_subparsers(dest="command", required=True)
+    serve = sub.add_parser("serve")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8011)
+    serve.add_argument("--profile", help="JSON с задержками и долями ошибок")
+    serve.add_argument("--latency-scale", type=float, default=1.0, help="множитель всех задержек")
+    serve.add_argument("--error-rate", type=float, default=None)
+    serve.add_argument("--truncate-rate", type=float, default=None)
+    serve.add_argument("--seed", type=int)
+    record = sub.add_parser("record")
+    record.add_argument("--cache", default="llm_cache.sqlite")
+    record.add_argument("--out", default=RECORDINGS)
+    args = parser.parse_args()
+
+    if args.command == "record":
+        print(f"Записано ответов: {record_from_cache(args.cache, args.out)} → {args.out}")
+    else:
+        profile = load_profile(args.profile)
+        behavior = MockBehavior(
+            latency=profile.get("latency"), latency_scale=args.latency_scale,
+            error_rate=args.error_rate if args.error_rate is not None else profile.get("error_rate", 0.0),
+            truncate_rate=args.truncate_rate if args.truncate_rate is not None else profile.get("truncate_rate", 0.0),
+            seed=args.seed,
+        )
+        with MockServer(behavior, args.host, args.port) as mock:
+            print(f"Стенд: {mock.base_url} (записанных ответов: {len(behavior.recordings)})")
+            try:
+                while True:
+                    time.sleep(3600)
+            except KeyboardInterrupt:
+                pass
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+# bench/pipeline_bench.py
+# Нагрузочный прогон пайплайна без сети и ключей: все запросы к LLM уходят в локальный
+# стенд bench/mock_yandex.py. Корпус писем (bench/corpus/*.txt) прогоняется на нескольких
+# уровнях параллельности через pipeline() и batch.run_batch().
+#
+# Отчёт по каждому прогону: пропускная способность, задержка письма p50/p95
+# (от постановки в очередь до результата), p50/p95 по этапам (metrics.py),
+# доля неразобранных ответов и откатов на значения по умолчанию.
+# Результат пишется в bench/results/<время>.json; --compare сравнивает с прошлым прогоном.
+#
+#   python bench/pipeline_bench.py                                   # pipeline и batch, 1/4/8
+#   python bench/pipeline_bench.py --mode batch --concurrency 1,8,32 --repeat 3
+#   python bench/pipeline_bench.py --error-rate 0.05 --truncate-rate 0.1
+#   python bench/pipeline_bench.py --compare bench/results/20241118-101500.json
+#
+# --latency-scale 0.05 ускоряет стенд в 20 раз (для быстрой проверки, а не для замеров).
+# Переменные окружения пайплайна (LLM_RPS, LLM_HEDGE, ...) действуют как обычно;
+# по умолчанию кэш LLM, поиск почти одинаковых писем и шаблоны ответов отключены,
+# лимитер не мешает, журнал метрик не пишется.
+import io
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import importlib
+import subprocess
+import contextlib
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = Path(__file__).resolve().parent
+ROOT = BENCH_DIR.parent
+sys.path.insert(0, str(ROOT))
+
+# Модули пайплайна (и llm_cache, который импортирует стенд) читают настройки при импорте
+os.environ.setdefault("api_key", "mock")
+os.environ.setdefault("folder_id", "mock")
+os.environ.setdefault("LLM_CACHE_BYPASS", "1")
+os.environ.setdefault("LLM_RPS", "1000")
+os.environ.setdefault("METRICS_LOG", "")
+os.environ.setdefault("METRICS_PROM_PATH", "")
+os.environ.setdefault("NEAR_DUP", "0")          # повторы корпуса (--repeat) иначе не доходят до LLM
+os.environ.setdefault("ANSWER_TEMPLATES_PATH", "")  # кэш одобренных ответов — только в памяти, пустой
+
+from mock_yandex import MockServer, MockBehavior, load_profile  # noqa: E402
+
+CORPUS = BENCH_DIR / "corpus"
+RESULTS = BENCH_DIR / "results"
+
+
+def quantile(values, q):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def load_corpus(path) -> list:
+    letters = [(p.stem, p.read_text(encoding="utf-8")) for p in sorted(Path(path).glob("*.txt"))]
+    if not letters:
+        sys.exit(f"Нет писем *.txt в {path}")
+    return letters
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+# ------------------------
+# Прогоны
+# ------------------------
+def run_pipeline(modules, letters, concurrency) -> list:
+    """pipeline() на пуле потоков: concurrency писем одновременно."""
+    started = time.perf_counter()
+    store = modules["artifact_store"].ArtifactStore()
+
+    def one(letter_id, letter_text):
+        try:
+            modules["pipeline"].pipeline(letter_text, letter_id=letter_id, store=store)
+            error = None
+        except Exception as e:
+            error = repr(e)
+        return {"letter_id": letter_id, "latency": time.perf_counter() - started, "error": error}
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(lambda item: one(*item), letters))
+
+
+def run_batch(modules, letters, concurrency) -> list:
+    """batch.run_batch: concurrency одновременных запросов к LLM."""
+    async def go():
+        started = time.perf_counter()
+        results = []
+        async for item in modules["batch"].run_batch(letters, concurrency=concurrency):
+            results.append({"letter_id": item["letter_id"], "latency": time.perf_counter() - started,
+                            "error": item["error"]})
+        return results
+    return asyncio.run(go())
+
+
+MODES = {"pipeline": run_pipeline, "batch": run_batch}
+
+
+def measure(modules, mock, mode, letters, concurrency) -> dict:
+    metrics = modules["metrics"]
+    metrics.registry = metrics.Aggregate(window=None)
+    mock.behavior.stats = {}
+
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):     # отчёты pipeline() по каждому письму не нужны
+        results = MODES[mode](modules, letters, concurrency)
+    elapsed = time.perf_counter() - started
+
+    snapshot = metrics.registry.snapshot()
+    latencies = [r["latency"] for r in results]
+    calls = sum(s["llm_calls"] for s in snapshot.values())
+    failures = sum(s["parse_failures"] for s in snapshot.values())
+    stages = {
+        name: {
+            "count": s["count"],
+            "p50": quantile(s["walls"], 0.5),
+            "p95": quantile(s["walls"], 0.95),
+            "llm_calls": s["llm_calls"],
+            "parse_failures": s["parse_failures"],
+            "parse_repaired": s["parse_repaired"],
+            "fallbacks": s["fallbacks"],
+            "retries": s["retries"],
+        }
+        for name, s in sorted(snapshot.items())
+    }
+    return {
+        "mode": mode,
+        "concurrency": concurrency,
+        "letters": len(results),
+        "errors": sum(r["error"] is not None for r in results),
+        "elapsed": round(elapsed, 3),
+        "throughput": round(len(results) / elapsed * 60, 2),     # писем в минуту
+        "latency_p50": quantile(latencies, 0.5),
+        "latency_p95": quantile(latencies, 0.95),
+        "llm_calls": calls,
+        "parse_failure_rate": round(failures / calls, 4) if calls else None,
+        "fallbacks": sum(s["fallbacks"] for s in snapshot.values()),
+        "stages": stages,
+        "mock": mock.behavior.stats,
+    }
+
+
+# ------------------------
+# Отчёт и сравнение
+# ------------------------
+def fmt(value, digits=2):
+    return "—" if value is None else f"{value:.{digits}f}"
+
+
+def format_run(run) -> str:
+    lines = [
+        f"{run['mode']} ×{run['concurrency']}: {run['letters']} писем за {run['elapsed']:.1f} с "
+        f"({run['throughput']:.1f} писем/мин), ошибок {run['errors']}, "
+        f"письмо p50 {fmt(run['latency_p50'])} с / p95 {fmt(run['latency_p95'])} с, "
+        f"неразобранных ответов {fmt((run['parse_failure_rate'] or 0) * 100, 1)}%, откатов {run['fallbacks']}",
+        f"    {'этап':<14}{'n':>5}{'p50, с':>9}{'p95, с':>9}{'вызовов':>9}{'разбор':>8}{'починка':>9}{'откат':>7}",
+    ]
+    for name, s in run["stages"].items():
+        lines.append(f"    {name:<14}{s['count']:>5}{fmt(s['p50']):>9}{fmt(s['p95']):>9}{s['llm_calls']:>9}"
+                     f"{s['parse_failures']:>8}{s['parse_repaired']:>9}{s['fallbacks']:>7}")
+    return "\n".join(lines)
+
+
+def delta(new, old):
+    if new is None or not old:
+        return "—"
+    return f"{(new - old) / old * 100:+.1f}%"
+
+
+def format_compare(current, baseline) -> str:
+    old_runs = {(r["mode"], r["concurrency"]): r for r in baseline["runs"]}
+    lines = [f"Сравнение с {baseline['meta'].get('started')} (коммит {baseline['meta'].get('commit')}):"]
+    for run in current["runs"]:
+        old = old_runs.get((run["mode"], run["concurrency"]))
+        if old is None:
+            lines.append(f"  {run['mode']} ×{run['concurrency']}: нет в базовом прогоне")
+            continue
+        lines.append(
+            f"  {run['mode']} ×{run['concurrency']}: писем/мин {delta(run['throughput'], old['throughput'])}, "
+            f"p50 {delta(run['latency_p50'], old['latency_p50'])}, p95 {delta(run['latency_p95'], old['latency_p95'])}, "
+            f"неразобранных {fmt((old['parse_failure_rate'] or 0) * 100, 1)}% → "
+            f"{fmt((run['parse_failure_rate'] or 0) * 100, 1)}%"
+        )
+        for name, s in run["stages"].items():
+            o = old["stages"].get(name)
+            if o is not None:
+                lines.append(f"      {name:<14}p95 {fmt(o['p95'])} → {fmt(s['p95'])} с ({delta(s['p95'], o['p95'])})")
+    return "\n".join(lines)
+
+
+# ------------------------
+# Запуск
+# ------------------------
+def load_pipeline(base_url):
+    """Импорт пайплайна после запуска стенда: llm_client берёт LLM_BASE_URL при импорте."""
+    os.environ["LLM_BASE_URL"] = base_url
+    names = ("metrics", "artifact_store", "pipeline", "batch")
+    return {name: importlib.import_module(name) for name in names}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Прогон пайплайна на локальном стенде Yandex responses API")
+    parser.add_argument("--mode", choices=["pipeline", "batch", "all"], default="all")
+    parser.add_argument("--concurrency", default="1,4,8", help="уровни параллельности через запятую")
+    parser.add_argument("--repeat", type=int, default=1, help="сколько раз повторить корпус в каждом прогоне")
+    parser.add_argument("--corpus", default=str(CORPUS), help="папка с письмами *.txt")
+    parser.add_argument("--profile", help="JSON с задержками этапов и долями ошибок (см. mock_yandex.load_profile)")
+    parser.add_argument("--latency-scale", type=float, default=None, help="множитель задержек стенда")
+    parser.add_argument("--error-rate", type=float, default=None, help="доля ответов 429/5xx")
+    parser.add_argument("--truncate-rate", type=float, default=None, help="доля оборванных ответов")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=None, help="файл результата (по умолчанию bench/results/<время>.json)")
+    parser.add_argument("--compare", help="прошлый результат для сравнения")
+    args = parser.parse_args()
+
+    profile = load_profile(args.profile)
+    for key in ("latency_scale", "error_rate", "truncate_rate"):
+        if getattr(args, key) is not None:
+            profile[key] = getattr(args, key)
+    behavior = MockBehavior(seed=args.seed, **profile)
+
+    corpus = load_corpus(args.corpus)
+    letters = [(f"{name}-{n}", text) for n in range(args.repeat) for name, text in corpus]
+    modes = ["pipeline", "batch"] if args.mode == "all" else [args.mode]
+    levels = [int(c) for c in args.concurrency.split(",") if c.strip()]
+
+    meta = {
+        "started": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "commit": git_commit(),
+        "corpus": args.corpus,
+        "letters": len(letters),
+        "profile": args.profile,
+        "latency_scale": behavior.latency_scale,
+        "error_rate": behavior.error_rate,
+        "truncate_rate": behavior.truncate_rate,
+        "recordings": len(behavior.recordings),
+        "seed": args.seed,
+    }
+    print(f"Писем в прогоне: {len(letters)}, записанных ответов: {meta['recordings']}, "
+          f"масштаб задержек: {behavior.latency_scale}")
+
+    runs = []
+    with MockServer(behavior) as mock:
+        modules = load_pipeline(mock.base_url)
+        for mode in modes:
+            for concurrency in levels:
+                run = measure(modules, mock, mode, letters, concurrency)
+                print(format_run(run), end="\n\n")
+                runs.append(run)
+
+    result = {"meta": meta, "runs": runs}
+    out = Path(args.out) if args.out else RESULTS / (time.strftime("%Y%m%d-%H%M%S") + ".json")
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(result, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"Результат: {out}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            print(format_compare(result, json.load(f)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# bench/rag2_merge_check.py
+# Проверка RAG2_MODE=hybrid: в результат правил подставляются только стили, которые модель
+# действительно разобрала. Пропущенный в ответе стиль, пустой разбор или неразобранный ответ
+# оставляют результат правил. Сеть и ключи не нужны.
+#
+#   python bench/rag2_merge_check.py
+import os
+import sys
+import json
+import copy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+# ключи нужны только чтобы импортировать модуль этапа
+os.environ.setdefault("api_key", "mock")
+os.environ.setdefault("folder_id", "mock")
+
+from rag2_yandex import merge_output  # noqa: E402
+
+
+def rules_result() -> dict:
+    """Результат правил: official, business и simple — с низкой уверенностью, client_friendly — уверенно."""
+    def item(code, confidence):
+        return {"used_docs": [code], "missing_docs": [], "hallucinated_refs": [],
+                "comment": "правила", "confidence": confidence}
+    return {"analysis": {"official": item("R-1", 0.5), "business": item("R-2", 0.5),
+                         "client_friendly": item("R-3", 1.0), "simple": item("R-4", 0.4)}}
+
+
+CASES = [
+    # (название, ответ модели, стили, которые должны прийти из ответа модели)
+    ("partial_reply",
+     {"analysis": {"official": {"used_docs": ["L-1"], "comment": "ссылка на регламент есть"}}},
+     {"official"}),
+    ("empty_verdicts",
+     {"analysis": {"official": {"used_docs": [], "missing_docs": [], "hallucinated_refs": [], "comment": ""},
+                   "business": {"hallucinated_refs": ["ст. 999 ГК РФ"]},
+                   "simple": "нет данных"}},
+     {"business"}),
+    ("truncated_reply",
+     '{"analysis": {"official": {"used_docs": ["L-1"], "comment": "есть"}, "simple": {"used_do',
+     {"official"}),
+    ("not_json", "Не могу выполнить анализ.", set()),
+]
+
+
+def check() -> int:
+    failed = 0
+    for name, reply, from_llm in CASES:
+        raw = reply if isinstance(reply, str) else json.dumps(reply, ensure_ascii=False)
+        rules = rules_result()
+        merged = merge_output(copy.deepcopy(rules), raw)["analysis"]
+        problems = []
+        for style, item in merged.items():
+            expected = rules["analysis"][style]
+            if style in from_llm:
+                if item == expected or item["confidence"] != expected["confidence"]:
+                    problems.append(f"{style}: нет ответа модели")
+                elif not all(key in item for key in ("used_docs", "missing_docs", "hallucinated_refs", "comment")):
+                    problems.append(f"{style}: не все поля")
+            elif item != expected:
+                problems.append(f"{style}: затёрт результат правил")
+        failed += bool(problems)
+        print(f"{'FAIL' if problems else 'OK  '} {name:<18} {'; '.join(problems)}")
+    return failed
+
+
+if __name__ == "__main__":
+    sys.exit(1 if check() else 0)
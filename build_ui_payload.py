@@ -1,45 +1,45 @@
 # build_ui_payload.py
 import json
+import argparse
 from pathlib import Path
 
+from artifact_store import ArtifactStore, read_letter_dir
+
 BASE = Path(".")
 
-def load_json(name, default):
-    path = BASE / name
-    if not path.exists():
-        return default
-    with path.open("r", encoding="utf-8") as f:
-        return json.load(f)
+# Стили ответов пайплайна → кнопки стилей в ии_6.html
+UI_STYLES = {"official": "formal", "business": "business", "client_friendly": "client", "simple": "brief"}
 
-def main():
+def build_payload(artifacts: dict) -> dict:
+    """Собирает ui_payload из артефактов одного письма (см. artifact_store.FILE_NAMES)."""
     # NER
-    ner = load_json("ner_output.json", {
+    ner = artifacts.get("ner") or {
         "contract_numbers": [],
         "deadlines": [],
         "law_refs": [],
         "contacts": {},
         "organizations": []
-    })
+    }
 
     # Классификация
-    classification = load_json("classification_output.json", {
+    classification = artifacts.get("classification") or {
         "type": None,
         "urgency": None,
         "formality": None,
         "departments": [],
         "legal_risk": None,
         "deadline": None
-    })
+    }
 
     # Ответы LLM2
-    llm2 = load_json("llm2_output.json", {"answers": {}})
+    llm2 = artifacts.get("llm2") or {"answers": {}}
     answers = llm2.get("answers", {})
 
     # Документы из RAG1
-    rag_docs = load_json("rag_docs_output.json", {
+    rag_docs = artifacts.get("rag_docs") or {
         "valid_docs": [],
         "recommended_docs": []
-    })
+    }
 
     # Дедлайн для UI: сначала пытаемся взять из classification, если нет — из NER
     ui_deadline = classification.get("deadline")
@@ -49,7 +49,7 @@ def main():
                 ui_deadline = d["date"]
                 break
 
-    ui_payload = {
+    return {
         "ner": ner,
         "classification": {
             "type": classification.get("type"),
@@ -59,19 +59,31 @@ def main():
             "legal_risk": classification.get("legal_risk"),
             "deadline": ui_deadline,
         },
-        "answers": {
-            # маппинг на стили UI
-            "formal":   answers.get("official"),
-            "business": answers.get("business"),
-            "client":   answers.get("client_friendly"),
-            "brief":    answers.get("simple"),
-        },
+        # маппинг на стили UI
+        "answers": {ui_style: answers.get(style) for style, ui_style in UI_STYLES.items()},
         "rag_docs": {
             "valid_docs": rag_docs.get("valid_docs", []),
             "recommended_docs": rag_docs.get("recommended_docs", []),
         },
     }
 
+def main():
+    parser = argparse.ArgumentParser(description="Сборка ui_payload.json для ии_6.html")
+    parser.add_argument("--letter", help="letter_id в хранилище артефактов (без него — файлы в текущей папке)")
+    parser.add_argument("--store", default="letters", help="папка хранилища (letters/<letter_id>/)")
+    parser.add_argument("--journal", help="append-only журнал артефактов вместо папки")
+    args = parser.parse_args()
+
+    if args.letter:
+        store = ArtifactStore(root=None if args.journal else args.store, journal=args.journal)
+        artifacts = store.letter(args.letter)
+        if not artifacts:
+            raise SystemExit(f"Письмо {args.letter} не найдено в хранилище")
+    else:
+        artifacts = read_letter_dir(BASE)
+
+    ui_payload = build_payload(artifacts)
+
     with open("ui_payload.json", "w", encoding="utf-8") as f:
         json.dump(ui_payload, f, ensure_ascii=False, indent=2)
 
@@ -0,0 +1,207 @@
+# chunking.py
+# Длинные письма и переписки: разбиение на фрагменты и сведение результатов (map-reduce).
+#
+# Письмо длиннее LONG_LETTER_TOKENS токенов (prompt_builder.count_tokens) режется на фрагменты
+# не длиннее LONG_CHUNK_TOKENS с перекрытием LONG_CHUNK_OVERLAP токенов — сущность на стыке
+# попадает в оба соседних фрагмента. Границы — по абзацам, слишком длинный абзац — по предложениям;
+# начало пересланного / цитируемого сообщения («От:», «-----Original Message-----») всегда
+# начинает новый фрагмент.
+#
+# NER, классификатор, LLM1 и объединённый анализ отправляют фрагменты параллельно,
+# результаты сводятся в прежние схемы: сущности и требования — без дубликатов.
+# Время на длинном письме растёт с числом фрагментов на одного исполнителя, а не с длиной текста.
+# Генерация ответа (RAG1 / LLM2 / RAG2) получает сокращённое письмо: начало и конец (condense),
+# требования всего письма к этому моменту уже собраны в LLM1.
+#
+#   LONG_LETTER_TOKENS=3000 (0 — не разбивать), LONG_CHUNK_TOKENS=1500, LONG_CHUNK_OVERLAP=150
+import os
+import re
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from prompt_builder import count_tokens
+from llm_cache import cache
+import metrics
+
+LONG_LETTER_TOKENS = int(os.getenv("LONG_LETTER_TOKENS", 3000))
+CHUNK_TOKENS       = int(os.getenv("LONG_CHUNK_TOKENS", 1500))
+CHUNK_OVERLAP      = int(os.getenv("LONG_CHUNK_OVERLAP", 150))
+
+# Начало следующего сообщения в цепочке
+THREAD_RE = re.compile(
+    r"^\s*(?:-{2,}\s*(?:original message|forwarded message|исходное сообщение|пересылаемое сообщение)"
+    r"|(?:от|from|отправлено|sent)\s*:)",
+    re.IGNORECASE,
+)
+SENTENCE_RE = re.compile(r"(?<=[.!?…;])\s+")
+
+URGENCY_ORDER = ["не срочно", "средне срочно", "очень срочно"]
+
+
+# ------------------------
+# Разбиение
+# ------------------------
+def is_long(letter_text: str) -> bool:
+    return LONG_LETTER_TOKENS > 0 and count_tokens(letter_text) > LONG_LETTER_TOKENS
+
+
+def _pieces(text: str, limit: int) -> list:
+    """Абзац не длиннее limit токенов целиком, иначе — предложения (или слова) подряд."""
+    if count_tokens(text) <= limit:
+        return [text]
+    pieces = []
+    for sentence in SENTENCE_RE.split(text):
+        if count_tokens(sentence) <= limit:
+            pieces.append(sentence)
+            continue
+        words, current = sentence.split(), []
+        for word in words:
+            if current and count_tokens(" ".join(current + [word])) > limit:
+                pieces.append(" ".join(current))
+                current = []
+            current.append(word)
+        if current:
+            pieces.append(" ".join(current))
+    return pieces
+
+
+def split_letter(letter_text: str, max_tokens=None, overlap=None) -> list:
+    """Фрагменты письма; короткое письмо — один фрагмент, сам текст."""
+    if not is_long(letter_text) and max_tokens is None:
+        return [letter_text]
+    max_tokens = max_tokens or CHUNK_TOKENS
+    overlap = CHUNK_OVERLAP if overlap is None else overlap
+
+    units = []      # (текст, токены, начинает новое сообщение)
+    for paragraph in re.split(r"\n\s*\n", letter_text):
+        if not paragraph.strip():
+            continue
+        for n, piece in enumerate(_pieces(paragraph.strip(), max_tokens)):
+            units.append((piece, count_tokens(piece), n == 0 and bool(THREAD_RE.match(paragraph))))
+
+    chunks, current, size = [], [], 0
+    for unit in units:
+        text, tokens, new_message = unit
+        if current and (size + tokens > max_tokens or new_message):
+            chunks.append(current)
+            # хвост предыдущего фрагмента повторяется в начале следующего (но не через границу сообщения)
+            carried, carried_size = [], 0
+            if not new_message:
+                for prev in reversed(current):
+                    if carried_size + prev[1] > overlap or carried_size + prev[1] + tokens > max_tokens:
+                        break
+                    carried.insert(0, prev)
+                    carried_size += prev[1]
+            current, size = carried, carried_size
+        current.append(unit)
+        size += tokens
+    if current:
+        chunks.append(current)
+    return ["\n\n".join(u[0] for u in chunk) for chunk in chunks]
+
+
+def condense(letter_text: str) -> str:
+    """Для этапов генерации ответа: длинное письмо — начало и конец с пометкой о пропуске."""
+    if not is_long(letter_text):
+        return letter_text
+    chunks = split_letter(letter_text, overlap=0)
+    if len(chunks) <= 2:
+        return letter_text
+    skipped = len(letter_text) - len(chunks[0]) - len(chunks[-1])
+    return (f"{chunks[0]}\n\n[… пропущено ~{skipped} символов из середины письма; "
+            f"требования всего письма — в результате LLM1 …]\n\n{chunks[-1]}")
+
+
+def section_title(part=None) -> str:
+    """Заголовок раздела с текстом в промпте: «ТЕКСТ ПИСЬМА» или «ФРАГМЕНТ ПИСЬМА i ИЗ n»."""
+    return "ТЕКСТ ПИСЬМА" if part is None else f"ФРАГМЕНТ ПИСЬМА {part[0]} ИЗ {part[1]}"
+
+
+def chunk_requests(build, chunks) -> list:
+    """build(text, part) для каждого фрагмента; единственный фрагмент — обычный запрос build(text)."""
+    if len(chunks) == 1:
+        return [build(chunks[0])]
+    return [build(chunk, (n, len(chunks))) for n, chunk in enumerate(chunks, 1)]
+
+
+def create_all(client, requests) -> list:
+    """Запросы фрагментов параллельно (как стили в llm2 / llm3); ответы — в порядке фрагментов."""
+    if len(requests) == 1:
+        return [cache.create(client, requests[0])]
+    metrics.note("chunks", len(requests))
+    with ThreadPoolExecutor(max_workers=len(requests)) as pool:
+        return list(pool.map(metrics.bind(lambda request: cache.create(client, request)), requests))
+
+
+async def acreate_all(call, requests) -> list:
+    """create_all для пакетного режима: call(request) — корутина этапа."""
+    if len(requests) > 1:
+        metrics.note("chunks", len(requests))
+    return list(await asyncio.gather(*[call(request) for request in requests]))
+
+
+# ------------------------
+# Сведение результатов
+# ------------------------
+_ITEM_SPLIT_RE = re.compile(r"\s*(?:\n+|;\s+)\s*")
+_BULLET_RE = re.compile(r"^(?:[-–•*]|\d+[.)])\s*")
+
+
+def _items(value) -> list:
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return [str(v).strip() for v in value if str(v).strip()]
+    parts = (_BULLET_RE.sub("", p).strip().rstrip(".") for p in _ITEM_SPLIT_RE.split(str(value)))
+    return [p for p in parts if p]
+
+
+def _words(text: str) -> set:
+    return set(re.findall(r"\w+", text.lower()))
+
+
+def dedupe_items(items, threshold=0.8) -> list:
+    """Убирает повторы, в т.ч. почти одинаковые формулировки из перекрывающихся фрагментов."""
+    kept = []
+    for item in items:
+        words = _words(item)
+        if not words:
+            continue
+        duplicate = False
+        for n, (other, other_words) in enumerate(kept):
+            overlap = len(words & other_words) / len(words | other_words)
+            if overlap >= threshold or words <= other_words or other_words <= words:
+                if len(words) > len(other_words):
+                    kept[n] = (item, words)     # оставляем более полную формулировку
+                duplicate = True
+                break
+        if not duplicate:
+            kept.append((item, words))
+    return [item for item, _ in kept]
+
+
+def merge_llm1(results: list) -> dict:
+    """Суть — из первого фрагмента, где она есть; требования и ожидания — все, без повторов."""
+    merged = {"core_request": None, "requirements": None, "expectations": None}
+    merged["core_request"] = next((r.get("core_request") for r in results if r.get("core_request")), None)
+    for field in ("requirements", "expectations"):
+        items = dedupe_items(item for r in results for item in _items(r.get(field)))
+        merged[field] = "; ".join(items) or None
+    return merged
+
+
+def merge_classification(results: list, default: dict) -> dict:
+    """Тип — по первому фрагменту; срочность — максимальная; риск — если есть хоть в одном; подразделения — все."""
+    if not results:
+        return dict(default)
+    merged = {**default, **results[0]}
+    urgencies = [r.get("urgency") for r in results if r.get("urgency") in URGENCY_ORDER]
+    if urgencies:
+        merged["urgency"] = max(urgencies, key=URGENCY_ORDER.index)
+    if any(str(r.get("legal_risk", "")).lower().startswith("есть") for r in results):
+        merged["legal_risk"] = "есть"
+    if any(r.get("formality") == "официальный" for r in results):
+        merged["formality"] = "официальный"
+    departments = [d for r in results for d in (r.get("departments") or []) if isinstance(d, str)]
+    merged["departments"] = list(dict.fromkeys(departments))
+    return merged
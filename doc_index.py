@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+# doc_index.py
+# Локальный лексический индекс документов (BM25) для RAG1.
+#
+# Корпус — папка с текстовыми файлами (*.txt, *.md). В начале файла может быть шапка:
+#
+#   code: POLICY_COMPLAINTS
+#   kind: policy
+#   name: Регламент рассмотрения обращений клиентов
+#   ---
+#   текст документа...
+#
+# Без шапки: code — имя файла, kind — по имени подпапки (laws/, policies/, templates/, cases/ ...),
+# name — первая строка текста.
+#
+# Индекс хранит для каждого термина массив документов и готовые веса BM25,
+# поэтому запрос — это несколько сложений NumPy-массивов, без обращения к LLM.
+import os
+import re
+import json
+import math
+import stat
+import time
+import hashlib
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+
+try:
+    import pymorphy3
+    _morph = pymorphy3.MorphAnalyzer()
+except ImportError:  # без pymorphy3 — упрощённый стемминг по окончаниям
+    _morph = None
+
+DOCS_DIR   = os.getenv("DOCS_DIR", "docs")
+INDEX_PATH = os.getenv("DOCS_INDEX_PATH", "docs_index.npz")
+DOCS_RESCAN = float(os.getenv("DOCS_RESCAN", 60))   # сек: не чаще обходить корпус, если mtime DOCS_DIR не менялся
+
+# Виды документов → раздел ответа RAG1
+VALID_KINDS       = {"law", "policy", "methodology", "standard", "guideline"}
+RECOMMENDED_KINDS = {"template", "case", "faq", "playbook", "example"}
+
+FOLDER_KINDS = {
+    "laws": "law", "npa": "law", "policies": "policy", "methodologies": "methodology",
+    "standards": "standard", "guidelines": "guideline", "templates": "template",
+    "cases": "case", "faq": "faq", "playbooks": "playbook", "examples": "example",
+}
+
+STOP_WORDS = set("""
+а без более бы был была были было быть в вам вас весь во вот все всего всех вы где да даже для до его
+ее её если есть еще ещё же за здесь и из или им их к как ко когда кто ли либо мы на над надо наш не него
+нее неё нет ни них но ну о об однако он она они оно от очень по под при с со так также такой там те тем
+то того тоже той только том ты у уже хотя чего чей чем что чтобы чье чья эта эти это я просим прошу
+""".split())
+
+TOKEN_RE = re.compile(r"[а-яёa-z0-9]+(?:[-/][а-яёa-z0-9]+)*")
+
+SUFFIXES = sorted("""
+иями ями ами ией ого его ому ему ыми ими ая яя ое ее ые ие ый ий ой ей ом ем ам ям ах ях ию ью ия ья
+ов ев ую юю ость ости остью а я о е ы и у ю ь
+""".split(), key=len, reverse=True)
+
+
+@lru_cache(maxsize=100000)
+def lemma(word: str) -> str:
+    if any(ch.isdigit() for ch in word):
+        return word  # номера актов и договоров (55-у, 115-фз) не трогаем
+    if _morph is not None:
+        return _morph.parse(word)[0].normal_form
+    for suffix in SUFFIXES:
+        if len(word) - len(suffix) >= 3 and word.endswith(suffix):
+            return word[:-len(suffix)]
+    return word
+
+
+def tokenize(text: str) -> list:
+    return [lemma(t) for t in TOKEN_RE.findall(text.lower().replace("ё", "е")) if t not in STOP_WORDS]
+
+
+def read_document(path: Path, root: Path) -> dict:
+    text = path.read_text(encoding="utf-8").strip()
+    meta = {}
+    head, sep, body = text.partition("\n---\n")
+    if sep and all(":" in line for line in head.splitlines() if line.strip()):
+        for line in head.splitlines():
+            if line.strip():
+                key, value = line.split(":", 1)
+                meta[key.strip().lower()] = value.strip()
+        text = body.strip()
+
+    folder = path.relative_to(root).parts[0] if len(path.relative_to(root).parts) > 1 else ""
+    first_line = text.splitlines()[0].strip() if text else path.stem
+    return {
+        "code": meta.get("code") or path.stem.upper(),
+        "kind": meta.get("kind") or FOLDER_KINDS.get(folder.lower(), "guideline"),
+        "name": meta.get("name") or first_line[:200],
+        "path": str(path.relative_to(root)),
+        "text": text,
+    }
+
+
+class DocIndex:
+    """BM25-индекс: postings[term] = (doc_ids, weights)."""
+
+    def __init__(self, docs, vocab, offsets, doc_ids, weights, signature=""):
+        self.docs = docs              # метаданные без текста
+        self.vocab = vocab            # термин → номер
+        self.offsets = offsets        # границы постингов термина в doc_ids / weights
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.signature = signature
+
+    # ------------------------
+    # Построение
+    # ------------------------
+    @classmethod
+    def build(cls, docs_dir=DOCS_DIR, k1=1.5, b=0.75):
+        root = Path(docs_dir)
+        paths = sorted(p for p in root.rglob("*") if p.suffix.lower() in (".txt", ".md") and p.is_file())
+        docs = [read_document(p, root) for p in paths]
+
+        postings = {}
+        lengths = np.zeros(len(docs), dtype=np.float32)
+        for n, doc in enumerate(docs):
+            # название весит больше текста
+            tokens = tokenize(doc["name"]) * 3 + tokenize(doc["code"].replace("_", " ")) + tokenize(doc["text"])
+            lengths[n] = len(tokens)
+            counts = {}
+            for t in tokens:
+                counts[t] = counts.get(t, 0) + 1
+            for t, tf in counts.items():
+                postings.setdefault(t, []).append((n, tf))
+
+        avgdl = float(lengths.mean()) if len(docs) else 1.0
+        vocab, offsets, all_ids, all_weights = {}, [0], [], []
+        for t, plist in postings.items():
+            ids = np.array([d for d, _ in plist], dtype=np.int32)
+            tf = np.array([f for _, f in plist], dtype=np.float32)
+            idf = math.log(1 + (len(docs) - len(plist) + 0.5) / (len(plist) + 0.5))
+            w = idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * lengths[ids] / avgdl))
+            vocab[t] = len(vocab)
+            all_ids.append(ids)
+            all_weights.append(w.astype(np.float32))
+            offsets.append(offsets[-1] + len(ids))
+
+        meta = [{k: v for k, v in doc.items() if k != "text"} for doc in docs]
+        return cls(
+            meta, vocab, np.array(offsets, dtype=np.int64),
+            np.concatenate(all_ids) if all_ids else np.zeros(0, dtype=np.int32),
+            np.concatenate(all_weights) if all_weights else np.zeros(0, dtype=np.float32),
+            corpus_signature(docs_dir),
+        )
+
+    # ------------------------
+    # Сохранение / загрузка
+    # ------------------------
+    def save(self, path=INDEX_PATH):
+        meta = json.dumps({"docs": self.docs, "vocab": self.vocab, "signature": self.signature}, ensure_ascii=False)
+        np.savez(path, offsets=self.offsets, doc_ids=self.doc_ids, weights=self.weights,
+                 meta=np.frombuffer(meta.encode("utf-8"), dtype=np.uint8))
+
+    @classmethod
+    def load(cls, path=INDEX_PATH):
+        data = np.load(path)
+        meta = json.loads(data["meta"].tobytes().decode("utf-8"))
+        return cls(meta["docs"], meta["vocab"], data["offsets"], data["doc_ids"], data["weights"], meta["signature"])
+
+    # ------------------------
+    # Поиск
+    # ------------------------
+    def search(self, weighted_queries, top_k=10):
+        """
+        weighted_queries — [(текст, вес), ...]. Возвращает [(номер документа, score, совпавшие термины)].
+        """
+        query = {}
+        for text, weight in weighted_queries:
+            for t in tokenize(text or ""):
+                query[t] = query.get(t, 0.0) + weight
+
+        scores = np.zeros(len(self.docs), dtype=np.float32)
+        contributions = []
+        for t, qw in query.items():
+            term_id = self.vocab.get(t)
+            if term_id is None:
+                continue
+            lo, hi = self.offsets[term_id], self.offsets[term_id + 1]
+            ids, w = self.doc_ids[lo:hi], self.weights[lo:hi] * qw
+            scores[ids] += w
+            contributions.append((t, ids, w))
+
+        if not len(scores) or scores.max() <= 0:
+            return []
+        top = np.argsort(-scores)[:top_k]
+        top = top[scores[top] > 0]
+
+        results = []
+        for n in top:
+            matched = sorted(((float(w[ids == n].sum()), t) for t, ids, w in contributions if (ids == n).any()),
+                             reverse=True)
+            results.append((int(n), float(scores[n]), [t for _, t in matched[:5]]))
+        return results
+
+
+_signatures = {}        # docs_dir → (mtime каталога, время обхода, подпись)
+
+
+def _scan_signature(docs_dir) -> str:
+    root = Path(docs_dir)
+    if not root.is_dir():
+        return ""
+    stats = []
+    for p in root.rglob("*"):
+        st = p.stat()                       # один stat на файл
+        if stat.S_ISREG(st.st_mode):
+            stats.append((str(p), st.st_mtime_ns, st.st_size))
+    return hashlib.sha1(json.dumps(sorted(stats)).encode("utf-8")).hexdigest()[:16]
+
+
+def corpus_signature(docs_dir=DOCS_DIR, refresh=False) -> str:
+    """
+    Меняется при добавлении, удалении или правке файлов корпуса.
+    Корпус обходится заново, только если изменился mtime каталога (файл добавлен, удалён, переименован)
+    или прошло DOCS_RESCAN секунд с прошлого обхода (правка файла на месте, файлы в подпапках).
+    """
+    try:
+        mtime = os.stat(docs_dir).st_mtime_ns
+    except OSError:
+        mtime = None
+    now = time.monotonic()
+    cached = _signatures.get(str(docs_dir))
+    if not refresh and cached is not None and cached[0] == mtime and now - cached[1] < DOCS_RESCAN:
+        return cached[2]
+    signature = _scan_signature(docs_dir)
+    _signatures[str(docs_dir)] = (mtime, now, signature)
+    return signature
+
+
+_index = None
+
+
+def get_index(docs_dir=DOCS_DIR, index_path=INDEX_PATH):
+    """Индекс из кэша на диске; перестраивается, если корпус изменился."""
+    global _index
+    signature = corpus_signature(docs_dir)
+    if _index is not None and _index.signature == signature:
+        return _index
+    if os.path.exists(index_path):
+        loaded = DocIndex.load(index_path)
+        if loaded.signature == signature:
+            _index = loaded
+            return _index
+    _index = DocIndex.build(docs_dir)
+    _index.save(index_path)
+    return _index
+
+
+@lru_cache(maxsize=None)
+def corpus_available(docs_dir=DOCS_DIR) -> bool:
+    """Есть ли корпус документов; проверяется один раз за процесс."""
+    root = Path(docs_dir)
+    return root.is_dir() and any(p.suffix.lower() in (".txt", ".md") for p in root.rglob("*"))
+
+
+def build_queries(letter_text, ner_result, llm1_result) -> list:
+    """Запрос к индексу: письмо + NER.law_refs + LLM1.core_request / requirements, с весами."""
+    ner_result = ner_result or {}
+    llm1_result = llm1_result or {}
+    return [
+        (letter_text, 1.0),
+        (" ".join(ner_result.get("law_refs") or []), 3.0),
+        (llm1_result.get("core_request") or "", 2.0),
+        (str(llm1_result.get("requirements") or ""), 1.0),
+    ]
+
+
+def format_hits(hits, top_k=5) -> dict:
+    """
+    hits — [(метаданные документа, score, reason)] по убыванию score →
+    ответ в схеме rag_docs_output.json (valid_docs / recommended_docs).
+    """
+    result = {"valid_docs": [], "recommended_docs": []}
+    best = hits[0][1] if hits else 1.0
+    for doc, score, reason in hits:
+        section = "recommended_docs" if doc["kind"] in RECOMMENDED_KINDS else "valid_docs"
+        if len(result[section]) >= top_k:
+            continue
+        relative = score / best
+        result[section].append({
+            "code": doc["code"],
+            "kind": doc["kind"],
+            "name": doc["name"],
+            "reason": reason,
+            "priority": "high" if relative >= 0.66 else "medium" if relative >= 0.33 else "low",
+            "score": round(score, 3),
+        })
+    return result
+
+
+def search_docs(letter_text, ner_result, llm1_result, top_k=5, index=None) -> dict:
+    """Документы для RAG1 с реальными кодами и score."""
+    index = index or get_index()
+    hits = index.search(build_queries(letter_text, ner_result, llm1_result), top_k=top_k * 4)
+    return format_hits([(index.docs[n], score, "совпадение по: " + ", ".join(matched))
+                        for n, score, matched in hits], top_k)
+
+
+if __name__ == "__main__":
+    import sys
+
+    index = DocIndex.build(DOCS_DIR)
+    index.save(INDEX_PATH)
+    print(f"Индекс построен: {len(index.docs)} документов, {len(index.vocab)} терминов → {INDEX_PATH}")
+
+    if len(sys.argv) > 1:
+        for n, score, matched in index.search([(" ".join(sys.argv[1:]), 1.0)]):
+            print(f"{score:7.3f}  {index.docs[n]['code']:<30} {index.docs[n]['name']}  ({', '.join(matched)})")
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+# json_extract.py
+# Общий разбор JSON из ответов LLM.
+#
+# Ответ модели просматривается один раз: каждый объект верхнего уровня разбирается
+# JSONDecoder.raw_decode с его «{» (скобки и кавычки внутри строк, вложенность и экранирование
+# учитываются), подходящий объект возвращается, чужой пропускается целиком.
+# С первого битого объекта остаток ответа проходит посимвольный разбор (_scan) с починкой,
+# каждый участок — один раз, так что время линейно и для большого битого ответа.
+# Возвращается первый объект с ожидаемыми ключами. Частые поломки чинятся:
+#   - висячие запятые перед } / ];
+#   - обрыв по max_output_tokens — незакрытая строка закрывается, незакрытые скобки
+#     дописываются; если так не разбирается — ответ обрезается до последнего целого значения.
+import json
+import re
+
+import metrics
+
+STRING_OR_COMMA_RE = re.compile(r'"(?:[^"\\]|\\.)*"|,(\s*[}\]])', re.DOTALL)
+_decoder = json.JSONDecoder()
+# Символы, меняющие состояние разбора; остальные пропускаются без цикла Python
+SPECIAL_RE = re.compile(r'[{}\[\]",:\\]')
+# Начало объекта: после «{» — ключ или «}»; иначе это «{» в обычном тексте
+OBJECT_START_RE = re.compile(r'\{[ \t\n\r]*["}]')
+
+
+def _loads(text: str):
+    try:
+        return json.loads(text), "ok"
+    except (ValueError, RecursionError):
+        pass
+    fixed = _strip_trailing_commas(text)
+    if fixed != text:
+        try:
+            return json.loads(fixed), "repaired"
+        except (ValueError, RecursionError):
+            pass
+    return None, None
+
+
+def _strip_trailing_commas(text: str) -> str:
+    """Убирает «,» перед } / ] вне строк."""
+    return STRING_OR_COMMA_RE.sub(lambda m: m.group(0) if m.group(1) is None else m.group(1), text)
+
+
+def _matches(obj, keys) -> bool:
+    return isinstance(obj, dict) and (not keys or any(k in obj for k in keys))
+
+
+def find_json(text: str, keys=None, repair=True):
+    """
+    Возвращает (объект, статус): статус "ok" — объект разобран как есть,
+    "repaired" — после починки, None — подходящего объекта нет (объект тоже None).
+    keys — ожидаемые ключи: подходит первый объект, где есть хотя бы один из них.
+    Починка и неудачный разбор учитываются в метриках текущего этапа.
+    """
+    obj, status = _find_json(text, keys, repair)
+    if status != "ok":
+        metrics.note("parse_repaired" if status == "repaired" else "parse_failures")
+    return obj, status
+
+
+def _find_json(text: str, keys, repair):
+    pos = 0
+    fast = True               # после первого битого объекта — только посимвольный разбор
+    while text:
+        start = text.find("{", pos)
+        if start == -1:
+            return None, None
+        if not OBJECT_START_RE.match(text, start):
+            pos = start + 1           # «{» в обычном тексте — ищем дальше
+            continue
+        if fast:
+            try:
+                # быстрый путь: целый объект разбирается на C-скорости, end — его конец
+                obj, end = _decoder.raw_decode(text, start)
+            except (ValueError, RecursionError):
+                # ошибка raw_decode стоит O(позиции) (номер строки для сообщения), поэтому дальше
+                # текст проходит только _scan — каждый участок один раз
+                fast = False
+            else:
+                if _matches(obj, keys):
+                    return obj, "ok"
+                pos = end             # внутрь чужого объекта не заходим
+                continue
+        obj, status, scanned, children = _scan(text, start, keys, repair)
+        if obj is not None:
+            return obj, status
+        if scanned is None:
+            return None, None
+        # внутри битого объекта — целые вложенные объекты первого уровня и оборванный последний
+        for child, end in children:
+            if end is None:
+                obj, status = _scan(text, child, keys, repair)[:2]
+            else:
+                obj, status = _loads(text[child:end])
+            if _matches(obj, keys) and (repair or status == "ok"):
+                return obj, status
+        pos = scanned
+    return None, None
+
+
+def _scan(text: str, pos: int, keys, repair):
+    """
+    Один проход с позиции pos. Возвращает (объект, статус, None, ()) или, если объект с «{»
+    битый или это не начало JSON (например, «{» в тексте до него), (None, None, позиция, вложенные):
+    позиция — докуда дошёл разбор, вложенные — [(начало, конец)] объектов первого уровня
+    внутри битого (конец None — объект оборван вместе с ним).
+    """
+    depth = 0
+    start = -1
+    stack = []              # "}" / "]" — чем закрывать открытые скобки
+    expect_key = []         # для объектов: ждём ключ (True) или значение (False)
+    in_string = False
+    string_is_key = False
+    safe_end = -1           # конец последнего целого значения внутри объекта
+    safe_depth = 0          # глубина в этой точке: stack[:safe_depth] с тех пор не менялся
+    children = []
+
+    skip_until = -1         # позиция после экранированного символа
+
+    for m in SPECIAL_RE.finditer(text, pos):
+        i = m.start()
+        if i < skip_until:
+            continue
+        c = text[i]
+        if in_string:
+            if c == "\\":
+                skip_until = i + 2
+            elif c == '"':
+                in_string = False
+                if not string_is_key:
+                    safe_end, safe_depth = i + 1, len(stack)
+            continue
+
+        if depth == 0:
+            if c == "{":
+                depth, start, stack, expect_key = 1, i, ["}"], [True]
+                safe_end, safe_depth, children = -1, 0, []
+            continue
+
+        if c == '"':
+            in_string = True
+            string_is_key = stack[-1] == "}" and expect_key[-1]
+        elif c in "{[":
+            if c == "{" and depth == 1:
+                children.append((i, None))
+            depth += 1
+            stack.append("}" if c == "{" else "]")
+            expect_key.append(c == "{")
+        elif c in "}]":
+            depth -= 1
+            stack.pop()
+            expect_key.pop()
+            if depth == 0:
+                obj, status = _loads(text[start:i + 1])
+                if obj is None:
+                    return None, None, i + 1, children
+                if _matches(obj, keys) and (repair or status == "ok"):
+                    return obj, status, None, ()
+            else:
+                if depth == 1 and children and children[-1][1] is None:
+                    children[-1] = (children[-1][0], i + 1)
+                safe_end, safe_depth = i + 1, len(stack)
+        elif c == ":":
+            expect_key[-1] = False
+        elif c == ",":
+            if stack[-1] == "}":
+                expect_key[-1] = True
+            safe_end, safe_depth = i, len(stack)
+
+    if depth == 0:
+        return None, None, None, ()
+    if not repair:
+        return None, None, len(text), children
+
+    # -----------------------------
+    # Обрыв: дописываем закрывающие скобки
+    # -----------------------------
+    tail = text[start:]
+    attempts = []
+    if in_string and not string_is_key:
+        body = tail[:-1] if skip_until > len(text) else tail
+        attempts.append(body + '"' + "".join(reversed(stack)))
+    elif not in_string:
+        attempts.append(tail.rstrip().rstrip(",") + "".join(reversed(stack)))
+    if safe_end > start:
+        attempts.append(text[start:safe_end].rstrip().rstrip(",") + "".join(reversed(stack[:safe_depth])))
+
+    for candidate in attempts:
+        obj, _ = _loads(candidate)
+        if obj is not None and _matches(obj, keys):
+            return obj, "repaired", None, ()
+    return None, None, len(text), children
+
+
+def extract_json(text: str, keys=None, repair=True):
+    """Первый JSON-объект с ключами keys из ответа модели или None."""
+    return find_json(text, keys, repair)[0]
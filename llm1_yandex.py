@@ -1,24 +1,11 @@
-import os
 import json
-import re
-from dotenv import load_dotenv
-from openai import OpenAI
+from llm_client import MODEL, get_client
+from json_extract import extract_json
+from prompt_builder import Prompt
+from chunking import split_letter, section_title, chunk_requests, create_all, acreate_all, merge_llm1
+import metrics
 
-# ------------------------
-# Загружаем API ключи
-# ------------------------
-load_dotenv()
-
-folder_id = os.getenv("folder_id")
-api_key   = os.getenv("api_key")
-
-MODEL = f"gpt://{folder_id}/qwen3-235b-a22b-fp8/latest"
-
-client = OpenAI(
-    base_url="https://rest-assistant.api.cloud.yandex.net/v1",
-    api_key=api_key,
-    project=folder_id
-)
+client = get_client("llm1")
 
 # ------------------------
 # Входной текст
@@ -26,13 +13,10 @@ client = OpenAI(
 # letter_text = """
 # Настоящим уведомляем о грубом нарушении условий договора №БС-1456 от 15.03.2023: средства с нашего счёта были списаны без предварительного уведомления. Требуем немедленного разъяснения и возврата средств в течение 3 рабочих дней.
 # """
-# Загрузка текста письма
-with open("letter.txt", "r", encoding="utf-8") as f:
-    letter_text = f.read().strip()
 # ------------------------
 # PROMPT
 # ------------------------
-prompt = f"""
+LLM1_PROMPT = Prompt("""
 Ты — эксперт по анализу официальной деловой переписки.
 
 Тебе даётся текст одного письма/запроса на русском языке.
@@ -50,82 +34,69 @@ prompt = f"""
 
 Формат ответа:
 
-{{
+{
   "core_request": "краткое описание сути запроса",
   "requirements": "список или сжатое описание конкретных требований",
   "expectations": "чего отправитель ожидает по результату"
-}}
+}
+""")
 
-ТЕКСТ ПИСЬМА:
----
-{letter_text}
----
-""".strip()
 
-# ------------------------
-# Вызов Яндекс LLM
-# ------------------------
-response = client.responses.create(
-    model=MODEL,
-    input=prompt,
-    max_output_tokens=300,
-    temperature=0.0
-)
+def build_request(letter_text: str, part=None) -> dict:
+    """Параметры вызова LLM1 для текста письма (или его фрагмента part=(i, n))."""
+    return {
+        "model": MODEL,
+        **LLM1_PROMPT.render((section_title(part), letter_text)),
+        "max_output_tokens": 300,
+        "temperature": 0.0,
+    }
 
-raw = response.output_text.strip()
 
-# ------------------------
-# Чистим ````json обёртки
-# ------------------------
-text = raw
-
-if text.startswith("```"):
-    parts = text.split("```")
-    if len(parts) >= 2:
-        text = parts[1].strip()
-        first_newline = text.find("\n")
-        if first_newline != -1 and not text.lstrip().startswith("{"):
-            maybe_lang = text[:first_newline].lower()
-            if "json" in maybe_lang:
-                text = text[first_newline + 1:].strip()
+def parse_output(raw: str) -> dict:
+    """Ищет в ответе JSON с core_request / requirements / expectations."""
+    best_obj = extract_json(raw, keys={"core_request", "requirements", "expectations"})
 
-# ------------------------
-# Ищем JSON-объекты
-# ------------------------
-candidates = re.findall(r"\{.*?\}", text, flags=re.DOTALL)
-target_keys = {"core_request", "requirements", "expectations"}
-
-valid_objects = []
-for js in candidates:
-    try:
-        obj = json.loads(js)
-        valid_objects.append(obj)
-    except:
-        continue
-
-best_obj = None
-if valid_objects:
-    for obj in valid_objects:
-        if any(k in obj for k in target_keys):
-            best_obj = obj
-            break
+    # ------------------------
+    # Если JSON не найден
+    # ------------------------
     if best_obj is None:
-        best_obj = valid_objects[0]
+        metrics.note("fallbacks")
+        best_obj = {
+            "core_request": None,
+            "requirements": None,
+            "expectations": None
+        }
+
+    return best_obj
+
+
+def merge_chunks(raws: list) -> dict:
+    results = [parse_output(raw) for raw in raws]
+    return results[0] if len(results) == 1 else merge_llm1(results)
+
+
+def run_llm1(letter_text: str) -> dict:
+    """Выделяет суть запроса, требования и ожидания отправителя (длинное письмо — по фрагментам)."""
+    return merge_chunks(create_all(client, chunk_requests(build_request, split_letter(letter_text))))
+
+
+async def arun(call, letter_text: str) -> dict:
+    """run_llm1 для пакетного режима."""
+    return merge_chunks(await acreate_all(call, chunk_requests(build_request, split_letter(letter_text))))
 
-# ------------------------
-# Если JSON не найден
-# ------------------------
-if best_obj is None:
-    best_obj = {
-        "core_request": None,
-        "requirements": None,
-        "expectations": None
-    }
 
 # ------------------------
-# Сохраняем в JSON файл
+# Запуск как скрипта
 # ------------------------
-with open("llm1_output.json", "w", encoding="utf-8") as f:
-    json.dump(best_obj, f, ensure_ascii=False, indent=2)
+if __name__ == "__main__":
+    # Загрузка текста письма
+    with open("letter.txt", "r", encoding="utf-8") as f:
+        letter_text = f.read().strip()
+
+    best_obj = run_llm1(letter_text)
+
+    # Сохраняем в JSON файл
+    with open("llm1_output.json", "w", encoding="utf-8") as f:
+        json.dump(best_obj, f, ensure_ascii=False, indent=2)
 
-print("Файл сохранён → llm1_output.json")
\ No newline at end of file
+    print("Файл сохранён → llm1_output.json")
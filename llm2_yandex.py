@@ -2,194 +2,307 @@
 import os
 import json
 import re
-from dotenv import load_dotenv
-from openai import OpenAI
-
-# -----------------------------------------
-# Загружаем ключи из .env
-# -----------------------------------------
-load_dotenv()
-
-folder_id = os.getenv("folder_id")
-api_key   = os.getenv("api_key")
-
-MODEL = f"gpt://{folder_id}/qwen3-235b-a22b-fp8/latest"
-
-client = OpenAI(
-    base_url="https://rest-assistant.api.cloud.yandex.net/v1",
-    api_key=api_key,
-    project=folder_id
-)
-
-# -----------------------------------------
-# ТВОИ ВХОДНЫЕ ДАННЫЕ (подставляешь реальные)
-# -----------------------------------------
-# Пример: ты загружаешь эти три файла после их работы
-# Текст письма
-with open("letter.txt", "r", encoding="utf-8") as f:
-    letter_text = f.read().strip()
-
-# JSON NER
-with open("ner_output.json", "r", encoding="utf-8") as f:
-    ner_result = json.load(f)
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from llm_cache import cache
+from llm_client import MODEL, get_client
+from json_extract import extract_json
+import metrics
+from streaming import stream_fields
+from prompt_builder import Prompt
+from chunking import condense
+import answer_templates
+
+client = get_client("llm2")
+
+# Режим генерации:
+#   single    — один запрос на все 4 стиля (max_output_tokens=1500 на всё);
+#   per_style — 4 параллельных запроса, у каждого стиля свой бюджет токенов
+#               и ответ простым текстом (обрезка не ломает JSON).
+ANSWERS_MODE = os.getenv("ANSWERS_MODE", "single")
+
+STYLES = ["official", "business", "client_friendly", "simple"]
+
+STYLE_DESCRIPTIONS = {
+    "official":        "строгий официальный ответ от лица Банка",
+    "business":        "деловой ответ, немного менее сухой, чем официальный, но по сути тот же",
+    "client_friendly": "более тёплый, клиентоориентированный ответ без фамильярности",
+    "simple":          "упрощённый, максимально понятный ответ простым языком",
+}
 
-# JSON классификатора
-with open("classification_output.json", "r", encoding="utf-8") as f:
-    classifier_result = json.load(f)
+STYLE_MAX_OUTPUT_TOKENS = {
+    "official":        1000,
+    "business":        1000,
+    "client_friendly": 1000,
+    "simple":          700,
+}
 
-# JSON LLM1
-with open("llm1_output.json", "r", encoding="utf-8") as f:
-    llm1_result = json.load(f)
+# Адаптация одобренного шаблона (answer_templates.py): модель возвращает только замены
+ADAPT_MAX_OUTPUT_TOKENS = int(os.getenv("ADAPT_MAX_OUTPUT_TOKENS", 300))
 
 # -----------------------------------------
-# PROMPT TEMPLATE (как ты дал)
+# PROMPT: роль и правила — общие для обоих режимов
 # -----------------------------------------
-PROMPT_TEMPLATE = """Ты — интеллектуальный помощник по подготовке деловой переписки от лица крупного банка.
+RULES = """Ты — интеллектуальный помощник по подготовке деловой переписки от лица крупного банка.
 
 ТВОЯ РОЛЬ И ПРАВИЛА:
 - Ты готовишь ответы на входящие письма клиентов, партнёров и регуляторов.
 - Ты пишешь на русском языке, в корректном деловом стиле.
 - Ты обязан соблюдать юридическую осторожность.
-- У тебя НЕТ доступа к внутренним системам и дополнительным данным, кроме того, что передано ниже.
+- У тебя НЕТ доступа к внутренним системам и дополнительным данным, кроме тех, что переданы после инструкций:
+  текст письма, NER (номера договоров, сроки, ссылки на НПА, контакты, организации),
+  классификация (type, urgency, formality, departments, legal_risk) и LLM1 (core_request, requirements, expectations).
 
 СТРОГИЕ ЗАПРЕТЫ:
 - НЕЛЬЗЯ придумывать суммы, даты, реквизиты договоров, имена, названия подразделений, которых нет во входных данных.
 - НЕЛЬЗЯ обещать действия, которые не следуют из данных (например, «мы точно вернём деньги»). Можно только:
   «Банк рассмотрит возможность…», «Банк проведёт проверку…», «Решение будет принято в соответствии с условиями договора и действующим законодательством…».
 - НЕЛЬЗЯ добавлять в ответ технические комментарии вроде «как модель ИИ…».
+"""
 
-ФОРМАТ ВЫВОДА:
-Верни ОДИН валидный JSON следующего вида:
-
-{{
-  "answers": {{
-    "official": "строгий официальный ответ от лица Банка",
-    "business": "деловой ответ, немного менее сухой, чем official, но по сути тот же",
-    "client_friendly": "более тёплый, клиентоориентированный ответ без фамильярности",
-    "simple": "упрощённый, максимально понятный ответ простым языком"
-  }}
-}}
-
---------------------------------
-ВХОДНЫЕ ДАННЫЕ
---------------------------------
-
-=== ТЕКСТ ПИСЬМА ===
-{letter_text}
-
-=== РЕЗУЛЬТАТ NER (JSON) ===
-{ner_json}
-
-Пример структуры NER:
-{{
-  "contract_numbers": [...],
-  "deadlines": [
-    {{ "text": "...", "date": "...", "type": "relative|absolute" }}
-  ],
-  "law_refs": [...],
-  "contacts": {{
-    "emails": [...],
-    "phones": [...],
-    "persons": [...]
-  }},
-  "organizations": [...]
-}}
-
-=== РЕЗУЛЬТАТ КЛАССИФИКАТОРА (JSON) ===
-{classifier_json}
-
-Пример структуры классификатора:
-{{
-  "type": "...",
-  "urgency": "...",
-  "formality": "...",
-  "departments": ["...", "..."],
-  "legal_risk": "..."
-}}
-
-=== РЕЗУЛЬТАТ LLM1 (JSON) ===
-{llm1_json}
-
-Пример структуры LLM1:
-{{
-  "core_request": "...",
-  "requirements": "...",
-  "expectations": "..."
-}}
-
---------------------------------
-ТВОЯ ЗАДАЧА
---------------------------------
-
+LLM2_PROMPT = Prompt(RULES + """
+ТВОЯ ЗАДАЧА:
 1. Проанализируй текст письма с учётом всех входных данных.
-2. Подготовь четыре варианта ответа: official, business, client_friendly, simple.
+2. Подготовь четыре варианта ответа:
+   - official — строгий официальный ответ от лица Банка;
+   - business — деловой ответ, немного менее сухой, чем official, но по сути тот же;
+   - client_friendly — более тёплый, клиентоориентированный ответ без фамильярности;
+   - simple — упрощённый, максимально понятный ответ простым языком.
 3. Учитывай тип письма и наличие legal_risk.
-4. ВЕРНИ СТРОГО JSON такого вида:
-
-{{
-  "answers": {{
-    "official": "...",
-    "business": "...",
-    "client_friendly": "...",
-    "simple": "..."
-  }}
-}}
-"""
 
-# -----------------------------------------
-# Подставляем данные в PROMPT
-# -----------------------------------------
-prompt = PROMPT_TEMPLATE.format(
-    letter_text=letter_text,
-    ner_json=json.dumps(ner_result, ensure_ascii=False),
-    classifier_json=json.dumps(classifier_result, ensure_ascii=False),
-    llm1_json=json.dumps(llm1_result, ensure_ascii=False),
-)
+ФОРМАТ ВЫВОДА — ОДИН валидный JSON:
+{"answers": {"official": "...", "business": "...", "client_friendly": "...", "simple": "..."}}
+""")
+
 
 # -----------------------------------------
-# Вызов Yandex Cloud LLM
+# PROMPT для одного стиля (режим per_style): стиль — последней строкой данных,
+# поэтому 4 запроса письма совпадают до самого конца
 # -----------------------------------------
-response = client.responses.create(
-    model=MODEL,
-    input=prompt,
-    max_output_tokens=1500,
-    temperature=0.1
-)
+STYLE_PROMPT = Prompt(RULES + """
+ТВОЯ ЗАДАЧА:
+Подготовь ОДИН вариант ответа — в стиле из раздела «СТИЛЬ ОТВЕТА» в конце входных данных.
+Учитывай тип письма и наличие legal_risk. Ответ — развёрнутое письмо из нескольких абзацев.
+Верни ТОЛЬКО текст письма, без JSON, Markdown и пояснений.
+""")
 
-raw = response.output_text.strip()
 
 # -----------------------------------------
-# Вырезаем JSON
+# PROMPT адаптации: одобренные ответы на похожее письмо → замены под текущее письмо
 # -----------------------------------------
-if raw.startswith("```"):
-    raw = raw.strip("`")
-    if raw.startswith("json"):
-        raw = raw[4:].strip()
-
-start = raw.find("{")
-end   = raw.rfind("}")
-
-if start != -1 and end != -1:
-    json_str = raw[start:end+1]
-else:
-    json_str = raw
-
-try:
-    result = json.loads(json_str)
-except:
-    result = {
-        "answers": {
-            "official": "",
-            "business": "",
-            "client_friendly": "",
-            "simple": ""
+ADAPT_PROMPT = Prompt(RULES + """
+ТВОЯ ЗАДАЧА:
+В разделе «ОДОБРЕННЫЙ ОТВЕТ» — четыре варианта ответа на похожее письмо того же типа, уже прошедшие
+комплаенс-проверку. Приспособь их к текущему письму, меняя как можно меньше:
+- замени имена, номера договоров, даты, суммы, сроки и другие детали прошлого письма на данные текущего;
+- формулировки одобренного ответа не переписывай и не улучшай;
+- если текущее письмо содержит требование, на которое одобренный ответ не отвечает, или ответ ему
+  противоречит, — шаблон не подходит: верни "fits": false.
+
+ФОРМАТ ВЫВОДА — ОДИН валидный JSON:
+{"fits": true, "replacements": [{"find": "точный фрагмент одобренного ответа", "replace": "новый текст"}]}
+Замены применяются ко всем четырём вариантам.
+""")
+
+
+def letter_sections(letter_text: str, ner_result: dict, classifier_result: dict, llm1_result: dict) -> list:
+    return [
+        ("ТЕКСТ ПИСЬМА", condense(letter_text)),
+        ("NER", ner_result),
+        ("КЛАССИФИКАТОР", classifier_result),
+        ("LLM1", llm1_result),
+    ]
+
+
+def build_request(letter_text: str, ner_result: dict, classifier_result: dict, llm1_result: dict) -> dict:
+    """Инструкции LLM2, затем письмо и результаты прошлых этапов; параметры вызова."""
+    return {
+        "model": MODEL,
+        **LLM2_PROMPT.render(*letter_sections(letter_text, ner_result, classifier_result, llm1_result)),
+        "max_output_tokens": 1500,
+        "temperature": 0.1,
+    }
+
+
+def parse_output(raw: str) -> dict:
+    """Вырезает JSON с answers; при ошибке разбора — пустые ответы."""
+    # Оборванный по max_output_tokens ответ чинится: уже написанные стили сохраняются
+    result = extract_json(raw, keys={"answers"})
+    if result is None:
+        metrics.note("fallbacks")
+        result = {
+            "answers": {
+                "official": "",
+                "business": "",
+                "client_friendly": "",
+                "simple": ""
+            }
         }
+
+    return result
+
+
+def build_style_request(style: str, letter_text: str, ner_result: dict, classifier_result: dict, llm1_result: dict) -> dict:
+    """Запрос на один стиль ответа со своим бюджетом токенов."""
+    sections = letter_sections(letter_text, ner_result, classifier_result, llm1_result)
+    return {
+        "model": MODEL,
+        **STYLE_PROMPT.render(*sections, ("СТИЛЬ ОТВЕТА", STYLE_DESCRIPTIONS[style])),
+        "max_output_tokens": STYLE_MAX_OUTPUT_TOKENS[style],
+        "temperature": 0.1,
+    }
+
+
+def build_adapt_request(template: dict, letter_text: str, ner_result: dict, classifier_result: dict,
+                        llm1_result: dict) -> dict:
+    """Запрос на адаптацию одобренного шаблона: данные письма, затем ответы шаблона."""
+    sections = letter_sections(letter_text, ner_result, classifier_result, llm1_result)
+    return {
+        "model": MODEL,
+        **ADAPT_PROMPT.render(*sections, ("ОДОБРЕННЫЙ ОТВЕТ", {"answers": template["answers"]})),
+        "max_output_tokens": ADAPT_MAX_OUTPUT_TOKENS,
+        "temperature": 0.0,
     }
 
+
+def parse_adapt_output(raw: str, template: dict, letter_text: str = ""):
+    """
+    Ответы шаблона с заменами или None — шаблон не подошёл, ответ не разобран
+    или в ответах остались сущности письма-источника (имена, номера, даты, которых нет в этом письме).
+    """
+    result = extract_json(raw, keys={"fits", "replacements"})
+    if result is None or result.get("fits") is False:
+        return None
+    answers = dict(template["answers"])
+    for item in result.get("replacements") or []:
+        if not isinstance(item, dict):
+            continue
+        find, replace = item.get("find"), item.get("replace")
+        if isinstance(find, str) and find and isinstance(replace, str):
+            answers = {style: text.replace(find, replace) for style, text in answers.items()}
+    if answer_templates.leftovers(template, letter_text, answers):
+        metrics.note("template_leaks")
+        return None
+    metrics.note("template_hits")
+    return {"answers": {style: answers.get(style, "") for style in STYLES}}
+
+
+def parse_style_output(raw: str) -> str:
+    """Текст одного ответа: снимаем ```-обёртку и кавычки, если модель их добавила."""
+    text = raw.strip()
+    if text.startswith("```"):
+        text = text.strip("`").strip()
+        if text.lower().startswith(("text", "json")):
+            text = text[4:].strip()
+    if text.startswith("{") and text.endswith("}"):
+        obj = extract_json(text, keys={"answer"}, repair=False)
+        if obj is not None and isinstance(obj.get("answer"), str):
+            text = obj["answer"]
+    text = text.strip()
+    if len(text) > 1 and text[0] == text[-1] == '"':
+        text = text[1:-1].strip()
+    return text
+
+
+def run_llm2_per_style(letter_text: str, ner_result: dict, classifier_result: dict, llm1_result: dict, on_partial=None) -> dict:
+    """4 стиля параллельно; время генерации — как у самого длинного стиля."""
+    answers = {}
+    with ThreadPoolExecutor(max_workers=len(STYLES)) as pool:
+        futures = {
+            pool.submit(metrics.bind(cache.create), client,
+                        build_style_request(style, letter_text, ner_result, classifier_result, llm1_result)): style
+            for style in STYLES
+        }
+        for future in as_completed(futures):
+            style = futures[future]
+            answers[style] = parse_style_output(future.result())
+            if on_partial is not None:
+                on_partial("answers", style, answers[style])
+
+    return {"answers": {style: answers[style] for style in STYLES}}
+
+
+def memo_inputs(letter_text: str, ner_result: dict, classifier_result: dict, llm1_result: dict, *args, **kwargs):
+    """Скрытый вход этапа для stage_memo: шаблон из кэша одобренных ответов (id и версия) или None."""
+    template = answer_templates.find(classifier_result, llm1_result, count=False)
+    if template is None:
+        return None
+    return [template["letter_id"], template["ts"], template["policy"]]
+
+
+def run_llm2(letter_text: str, ner_result: dict, classifier_result: dict, llm1_result: dict, on_partial=None, mode=None) -> dict:
+    """
+    Генерирует 4 варианта ответа: official, business, client_friendly, simple.
+
+    on_partial(section, style, value) — потоковый режим: вызывается, как только
+    очередной ответ (section="answers") полностью сгенерирован.
+    mode — "single" или "per_style" (по умолчанию ANSWERS_MODE).
+
+    Если в кэше одобренных ответов есть шаблон для такого письма, он только адаптируется.
+    """
+    template = answer_templates.find(classifier_result, llm1_result)
+    if template is not None:
+        request = build_adapt_request(template, letter_text, ner_result, classifier_result, llm1_result)
+        adapted = parse_adapt_output(cache.create(client, request), template, letter_text)
+        if adapted is not None:
+            if on_partial is not None:
+                for style in STYLES:
+                    on_partial("answers", style, adapted["answers"][style])
+            return adapted
+
+    if (mode or ANSWERS_MODE) == "per_style":
+        return run_llm2_per_style(letter_text, ner_result, classifier_result, llm1_result, on_partial)
+
+    request = build_request(letter_text, ner_result, classifier_result, llm1_result)
+    if on_partial is None:
+        return parse_output(cache.create(client, request))
+    raw = stream_fields(client, request, lambda path, value: on_partial(path[0], path[1], value))
+    return parse_output(raw)
+
+
+async def arun(call, letter_text: str, ner_result: dict, classifier_result: dict, llm1_result: dict, mode=None) -> dict:
+    """run_llm2 для пакетного режима; в режиме per_style стили запрашиваются параллельно."""
+    template = answer_templates.find(classifier_result, llm1_result)
+    if template is not None:
+        request = build_adapt_request(template, letter_text, ner_result, classifier_result, llm1_result)
+        adapted = parse_adapt_output(await call(request), template, letter_text)
+        if adapted is not None:
+            return adapted
+
+    if (mode or ANSWERS_MODE) == "per_style":
+        raws = await asyncio.gather(*[
+            call(build_style_request(style, letter_text, ner_result, classifier_result, llm1_result))
+            for style in STYLES
+        ])
+        return {"answers": {style: parse_style_output(raw) for style, raw in zip(STYLES, raws)}}
+
+    return parse_output(await call(build_request(letter_text, ner_result, classifier_result, llm1_result)))
+
+
 # -----------------------------------------
-# Сохраняем в JSON файл
+# Запуск как скрипта
 # -----------------------------------------
-with open("llm2_output.json", "w", encoding="utf-8") as f:
-    json.dump(result, f, ensure_ascii=False, indent=2)
+if __name__ == "__main__":
+    # Текст письма
+    with open("letter.txt", "r", encoding="utf-8") as f:
+        letter_text = f.read().strip()
+
+    # JSON NER
+    with open("ner_output.json", "r", encoding="utf-8") as f:
+        ner_result = json.load(f)
+
+    # JSON классификатора
+    with open("classification_output.json", "r", encoding="utf-8") as f:
+        classifier_result = json.load(f)
+
+    # JSON LLM1
+    with open("llm1_output.json", "r", encoding="utf-8") as f:
+        llm1_result = json.load(f)
+
+    result = run_llm2(letter_text, ner_result, classifier_result, llm1_result)
+
+    # Сохраняем в JSON файл
+    with open("llm2_output.json", "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
 
-print("Файл сохранён → llm2_output.json")
\ No newline at end of file
+    print("Файл сохранён → llm2_output.json")
@@ -2,45 +2,38 @@
 import os
 import json
 import re
-from dotenv import load_dotenv
-from openai import OpenAI
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from llm_cache import cache
+from llm_client import MODEL, get_client
+from json_extract import extract_json
+import metrics
+from streaming import stream_fields
+from prompt_builder import Prompt
 
-# -----------------------------------------
-# Загружаем ключи из .env
-# -----------------------------------------
-load_dotenv()
-
-folder_id = os.getenv("folder_id")
-api_key   = os.getenv("api_key")
+client = get_client("llm3")
 
-MODEL = f"gpt://{folder_id}/qwen3-235b-a22b-fp8/latest"
+# Режим проверки (см. llm2_yandex.ANSWERS_MODE):
+#   single    — все 4 черновика одним запросом;
+#   per_style — по запросу на каждый черновик, параллельно, со своим бюджетом токенов.
+ANSWERS_MODE = os.getenv("ANSWERS_MODE", "single")
 
-client = OpenAI(
-    base_url="https://rest-assistant.api.cloud.yandex.net/v1",
-    api_key=api_key,
-    project=folder_id
-)
+STYLES = ["official", "business", "client_friendly", "simple"]
 
-
-# -----------------------------------------
-# ВХОДНЫЕ ДАННЫЕ
-# -----------------------------------------
-# draft_answers_json = JSON из llm2_output.json
-# LLM2 result
-with open("llm2_output.json", "r", encoding="utf-8") as f:
-    draft_answers_json = json.load(f)
+STYLE_MAX_OUTPUT_TOKENS = 1000
 
 
 # -----------------------------------------
-# PROMPT TEMPLATE (как ты дал)
+# PROMPT: проверка всех четырёх черновиков
 # -----------------------------------------
-LLM3_PROMPT_TEMPLATE = """Ты — юридический и комплаенс-эксперт крупного банка.
+LLM3_PROMPT = Prompt("""Ты — юридический и комплаенс-эксперт крупного банка.
 
 ТВОЯ РОЛЬ:
 - Ты проверяешь и при необходимости исправляешь проекты ответов клиентам, партнёрам и регуляторам.
 - Ты пишешь на русском языке, в корректном деловом стиле.
 - Ты обязан соблюдать юридическую осторожность и избегать избыточных обещаний.
-- У тебя НЕТ доступа к исходному письму и дополнительным данным, кроме переданных черновых ответов.
+- У тебя НЕТ доступа к исходному письму и дополнительным данным, кроме черновых ответов LLM2,
+  переданных после инструкций: {"answers": {"official": ..., "business": ..., "client_friendly": ..., "simple": ...}}.
 
 ЧТО НЕЛЬЗЯ:
 - НЕЛЬЗЯ придумывать суммы, даты, реквизиты договоров, имена людей, названия подразделений и любые факты, которых нет в черновых ответах.
@@ -54,130 +47,170 @@ LLM3_PROMPT_TEMPLATE = """Ты — юридический и комплаенс-
 - Делать ответы аккуратными, юридически безопасными.
 - Сохранять общий смысл и структуру.
 
-ФОРМАТ ВЫВОДА:
-Верни ОДИН валидный JSON:
-
-{{
-  "answers": {{
-    "official": "скорректированный официальный ответ",
-    "business": "скорректированный деловой ответ",
-    "client_friendly": "скорректированный клиентоориентированный ответ",
-    "simple": "скорректированный упрощённый ответ"
-  }},
-  "issues": {{
-    "official": ["замечание 1", "замечание 2"],
-    "business": ["замечание 1"],
-    "client_friendly": ["..."],
-    "simple": ["..."]
-  }}
-}}
-
---------------------------------
-ВХОДНЫЕ ДАННЫЕ
---------------------------------
-
-Ниже приведён JSON с черновыми ответами от предыдущей модели (LLM2):
-
-{draft_json}
-
-Ожидаемая структура входных данных:
-
-{{
-  "answers": {{
-    "official": "...",
-    "business": "...",
-    "client_friendly": "...",
-    "simple": "..."
-  }}
-}}
-
---------------------------------
-ТВОЯ ЗАДАЧА
---------------------------------
-
-1. Для каждого варианта ответа:
-   - Найди потенциальные риски, обещания или некорректные формулировки.
-   - При необходимости переформулируй, сохранив смысл.
-2. Заполни две секции: "answers" и "issues".
-3. ВЕРНИ строго такой JSON:
-
-{{
-  "answers": {{
-    "official": "...",
-    "business": "...",
-    "client_friendly": "...",
-    "simple": "..."
-  }},
-  "issues": {{
-    "official": ["..."],
-    "business": ["..."],
-    "client_friendly": ["..."],
-    "simple": ["..."]
-  }}
-}}
-"""
+ТВОЯ ЗАДАЧА:
+1. Для каждого варианта ответа найди потенциальные риски, обещания или некорректные формулировки
+   и при необходимости переформулируй, сохранив смысл.
+2. Заполни две секции: "answers" (скорректированные ответы) и "issues" (замечания по каждому варианту).
+
+ФОРМАТ ВЫВОДА — ОДИН валидный JSON:
+{
+  "answers": {"official": "...", "business": "...", "client_friendly": "...", "simple": "..."},
+  "issues": {"official": ["замечание 1", "замечание 2"], "business": ["..."], "client_friendly": ["..."], "simple": ["..."]}
+}
+""")
 
 
 # -----------------------------------------
-# Подставляем входные данные в PROMPT
+# PROMPT для одного черновика (режим per_style): инструкции общие для всех стилей
 # -----------------------------------------
-prompt = LLM3_PROMPT_TEMPLATE.format(
-    draft_json=json.dumps(draft_answers_json, ensure_ascii=False, indent=2)
-)
+STYLE_PROMPT = Prompt("""Ты — юридический и комплаенс-эксперт крупного банка.
 
+ТВОЯ РОЛЬ:
+- Ты проверяешь и при необходимости исправляешь проект ответа клиенту, партнёру или регулятору.
+- Ты пишешь на русском языке, в корректном деловом стиле.
+- Ты обязан соблюдать юридическую осторожность и избегать избыточных обещаний.
 
-# -----------------------------------------
-# Вызов модели Yandex LLM
-# -----------------------------------------
-response = client.responses.create(
-    model=MODEL,
-    input=prompt,
-    max_output_tokens=1500,
-    temperature=0.1
-)
+ЧТО НЕЛЬЗЯ:
+- НЕЛЬЗЯ придумывать суммы, даты, реквизиты договоров, имена людей, названия подразделений и любые факты, которых нет в черновике.
+- НЕЛЬЗЯ добавлять категоричные обещания результата.
+- НЕЛЬЗЯ добавлять технические комментарии.
 
-raw = response.output_text.strip()
+ЧТО МОЖНО И НУЖНО:
+- Смягчать формулировки, которые звучат как жёсткие обещания результата.
+- Использовать выражения: «Банк рассмотрит…», «Банк проведёт проверку…», «Решение будет принято…».
+- Удалять конфликтные, резкие или эмоциональные элементы.
+- Сохранять стиль черновика (раздел «СТИЛЬ»), общий смысл, структуру и объём.
 
+Верни строго JSON:
+{"answer": "скорректированный текст ответа", "issues": ["замечание 1", "замечание 2"]}
+""")
 
-# -----------------------------------------
-# Извлекаем JSON из ответа
-# -----------------------------------------
-if raw.startswith("```"):
-    raw = raw.strip("`")
-    if raw.startswith("json"):
-        raw = raw[4:].strip()
-
-start = raw.find("{")
-end   = raw.rfind("}")
-
-if start != -1 and end != -1:
-    json_str = raw[start:end+1]
-else:
-    json_str = raw
-
-try:
-    result = json.loads(json_str)
-except:
-    result = {
-        "answers": {
-            "official": "",
-            "business": "",
-            "client_friendly": "",
-            "simple": ""
-        },
-        "issues": {
-            "official": [],
-            "business": [],
-            "client_friendly": [],
-            "simple": []
+
+def build_request(draft_answers_json: dict) -> dict:
+    """Инструкции LLM3, затем черновики LLM2."""
+    return {
+        "model": MODEL,
+        **LLM3_PROMPT.render(("ЧЕРНОВЫЕ ОТВЕТЫ LLM2", draft_answers_json)),
+        "max_output_tokens": 1500,
+        "temperature": 0.1,
+    }
+
+
+def parse_output(raw: str) -> dict:
+    """Вырезает JSON с answers / issues; при ошибке разбора — пустые значения."""
+    result = extract_json(raw, keys={"answers", "issues"})
+    if result is None:
+        metrics.note("fallbacks")
+        result = {
+            "answers": {
+                "official": "",
+                "business": "",
+                "client_friendly": "",
+                "simple": ""
+            },
+            "issues": {
+                "official": [],
+                "business": [],
+                "client_friendly": [],
+                "simple": []
+            }
+        }
+
+    return result
+
+
+def build_style_request(style: str, draft: str) -> dict:
+    """Запрос на проверку одного черновика."""
+    return {
+        "model": MODEL,
+        **STYLE_PROMPT.render(("ЧЕРНОВИК", draft), ("СТИЛЬ", style)),
+        "max_output_tokens": STYLE_MAX_OUTPUT_TOKENS,
+        "temperature": 0.1,
+    }
+
+
+def parse_style_output(raw: str, draft: str) -> tuple:
+    """(answer, issues) для одного стиля; если ответ не разобрался — черновик с пометкой."""
+    obj = extract_json(raw, keys={"answer"})
+    if obj is not None:
+        answer = str(obj.get("answer") or "").strip()
+        issues = obj.get("issues") or []
+        if answer:
+            return answer, [str(x) for x in issues] if isinstance(issues, list) else [str(issues)]
+    metrics.note("fallbacks")
+    return draft, ["Комплаенс-проверка не выполнена: ответ модели не разобран, показан черновик LLM2."]
+
+
+def run_llm3_per_style(draft_answers_json: dict, on_partial=None) -> dict:
+    """Проверяет 4 черновика параллельно."""
+    drafts = draft_answers_json.get("answers", {})
+    result = {"answers": {}, "issues": {}}
+
+    with ThreadPoolExecutor(max_workers=len(STYLES)) as pool:
+        futures = {
+            pool.submit(metrics.bind(cache.create), client, build_style_request(style, drafts.get(style) or "")): style
+            for style in STYLES if drafts.get(style)
         }
+        for future in as_completed(futures):
+            style = futures[future]
+            answer, issues = parse_style_output(future.result(), drafts[style])
+            result["answers"][style] = answer
+            result["issues"][style] = issues
+            if on_partial is not None:
+                on_partial("answers", style, answer)
+                on_partial("issues", style, issues)
+
+    return {
+        "answers": {style: result["answers"].get(style, "") for style in STYLES},
+        "issues": {style: result["issues"].get(style, []) for style in STYLES},
+    }
+
+
+def run_llm3(draft_answers_json: dict, on_partial=None, mode=None) -> dict:
+    """
+    Комплаенс-проверка черновиков LLM2: исправленные ответы и замечания.
+
+    on_partial(section, style, value) — потоковый режим: section="answers" для
+    исправленного текста и "issues" для списка замечаний по стилю.
+    mode — "single" или "per_style" (по умолчанию ANSWERS_MODE).
+    """
+    if (mode or ANSWERS_MODE) == "per_style":
+        return run_llm3_per_style(draft_answers_json, on_partial)
+
+    request = build_request(draft_answers_json)
+    if on_partial is None:
+        return parse_output(cache.create(client, request))
+    raw = stream_fields(client, request, lambda path, value: on_partial(path[0], path[1], value))
+    return parse_output(raw)
+
+
+async def arun(call, draft_answers_json: dict, mode=None) -> dict:
+    """run_llm3 для пакетного режима."""
+    if (mode or ANSWERS_MODE) != "per_style":
+        return parse_output(await call(build_request(draft_answers_json)))
+
+    drafts = draft_answers_json.get("answers", {})
+    styles = [style for style in STYLES if drafts.get(style)]
+    raws = await asyncio.gather(*[call(build_style_request(style, drafts[style])) for style in styles])
+    checked = {style: parse_style_output(raw, drafts[style]) for style, raw in zip(styles, raws)}
+    return {
+        "answers": {style: checked[style][0] if style in checked else "" for style in STYLES},
+        "issues": {style: checked[style][1] if style in checked else [] for style in STYLES},
     }
 
 
 # -----------------------------------------
-# Сохраняем результат в файл
+# Запуск как скрипта
 # -----------------------------------------
-with open("llm3_output.json", "w", encoding="utf-8") as f:
-    json.dump(result, f, ensure_ascii=False, indent=2)
+if __name__ == "__main__":
+    # LLM2 result
+    with open("llm2_output.json", "r", encoding="utf-8") as f:
+        draft_answers_json = json.load(f)
+
+    result = run_llm3(draft_answers_json)
+
+    # Сохраняем результат в файл
+    with open("llm3_output.json", "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
 
-print("Файл сохранён → llm3_output.json")
\ No newline at end of file
+    print("Файл сохранён → llm3_output.json")
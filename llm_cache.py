@@ -0,0 +1,175 @@
+# llm_cache.py
+# Персистентный кэш ответов LLM (SQLite).
+# Ключ — хеш запроса целиком: model, input (промпт), temperature, max_output_tokens.
+# По умолчанию кэшируются только детерминированные запросы (temperature == 0).
+#
+# Настройки через .env / окружение:
+#   LLM_CACHE_PATH         — файл базы (по умолчанию llm_cache.sqlite)
+#   LLM_CACHE_TTL          — время жизни записи, секунды (по умолчанию 7 дней)
+#   LLM_CACHE_MAX_ENTRIES  — максимум записей, старые по последнему обращению вытесняются
+#   LLM_CACHE_BYPASS=1     — не читать и не писать кэш
+import os
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from dotenv import load_dotenv
+
+import metrics
+
+load_dotenv()
+
+
+class ResponseCache:
+    def __init__(self, path="llm_cache.sqlite", ttl=7 * 24 * 3600, max_entries=10000,
+                 bypass=False, only_deterministic=True):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.bypass = bypass
+        self.only_deterministic = only_deterministic
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = None
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            path=os.getenv("LLM_CACHE_PATH", "llm_cache.sqlite"),
+            ttl=float(os.getenv("LLM_CACHE_TTL", 7 * 24 * 3600)),
+            max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", 10000)),
+            bypass=os.getenv("LLM_CACHE_BYPASS", "0").lower() in ("1", "true", "yes"),
+        )
+
+    # ------------------------
+    # SQLite
+    # ------------------------
+    def _db(self):
+        # Соединение открывается лениво: импорт модуля не создаёт файл базы
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY,"
+                " model TEXT,"
+                " output_text TEXT NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " accessed_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_accessed ON responses(accessed_at)")
+            self._conn.commit()
+        return self._conn
+
+    @staticmethod
+    def key(request: dict) -> str:
+        payload = json.dumps(request, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def cacheable(self, request: dict) -> bool:
+        if self.bypass:
+            return False
+        return not self.only_deterministic or request.get("temperature", 1.0) == 0.0
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            row = db.execute("SELECT output_text, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                self.misses += 1
+                return None
+            db.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            db.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, request, output_text):
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            db.execute(
+                "INSERT OR REPLACE INTO responses(key, model, output_text, created_at, accessed_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (key, request.get("model"), output_text, now, now),
+            )
+            self._evict(db, now)
+            db.commit()
+
+    def _evict(self, db, now):
+        db.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,))
+        db.execute(
+            "DELETE FROM responses WHERE key IN ("
+            " SELECT key FROM responses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+
+    # ------------------------
+    # Обёртки над client.responses.create
+    # ------------------------
+    def create(self, client, request: dict, bypass=False) -> str:
+        """client.responses.create(**request).output_text с кэшем."""
+        if bypass or not self.cacheable(request):
+            return client.responses.create(**request).output_text
+
+        key = self.key(request)
+        cached = self.get(key)
+        if cached is not None:
+            metrics.note("cache_hits")
+            return cached
+
+        output_text = client.responses.create(**request).output_text
+        if output_text.strip():
+            self.put(key, request, output_text)
+        return output_text
+
+    async def acreate(self, aclient, request: dict, bypass=False) -> str:
+        """То же для AsyncOpenAI (пакетный режим)."""
+        if bypass or not self.cacheable(request):
+            return (await aclient.responses.create(**request)).output_text
+
+        key = self.key(request)
+        cached = self.get(key)
+        if cached is not None:
+            metrics.note("cache_hits")
+            return cached
+
+        output_text = (await aclient.responses.create(**request)).output_text
+        if output_text.strip():
+            self.put(key, request, output_text)
+        return output_text
+
+    # ------------------------
+    # Статистика и обслуживание
+    # ------------------------
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._db().execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            "entries": entries,
+        }
+
+    def clear(self):
+        with self._lock:
+            db = self._db()
+            db.execute("DELETE FROM responses")
+            db.commit()
+
+
+# Общий кэш для всех этапов процесса
+cache = ResponseCache.from_env()
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "stats"
+    if command == "clear":
+        cache.clear()
+        print(f"Кэш очищен → {cache.path}")
+    else:
+        print(json.dumps(cache.stats(), ensure_ascii=False, indent=2))
@@ -0,0 +1,208 @@
+# llm_client.py
+# Общий клиент Yandex responses API для всех этапов.
+# Раньше каждый скрипт создавал свой OpenAI(...) — соединения не переиспользовались,
+# и на каждый из семи вызовов на письмо приходилось заново делать TCP + TLS.
+# Здесь один долгоживущий пул httpx (keep-alive) на процесс; этапы получают клиент
+# со своим тайм-аутом через get_client(stage), пул при этом общий.
+# Каждый вызов client.responses.create идёт через rate_limiter (общая квота RPS / TPM)
+# и llm_retry: дедлайн этапа, повторы временных ошибок и (LLM_HEDGE=1) хеджирование.
+# Размер промпта считается локально до отправки и сверяется с usage (prompt_builder.stats).
+#
+# Настройки через .env / окружение:
+#   LLM_BASE_URL           — адрес API (по умолчанию Yandex; для локального стенда — bench/mock_yandex.py)
+#   LLM_POOL_SIZE          — максимум соединений в пуле (по умолчанию 32)
+#   LLM_KEEPALIVE_EXPIRY   — сколько секунд держать простаивающее соединение (60)
+#   LLM_HTTP2=1            — HTTP/2 (нужен пакет h2; без него — HTTP/1.1)
+#   LLM_CONNECT_TIMEOUT    — тайм-аут установки соединения, сек (5)
+#   LLM_TIMEOUT_<ЭТАП>     — тайм-аут ответа этапа, сек: LLM_TIMEOUT_NER=20, LLM_TIMEOUT_LLM2=180 ...
+import os
+import asyncio
+import threading
+
+import httpx
+import openai
+from dotenv import load_dotenv
+from openai import OpenAI, AsyncOpenAI
+
+import llm_retry
+import metrics
+from rate_limiter import limiter, estimate_tokens, usage_tokens
+from prompt_builder import prompt_stats
+
+load_dotenv()
+
+folder_id = os.getenv("folder_id")
+api_key   = os.getenv("api_key")
+
+BASE_URL = os.getenv("LLM_BASE_URL", "https://rest-assistant.api.cloud.yandex.net/v1")
+MODEL    = f"gpt://{folder_id}/qwen3-235b-a22b-fp8/latest"
+
+POOL_SIZE        = int(os.getenv("LLM_POOL_SIZE", 32))
+KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", 60))
+HTTP2            = os.getenv("LLM_HTTP2", "0").lower() in ("1", "true", "yes")
+CONNECT_TIMEOUT  = float(os.getenv("LLM_CONNECT_TIMEOUT", 5))
+
+# Тайм-аут ответа по этапам, сек: короткие JSON-этапы отвечают быстрее генерации писем
+STAGE_TIMEOUTS = {
+    "ner": 30, "classifier": 30, "llm1": 30, "analysis": 60,
+    "rag1": 45, "rag2": 45, "llm2": 120, "llm3": 120,
+}
+DEFAULT_TIMEOUT = 60
+
+
+def stage_timeout(stage=None) -> httpx.Timeout:
+    default = STAGE_TIMEOUTS.get(stage, DEFAULT_TIMEOUT)
+    read = float(os.getenv(f"LLM_TIMEOUT_{stage.upper()}", default)) if stage else DEFAULT_TIMEOUT
+    return httpx.Timeout(read, connect=CONNECT_TIMEOUT)
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(max_connections=POOL_SIZE, max_keepalive_connections=POOL_SIZE,
+                        keepalive_expiry=KEEPALIVE_EXPIRY)
+
+
+def _http2() -> bool:
+    if not HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+# ------------------------
+# Обёртки: responses.create через лимитер, с повторами и дедлайном этапа
+# ------------------------
+def _record(response):
+    metrics.note("llm_calls")
+    metrics.record_usage(response)    # у потока usage нет — его учитывает streaming.stream_text
+
+
+def _waited(wait):
+    metrics.note("queue_wait", wait)
+    return wait
+
+
+async def _awaited(pending):
+    return _waited(await pending)
+
+
+class _Responses:
+    def __init__(self, client, stage, timeout):
+        self._client = client
+        self._stage = stage
+        self._timeout = timeout
+
+    def _attempt(self, request, cost, prompt):
+        def attempt(t):
+            try:
+                response = self._client.responses.create(**request, timeout=httpx.Timeout(t, connect=CONNECT_TIMEOUT))
+            except openai.RateLimitError as e:
+                limiter.pause(llm_retry.retry_after(e) or 1.0)
+                raise
+            limiter.settle(cost, usage_tokens(response))
+            prompt_stats.usage(self._stage, prompt, response)
+            _record(response)
+            return response
+        return attempt
+
+    def create(self, **request):
+        # поток (stream=True) повторяется только до начала ответа и не хеджируется
+        hedge = False if request.get("stream") else None
+        prompt = prompt_stats.request(self._stage, request)
+        cost = estimate_tokens(request, prompt)
+        return llm_retry.call(
+            self._attempt(request, cost, prompt),
+            stage=self._stage, timeout=self._timeout, hedge=hedge,
+            acquire=lambda: _waited(limiter.acquire(cost)), try_acquire=lambda: limiter.try_acquire(cost),
+        )
+
+
+class _AsyncResponses(_Responses):
+    def _attempt(self, request, cost, prompt):
+        async def attempt(t):
+            try:
+                response = await self._client.responses.create(**request, timeout=httpx.Timeout(t, connect=CONNECT_TIMEOUT))
+            except openai.RateLimitError as e:
+                limiter.pause(llm_retry.retry_after(e) or 1.0)
+                raise
+            limiter.settle(cost, usage_tokens(response))
+            prompt_stats.usage(self._stage, prompt, response)
+            _record(response)
+            return response
+        return attempt
+
+    async def create(self, **request):
+        hedge = False if request.get("stream") else None
+        prompt = prompt_stats.request(self._stage, request)
+        cost = estimate_tokens(request, prompt)
+        return await llm_retry.acall(
+            self._attempt(request, cost, prompt),
+            stage=self._stage, timeout=self._timeout, hedge=hedge,
+            acquire=lambda: _awaited(limiter.aacquire(cost)), try_acquire=lambda: limiter.try_acquire(cost),
+        )
+
+
+class StageClient:
+    """Клиент этапа: тот же интерфейс client.responses.create, что у OpenAI."""
+
+    def __init__(self, client, stage=None, responses_cls=_Responses):
+        self.stage = stage
+        self.raw = client
+        self.responses = responses_cls(client, stage, stage_timeout(stage).read)
+
+
+# ------------------------
+# Синхронный клиент (pipeline.py, CLI этапов)
+# ------------------------
+_client = None
+_lock = threading.Lock()
+
+
+def get_client(stage=None) -> StageClient:
+    """Клиент этапа на общем пуле: тайм-аут этапа и повторы — в каждом запросе."""
+    global _client
+    with _lock:
+        if _client is None:
+            _client = OpenAI(
+                base_url=BASE_URL,
+                api_key=api_key,
+                project=folder_id,
+                max_retries=0,          # повторами управляет llm_retry
+                http_client=httpx.Client(limits=_limits(), http2=_http2(), timeout=stage_timeout()),
+            )
+    return StageClient(_client, stage)
+
+
+# ------------------------
+# Асинхронный клиент (batch.py)
+# ------------------------
+# Пул httpx.AsyncClient привязан к циклу событий, поэтому клиент — свой на каждый цикл.
+_aclients = {}
+
+
+def get_async_client(stage=None) -> StageClient:
+    loop = asyncio.get_running_loop()
+    aclient = _aclients.get(loop)
+    if aclient is None:
+        # клиенты закрытых циклов больше не нужны
+        for old in [lp for lp in _aclients if lp.is_closed()]:
+            del _aclients[old]
+        aclient = _aclients[loop] = AsyncOpenAI(
+            base_url=BASE_URL,
+            api_key=api_key,
+            project=folder_id,
+            max_retries=0,
+            http_client=httpx.AsyncClient(limits=_limits(), http2=_http2(), timeout=stage_timeout()),
+        )
+    return StageClient(aclient, stage, _AsyncResponses)
+
+
+def close():
+    """Закрывает пул синхронного клиента (например, при остановке сервиса)."""
+    global _client
+    with _lock:
+        if _client is not None:
+            _client.close()
+            _client = None
@@ -0,0 +1,252 @@
+# llm_retry.py
+# Управление хвостом задержек вызовов LLM: дедлайн этапа, повторы с экспоненциальной
+# задержкой и джиттером, необязательные «хеджированные» запросы.
+#
+# Хеджирование: если первый запрос не ответил за p95 задержки этапа, отправляется
+# дубликат; берётся тот ответ, что пришёл раньше, второй отменяется (в пакетном режиме —
+# отменой задачи; в синхронном ответ проигравшего просто отбрасывается).
+#
+# Настройки через .env / окружение:
+#   LLM_MAX_RETRIES        — повторов после первой попытки (по умолчанию 3)
+#   LLM_BACKOFF_BASE       — базовая задержка, сек (0.5); задержка = random(0, base · 2^n), не больше LLM_BACKOFF_MAX
+#   LLM_BACKOFF_MAX        — максимум одной задержки, сек (8)
+#   LLM_DEADLINE_<ЭТАП>    — общий бюджет времени вызова с повторами, сек (по умолчанию 2 × тайм-аут этапа)
+#   LLM_HEDGE=1            — включить хеджирование (дублирует часть запросов — расходует токены)
+#   LLM_HEDGE_MIN_SAMPLES  — сколько замеров этапа нужно, чтобы оценить p95 (20)
+import os
+import time
+import random
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import openai
+
+import metrics
+
+MAX_RETRIES        = int(os.getenv("LLM_MAX_RETRIES", 3))
+BACKOFF_BASE       = float(os.getenv("LLM_BACKOFF_BASE", 0.5))
+BACKOFF_MAX        = float(os.getenv("LLM_BACKOFF_MAX", 8))
+HEDGE              = os.getenv("LLM_HEDGE", "0").lower() in ("1", "true", "yes")
+HEDGE_MIN_SAMPLES  = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", 20))
+
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class DeadlineExceeded(TimeoutError):
+    """Бюджет времени этапа исчерпан вместе с повторами."""
+
+
+def is_retryable(error) -> bool:
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRY_STATUSES
+    return False
+
+
+def retry_after(error):
+    """Retry-After из ответа 429/503, сек (или None)."""
+    response = getattr(error, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def backoff(attempt: int, error=None) -> float:
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+    hinted = retry_after(error) if error is not None else None
+    return max(delay, hinted) if hinted is not None else delay
+
+
+# ------------------------
+# Статистика по этапам
+# ------------------------
+class StageStats:
+    def __init__(self, window=200):
+        self.latencies = deque(maxlen=window)   # успешные вызовы, сек
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._lock = threading.Lock()
+
+    def add(self, field, value=1):
+        with self._lock:
+            if field == "latencies":
+                self.latencies.append(value)
+            else:
+                setattr(self, field, getattr(self, field) + value)
+
+    def quantile(self, q):
+        with self._lock:
+            values = sorted(self.latencies)
+        if not values:
+            return None
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    def hedge_delay(self):
+        """p95 задержки этапа, если замеров достаточно."""
+        return self.quantile(0.95) if len(self.latencies) >= HEDGE_MIN_SAMPLES else None
+
+    def as_dict(self) -> dict:
+        p = lambda q: round(self.quantile(q), 3) if self.latencies else None
+        return {
+            "calls": self.calls, "retries": self.retries, "failures": self.failures,
+            "hedges": self.hedges, "hedge_wins": self.hedge_wins,
+            "p50": p(0.5), "p95": p(0.95), "p99": p(0.99),
+        }
+
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def stage_stats(stage) -> StageStats:
+    with _stats_lock:
+        return _stats.setdefault(stage or "default", StageStats())
+
+
+def stats() -> dict:
+    with _stats_lock:
+        return {stage: s.as_dict() for stage, s in _stats.items()}
+
+
+def deadline_for(stage, timeout) -> float:
+    default = 2 * timeout
+    return float(os.getenv(f"LLM_DEADLINE_{stage.upper()}", default)) if stage else default
+
+
+# ------------------------
+# Синхронный вызов
+# ------------------------
+_hedge_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="llm-hedge")
+
+
+def call(fn, stage=None, timeout=60.0, hedge=None, acquire=None, try_acquire=None):
+    """
+    fn(timeout) — один запрос к API. Повторяет временные ошибки (тайм-аут, соединение,
+    429, 5xx) с задержкой и джиттером, пока не исчерпан дедлайн этапа.
+    acquire() — ожидание лимитера перед каждой попыткой (в дедлайн не входит),
+    try_acquire() — место для хеджа без ожидания: нет места — дубликат не отправляется.
+    """
+    st = stage_stats(stage)
+    hedge = HEDGE if hedge is None else hedge
+    deadline = time.monotonic() + deadline_for(stage, timeout)
+    st.add("calls")
+
+    for attempt in range(MAX_RETRIES + 1):
+        if acquire is not None:
+            deadline += acquire()
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            st.add("failures")
+            raise DeadlineExceeded(f"{stage}: дедлайн исчерпан после {attempt} попыток")
+        started = time.monotonic()
+        try:
+            if hedge:
+                result = _hedged(fn, st, min(timeout, remaining), try_acquire)
+            else:
+                result = fn(min(timeout, remaining))
+            st.add("latencies", time.monotonic() - started)
+            return result
+        except Exception as e:
+            if not is_retryable(e) or attempt == MAX_RETRIES:
+                st.add("failures")
+                raise
+            st.add("retries")
+            metrics.note("retries")
+            time.sleep(max(0.0, min(backoff(attempt, e), deadline - time.monotonic())))
+
+
+def _hedged(fn, st, timeout, try_acquire=None):
+    delay = st.hedge_delay()
+    if delay is None or delay >= timeout:
+        return fn(timeout)
+    first = _hedge_pool.submit(metrics.bind(fn), timeout)
+    done, _ = wait([first], timeout=delay)
+    if done or (try_acquire is not None and not try_acquire()):
+        return first.result()
+    st.add("hedges")
+    metrics.note("hedges")
+    second = _hedge_pool.submit(metrics.bind(fn), max(0.1, timeout - delay))
+    pending = {first, second}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if future is second:
+                    st.add("hedge_wins")
+                for other in pending:
+                    other.cancel()   # уже запущенный поток доработает, его ответ отбрасывается
+                return future.result()
+            error = future.exception()
+    raise error
+
+
+# ------------------------
+# Асинхронный вызов (batch.py)
+# ------------------------
+async def acall(fn, stage=None, timeout=60.0, hedge=None, acquire=None, try_acquire=None):
+    """То же для корутин: fn(timeout) и acquire() возвращают awaitable; проигравший хедж отменяется."""
+    st = stage_stats(stage)
+    hedge = HEDGE if hedge is None else hedge
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + deadline_for(stage, timeout)
+    st.add("calls")
+
+    for attempt in range(MAX_RETRIES + 1):
+        if acquire is not None:
+            deadline += await acquire()
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            st.add("failures")
+            raise DeadlineExceeded(f"{stage}: дедлайн исчерпан после {attempt} попыток")
+        started = loop.time()
+        try:
+            if hedge:
+                result = await _ahedged(fn, st, min(timeout, remaining), try_acquire)
+            else:
+                result = await fn(min(timeout, remaining))
+            st.add("latencies", loop.time() - started)
+            return result
+        except Exception as e:
+            if not is_retryable(e) or attempt == MAX_RETRIES:
+                st.add("failures")
+                raise
+            st.add("retries")
+            metrics.note("retries")
+            await asyncio.sleep(max(0.0, min(backoff(attempt, e), deadline - loop.time())))
+
+
+async def _ahedged(fn, st, timeout, try_acquire=None):
+    delay = st.hedge_delay()
+    if delay is None or delay >= timeout:
+        return await fn(timeout)
+    first = asyncio.ensure_future(fn(timeout))
+    done, _ = await asyncio.wait([first], timeout=delay)
+    if done or (try_acquire is not None and not try_acquire()):
+        return await first
+    st.add("hedges")
+    metrics.note("hedges")
+    second = asyncio.ensure_future(fn(max(0.1, timeout - delay)))
+    pending = {first, second}
+    error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is second:
+                        st.add("hedge_wins")
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
@@ -0,0 +1,284 @@
+# metrics.py
+# Метрики этапов по каждому письму: время, ожидание в очереди, токены, повторы,
+# сбои разбора ответа и откаты на значения по умолчанию.
+#
+# Каждый этап письма выполняется внутри stage_scope(letter_id, stage); вызовы LLM, кэш,
+# llm_retry и разбор JSON дописывают в текущую запись через note() / record_usage().
+# Текущая запись хранится в contextvars: асинхронные задачи наследуют её сами, для пулов
+# потоков функция оборачивается bind().
+#
+# Выгрузка:
+#   - METRICS_LOG (по умолчанию metrics.jsonl; пусто — не писать) — одна строка на этап письма;
+#   - Prometheus: render_prometheus() (GET /metrics в server.py) и файл METRICS_PROM_PATH;
+#   - сводка: python metrics.py summary [--log metrics.jsonl] — p50/p95/p99 по этапам.
+#
+# Стоимость считается по ценам за 1000 токенов: LLM_PRICE_INPUT, LLM_PRICE_OUTPUT,
+# LLM_PRICE_CACHED (по умолчанию как LLM_PRICE_INPUT). Цены не заданы — стоимость 0.
+import os
+import sys
+import json
+import time
+import inspect
+import argparse
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+
+from scheduler import Stage
+
+LOG_PATH     = os.getenv("METRICS_LOG", "metrics.jsonl")
+PROM_PATH    = os.getenv("METRICS_PROM_PATH", "")
+PRICE_INPUT  = float(os.getenv("LLM_PRICE_INPUT", 0))
+PRICE_OUTPUT = float(os.getenv("LLM_PRICE_OUTPUT", 0))
+PRICE_CACHED = float(os.getenv("LLM_PRICE_CACHED", PRICE_INPUT))
+
+COUNTERS = ["llm_calls", "cache_hits", "input_tokens", "output_tokens", "cached_tokens",
+            "retries", "hedges", "parse_failures", "parse_repaired", "fallbacks"]
+QUANTILES = (0.5, 0.95, 0.99)
+
+_current = contextvars.ContextVar("metrics_stage", default=None)
+
+
+# ------------------------
+# Запись этапа
+# ------------------------
+class StageRecord:
+    def __init__(self, letter_id, stage):
+        self.letter_id = letter_id
+        self.stage = stage
+        self.values = dict.fromkeys(COUNTERS, 0)
+        self.values["queue_wait"] = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, field, value=1):
+        with self._lock:
+            self.values[field] = self.values.get(field, 0) + value
+
+    def as_dict(self, wall, status) -> dict:
+        with self._lock:
+            values = dict(self.values)
+        values["queue_wait"] = round(values["queue_wait"], 3)
+        return {
+            "ts": round(time.time(), 3), "letter_id": self.letter_id, "stage": self.stage,
+            "status": status, "wall": round(wall, 3), **values, "cost": round(cost(values), 4),
+        }
+
+
+def cost(values) -> float:
+    cached = values.get("cached_tokens", 0)
+    return ((values.get("input_tokens", 0) - cached) * PRICE_INPUT + cached * PRICE_CACHED
+            + values.get("output_tokens", 0) * PRICE_OUTPUT) / 1000
+
+
+def note(field, value=1):
+    """Добавляет к счётчику текущего этапа (вне этапа — ничего не делает)."""
+    record = _current.get()
+    if record is not None:
+        record.add(field, value)
+
+
+def record_usage(response):
+    """Токены из response.usage (Responses API)."""
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return
+    note("input_tokens", getattr(usage, "input_tokens", 0) or 0)
+    note("output_tokens", getattr(usage, "output_tokens", 0) or 0)
+    details = getattr(usage, "input_tokens_details", None)
+    note("cached_tokens", getattr(details, "cached_tokens", 0) or 0)
+
+
+def bind(fn):
+    """fn, который в другом потоке пишет в запись текущего этапа (для ThreadPoolExecutor)."""
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        return context.copy().run(fn, *args, **kwargs)
+    return run
+
+
+# ------------------------
+# Агрегаты по этапам
+# ------------------------
+class Aggregate:
+    def __init__(self, window=1000):
+        self.window = window
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def add(self, record: dict):
+        with self._lock:
+            stage = self.stages.setdefault(record["stage"], {
+                "count": 0, "errors": 0, "wall_sum": 0.0, "queue_wait": 0.0, "cost": 0.0,
+                "walls": deque(maxlen=self.window), "waits": deque(maxlen=self.window),
+                **dict.fromkeys(COUNTERS, 0),
+            })
+            stage["count"] += 1
+            stage["errors"] += record.get("status") != "ok"
+            stage["wall_sum"] += record["wall"]
+            stage["walls"].append(record["wall"])
+            stage["waits"].append(record.get("queue_wait", 0.0))
+            stage["queue_wait"] += record.get("queue_wait", 0.0)
+            stage["cost"] += record.get("cost", 0.0)
+            for field in COUNTERS:
+                stage[field] += record.get(field, 0)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {name: {**s, "walls": list(s["walls"]), "waits": list(s["waits"])}
+                    for name, s in self.stages.items()}
+
+
+def quantile(values, q):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+registry = Aggregate()
+_log_lock = threading.Lock()
+
+
+def emit(record: dict):
+    registry.add(record)
+    if LOG_PATH:
+        line = json.dumps(record, ensure_ascii=False)
+        with _log_lock, open(LOG_PATH, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+
+@contextmanager
+def stage_scope(letter_id, stage):
+    record = StageRecord(letter_id, stage)
+    token = _current.set(record)
+    started = time.perf_counter()
+    status = "error"
+    try:
+        yield record
+        status = "ok"
+    finally:
+        _current.reset(token)
+        emit(record.as_dict(time.perf_counter() - started, status))
+
+
+def instrument(stages, letter_id):
+    """Оборачивает этапы графа (синхронные или корутины) в stage_scope."""
+    wrapped = []
+    for stage in stages:
+        name = stage.name.lower()
+        if inspect.iscoroutinefunction(stage.func):
+            async def func(*args, _func=stage.func, _name=name):
+                with stage_scope(letter_id, _name):
+                    return await _func(*args)
+        else:
+            def func(*args, _func=stage.func, _name=name):
+                with stage_scope(letter_id, _name):
+                    return _func(*args)
+        wrapped.append(Stage(stage.name, func, stage.inputs, stage.output))
+    return wrapped
+
+
+# ------------------------
+# Prometheus
+# ------------------------
+def render_prometheus(snapshot=None) -> str:
+    snapshot = registry.snapshot() if snapshot is None else snapshot
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            value = "NaN" if value is None else value
+            label_text = ",".join(f'{k}="{v}"' for k, v in labels.items())
+            lines.append(f"{name}{{{label_text}}} {value}")
+
+    stages = sorted(snapshot)
+    samples = []
+    for stage in stages:
+        s = snapshot[stage]
+        for q in QUANTILES:
+            samples.append(({"stage": stage, "quantile": q}, quantile(s["walls"], q)))
+    metric("pipeline_stage_seconds", "summary", "Время этапа на письмо, сек", samples)
+    for stage in stages:
+        lines.append(f'pipeline_stage_seconds_sum{{stage="{stage}"}} {round(snapshot[stage]["wall_sum"], 3)}')
+        lines.append(f'pipeline_stage_seconds_count{{stage="{stage}"}} {snapshot[stage]["count"]}')
+
+    metric("pipeline_stage_errors_total", "counter", "Этапы, завершившиеся ошибкой",
+           [({"stage": st}, snapshot[st]["errors"]) for st in stages])
+    metric("pipeline_queue_wait_seconds_total", "counter", "Ожидание лимитера и семафора запросов, сек",
+           [({"stage": st}, round(snapshot[st]["queue_wait"], 3)) for st in stages])
+    metric("pipeline_llm_calls_total", "counter", "Успешные запросы к LLM",
+           [({"stage": st}, snapshot[st]["llm_calls"]) for st in stages])
+    metric("pipeline_llm_cache_hits_total", "counter", "Ответы из кэша LLM",
+           [({"stage": st}, snapshot[st]["cache_hits"]) for st in stages])
+    metric("pipeline_llm_tokens_total", "counter", "Токены по usage ответа",
+           [({"stage": st, "kind": kind}, snapshot[st][f"{kind}_tokens"])
+            for st in stages for kind in ("input", "output", "cached")])
+    metric("pipeline_llm_retries_total", "counter", "Повторы запросов (llm_retry)",
+           [({"stage": st}, snapshot[st]["retries"]) for st in stages])
+    metric("pipeline_llm_hedges_total", "counter", "Хеджированные дубликаты запросов",
+           [({"stage": st}, snapshot[st]["hedges"]) for st in stages])
+    metric("pipeline_parse_failures_total", "counter", "Ответы без разбираемого JSON",
+           [({"stage": st}, snapshot[st]["parse_failures"]) for st in stages])
+    metric("pipeline_parse_repaired_total", "counter", "Ответы, разобранные после починки JSON",
+           [({"stage": st}, snapshot[st]["parse_repaired"]) for st in stages])
+    metric("pipeline_fallbacks_total", "counter", "Откаты на значения по умолчанию",
+           [({"stage": st}, snapshot[st]["fallbacks"]) for st in stages])
+    metric("pipeline_cost_total", "counter", "Стоимость по LLM_PRICE_*",
+           [({"stage": st}, round(snapshot[st]["cost"], 4)) for st in stages])
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path=None):
+    """Файл в text format для node_exporter textfile collector (METRICS_PROM_PATH)."""
+    path = path or PROM_PATH
+    if not path:
+        return
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(render_prometheus())
+    os.replace(tmp, path)
+
+
+# ------------------------
+# Сводка по журналу
+# ------------------------
+def load_log(path) -> Aggregate:
+    aggregate = Aggregate(window=None)
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                aggregate.add(json.loads(line))
+    return aggregate
+
+
+def format_summary(snapshot) -> str:
+    header = (f"{'этап':<12}{'n':>6}{'p50, с':>9}{'p95, с':>9}{'p99, с':>9}{'очередь p95':>13}"
+              f"{'вход/письмо':>13}{'выход/письмо':>14}{'кэш':>6}{'повт.':>7}{'разбор':>8}{'откат':>7}{'стоимость':>11}")
+    lines = [header, "-" * len(header)]
+    fmt = lambda v: f"{v:.2f}" if v is not None else "—"
+    for stage in sorted(snapshot, key=lambda st: -snapshot[st]["wall_sum"]):
+        s = snapshot[stage]
+        n = s["count"]
+        lines.append(
+            f"{stage:<12}{n:>6}{fmt(quantile(s['walls'], 0.5)):>9}{fmt(quantile(s['walls'], 0.95)):>9}"
+            f"{fmt(quantile(s['walls'], 0.99)):>9}{fmt(quantile(s['waits'], 0.95)):>13}"
+            f"{s['input_tokens'] / n:>13.0f}{s['output_tokens'] / n:>14.0f}{s['cache_hits']:>6}{s['retries']:>7}"
+            f"{s['parse_failures']:>8}{s['fallbacks']:>7}{s['cost']:>11.2f}"
+        )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Метрики этапов: сводка и Prometheus по журналу")
+    parser.add_argument("command", choices=["summary", "prom"], nargs="?", default="summary")
+    parser.add_argument("--log", default=LOG_PATH or "metrics.jsonl", help="журнал метрик (JSONL)")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.log):
+        sys.exit(f"Журнал метрик не найден: {args.log}")
+    snapshot = load_log(args.log).snapshot()
+    print(format_summary(snapshot) if args.command == "summary" else render_prometheus(snapshot), end="\n")
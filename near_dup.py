@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+# near_dup.py
+# Почти одинаковые письма (массовые жалобы после инцидента): MinHash + LSH по тексту
+# с замаскированными сущностями и повторное использование результатов прошлого письма.
+#
+# Сущности ищутся правилами ner_rules (без LLM) и заменяются метками: <PERSON>, <CONTRACT>,
+# <PHONE>, <EMAIL>, <ORG>, <DATE>, <NUM>. Ссылки на НПА не маскируются — другая статья
+# закона меняет ответ. Из замаскированного текста — шинглы по 3 слова, подпись MinHash
+# из NEAR_DUP_PERMUTATIONS (128) хешей, LSH — BANDS полос по ROWS хешей: поиск кандидатов —
+# несколько обращений к словарю, без перебора индекса.
+#
+# Письмо — дубликат, если оценка сходства (доля совпавших хешей) ≥ NEAR_DUP_THRESHOLD (0.9)
+# и метки в обоих письмах идут в одном порядке. Тогда результаты всех этапов прошлого
+# письма копируются с заменой его сущностей на сущности нового: ФИО (и по словам), номера,
+# телефоны, даты, суммы. Если в результатах осталось любое старое значение (имя в другом падеже,
+# число в другой записи), перенос отменяется.
+#
+#   NEAR_DUP=1 (0 — выключить), NEAR_DUP_THRESHOLD=0.9, NEAR_DUP_INDEX=near_dup.jsonl (пусто — только память)
+#
+#   python near_dup.py build [--letters letters]   # проиндексировать готовые письма из letters/
+#   python near_dup.py query letter.txt            # найти похожее письмо
+import os
+import re
+import sys
+import json
+import time
+import zlib
+import argparse
+import threading
+from pathlib import Path
+
+import numpy as np
+
+from artifact_store import read_letter_dir
+from ner_rules import (EMAIL_RE, PHONE_RE, CONTRACT_RE, ORGANIZATION_RE, PERSON_RES, LAW_REF_RES, DATE,
+                       normalize_date, extract_rules, merge)
+
+NEAR_DUP           = os.getenv("NEAR_DUP", "1") == "1"
+NEAR_DUP_THRESHOLD = float(os.getenv("NEAR_DUP_THRESHOLD", 0.9))
+NEAR_DUP_INDEX     = os.getenv("NEAR_DUP_INDEX", "near_dup.jsonl")
+NUM_PERM           = int(os.getenv("NEAR_DUP_PERMUTATIONS", 128))
+ROWS               = 8                    # хешей в полосе LSH: кандидат при сходстве ≳ (1 / BANDS) ** (1 / ROWS)
+BANDS              = NUM_PERM // ROWS
+SHINGLE            = 3
+
+# Результаты этапов, которые копируются из прошлого письма
+ARTIFACTS = ("ner", "classification", "llm1", "rag_docs", "llm2", "rag_usage", "llm3")
+
+# ФИО полностью и «Имя Отчество» (в правилах NER — только с инициалами)
+FULL_NAME_RE = re.compile(r"\b[А-ЯЁ][а-яё]+\s+[А-ЯЁ][а-яё]+\s+[А-ЯЁ][а-яё]+(?:вич|вна|ична|чна)\b")
+NAME_PATRONYMIC_RE = re.compile(r"\b[А-ЯЁ][а-яё]+\s+[А-ЯЁ][а-яё]+(?:вич|вна|ична|чна)\b")
+DATE_RE = re.compile(r"(?<!\d)(?:" + DATE + r")", re.IGNORECASE)
+NUM_RE = re.compile(r"(?<![\w])\d+(?:[  ]\d{3})*(?:[.,]\d+)?(?!\w)")
+WORD_RE = re.compile(r"<[A-Z]+>|\w+")
+DIGIT_SEP_RE = re.compile(r"(?<=\d)[\s()\-.,/  ]+(?=\d)")
+
+# (метка, шаблон, группа) по приоритету: более ранний шаблон забирает пересекающийся фрагмент;
+# метка None — фрагмент остаётся в тексте как есть (ссылки на НПА)
+SLOT_PATTERNS = (
+    [(None, regex, 0) for regex in LAW_REF_RES]
+    + [("EMAIL", EMAIL_RE, 0), ("PHONE", PHONE_RE, 0), ("ORG", ORGANIZATION_RE, 0), ("CONTRACT", CONTRACT_RE, 1),
+       ("DATE", DATE_RE, 0), ("PERSON", FULL_NAME_RE, 0)]
+    + [("PERSON", regex, 0) for regex in PERSON_RES]
+    + [("PERSON", NAME_PATRONYMIC_RE, 0), ("NUM", NUM_RE, 0)]
+)
+
+
+# ------------------------
+# Маскирование сущностей
+# ------------------------
+def find_slots(text: str) -> list:
+    """[(начало, конец, метка, значение)] по порядку в тексте, без пересечений."""
+    taken = []
+    for label, regex, group in SLOT_PATTERNS:
+        for m in regex.finditer(text):
+            start, end = m.span(group)
+            if any(start < e and s < end for s, e, _, _ in taken):
+                continue
+            taken.append((start, end, label, text[start:end]))
+    return sorted((s for s in taken if s[2] is not None), key=lambda s: s[0])
+
+
+def mask(text: str):
+    """(текст с метками вместо сущностей, слоты)."""
+    slots = find_slots(text)
+    parts, last = [], 0
+    for start, end, label, _ in slots:
+        parts.append(text[last:start])
+        parts.append(f"<{label}>")
+        last = end
+    parts.append(text[last:])
+    return "".join(parts), slots
+
+
+# ------------------------
+# MinHash
+# ------------------------
+_rng = np.random.RandomState(20240601)
+_A = (_rng.randint(1, 2 ** 31, size=NUM_PERM, dtype=np.int64).astype(np.uint64) << np.uint64(32)) \
+    | _rng.randint(1, 2 ** 31, size=NUM_PERM, dtype=np.int64).astype(np.uint64) | np.uint64(1)
+_B = _rng.randint(0, 2 ** 31, size=NUM_PERM, dtype=np.int64).astype(np.uint64) << np.uint64(32)
+
+
+def shingles(masked_text: str) -> set:
+    words = WORD_RE.findall(masked_text.lower().replace("ё", "е"))
+    if len(words) < SHINGLE:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + SHINGLE]) for i in range(len(words) - SHINGLE + 1)}
+
+
+def signature(masked_text: str) -> np.ndarray:
+    """MinHash: для каждой из NUM_PERM хеш-функций (a·x + b) >> 32 — минимум по шинглам."""
+    items = shingles(masked_text)
+    if not items:
+        return np.full(NUM_PERM, 0xFFFFFFFF, dtype=np.uint32)
+    x = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in items), dtype=np.uint64, count=len(items))
+    hashes = (x[:, None] * _A[None, :] + _B[None, :]) >> np.uint64(32)     # переполнение uint64 — часть хеша
+    return hashes.min(axis=0).astype(np.uint32)
+
+
+def similarity(a: np.ndarray, b: np.ndarray) -> float:
+    """Оценка коэффициента Жаккара по подписям."""
+    return float(np.mean(a == b))
+
+
+def bands(sig: np.ndarray) -> list:
+    return [(n, sig[n * ROWS:(n + 1) * ROWS].tobytes()) for n in range(BANDS)]
+
+
+# ------------------------
+# Индекс
+# ------------------------
+class NearDupIndex:
+    """
+    LSH-индекс подписей обработанных писем.
+
+    index = NearDupIndex("near_dup.jsonl")   # подписи дописываются в файл и читаются при запуске
+    index.add(letter_id, letter_text)
+    index.query(letter_text)                 # [(letter_id, сходство)], сначала самые похожие
+    """
+
+    def __init__(self, path=None):
+        self.path = Path(path) if path else None
+        self.signatures = {}
+        self.buckets = {}
+        self._lock = threading.Lock()
+        self.counters = {"letters": 0, "lookups": 0, "candidates": 0}
+        self.lookup_times = []
+        if self.path is not None and self.path.exists():
+            with self.path.open("r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        self._insert(record["letter_id"], np.frombuffer(bytes.fromhex(record["signature"]),
+                                                                        dtype=np.uint32))
+
+    def _insert(self, letter_id, sig):
+        if letter_id in self.signatures:
+            for band in bands(self.signatures[letter_id]):
+                self.buckets.get(band, set()).discard(letter_id)
+        self.signatures[letter_id] = sig
+        for band in bands(sig):
+            self.buckets.setdefault(band, set()).add(letter_id)
+        self.counters["letters"] = len(self.signatures)
+
+    def add(self, letter_id, letter_text):
+        sig = signature(mask(letter_text)[0])
+        with self._lock:
+            if letter_id in self.signatures and np.array_equal(self.signatures[letter_id], sig):
+                return
+            self._insert(letter_id, sig)
+            if self.path is not None:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                with self.path.open("a", encoding="utf-8") as f:
+                    f.write(json.dumps({"letter_id": letter_id, "signature": sig.tobytes().hex()}) + "\n")
+
+    def query(self, letter_text, threshold=None, exclude=None) -> list:
+        threshold = NEAR_DUP_THRESHOLD if threshold is None else threshold
+        started = time.perf_counter()
+        sig = signature(mask(letter_text)[0])
+        with self._lock:
+            candidates = set()
+            for band in bands(sig):
+                candidates.update(self.buckets.get(band, ()))
+            candidates.discard(exclude)
+            scored = [(letter_id, similarity(sig, self.signatures[letter_id])) for letter_id in candidates]
+            matches = sorted((m for m in scored if m[1] >= threshold), key=lambda m: -m[1])
+            self.counters["lookups"] += 1
+            self.counters["candidates"] += len(candidates)
+            self.lookup_times.append(time.perf_counter() - started)
+            self.lookup_times = self.lookup_times[-1000:]
+        return matches
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            times = sorted(self.lookup_times)
+            return {**self.counters,
+                    "lookup_ms_p50": round(times[len(times) // 2] * 1000, 3) if times else None}
+
+
+# ------------------------
+# Перенос результатов
+# ------------------------
+def _person_parts(old, new) -> list:
+    """«Петров А.В.» → «Сидоров Б.Г.»: ещё и по словам, чтобы заменить «А.В.» и фамилию отдельно."""
+    old_words, new_words = old.split(), new.split()
+    if len(old_words) != len(new_words) or len(old_words) < 2:
+        return []
+    return list(zip(old_words, new_words))
+
+
+def entity_mapping(old_text: str, new_text: str):
+    """
+    Замены «сущность прошлого письма → сущность нового» или None, если метки писем
+    не совпадают по порядку (другое число договоров, нет телефона и т.п.).
+    """
+    old_slots, new_slots = find_slots(old_text), find_slots(new_text)
+    if [s[2] for s in old_slots] != [s[2] for s in new_slots]:
+        return None
+    mapping = {}
+    for (_, _, label, old), (_, _, _, new) in zip(old_slots, new_slots):
+        old, new = " ".join(old.split()), " ".join(new.split())
+        if mapping.get(old, new) != new:
+            return None             # одно и то же значение в новом письме стало разными
+        mapping[old] = new
+        if label == "DATE":
+            try:
+                mapping.setdefault(normalize_date(old), normalize_date(new))
+            except (ValueError, KeyError):
+                pass
+        elif label == "PERSON":
+            for old_word, new_word in _person_parts(old, new):
+                mapping.setdefault(old_word, new_word)
+    return {old: new for old, new in mapping.items() if old != new}
+
+
+def substitute(value, mapping: dict):
+    """Заменяет сущности во всех строках результата этапа (целыми словами, за один проход)."""
+    if not mapping:
+        return value
+    pattern = re.compile(r"(?<!\w)(?:" + "|".join(re.escape(k) for k in sorted(mapping, key=len, reverse=True))
+                         + r")(?!\w)")
+
+    def walk(v):
+        if isinstance(v, str):
+            return pattern.sub(lambda m: mapping[m.group(0)], v)
+        if isinstance(v, dict):
+            return {k: walk(item) for k, item in v.items()}
+        if isinstance(v, list):
+            return [walk(item) for item in v]
+        return v
+    return walk(value)
+
+
+def _digits(text: str) -> str:
+    """«+7 (999) 123-45-67» → «+79991234567», «1 500,00» → «150000»: разделители между цифрами убраны."""
+    return DIGIT_SEP_RE.sub("", text)
+
+
+def _strings(value):
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from _strings(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from _strings(item)
+
+
+def leftovers(old_text: str, mapping: dict):
+    """
+    Что от заменённых сущностей прошлого письма не должно остаться в результатах:
+    (значения целиком — числа без разделителей, в нижнем регистре; основы слов ФИО — «Петрову» → «петро»).
+    """
+    values, stems = set(), set()
+    for _, _, label, value in find_slots(old_text):
+        value = " ".join(value.split())
+        if value not in mapping:
+            continue
+        values.add(_digits(value).lower())
+        if label == "DATE":
+            try:
+                values.add(_digits(normalize_date(value)))
+            except (ValueError, KeyError):
+                pass
+        elif label == "PERSON":
+            stems.update(w[:-2].lower() if len(w) > 5 else w.lower() for w in value.split()
+                         if w.isalpha() and len(w) >= 4)
+    return values, stems
+
+
+def leaked(artifacts: dict, old_text: str, mapping: dict) -> bool:
+    """Осталась ли в перенесённых результатах сущность прошлого письма (другой падеж, другая запись числа)."""
+    values, stems = leftovers(old_text, mapping)
+    text = _digits("\n".join(_strings(artifacts))).lower()
+    if any(stem in text for stem in stems):
+        return True
+    return any(re.search(r"(?<!\w)" + re.escape(value) + r"(?!\w)", text) for value in values)
+
+
+def reuse(letter_text: str, previous: dict):
+    """Результаты этапов прошлого письма previous для нового письма или None, если перенести нельзя."""
+    if "letter_text" not in previous or any(name not in previous for name in ARTIFACTS):
+        return None
+    mapping = entity_mapping(previous["letter_text"], letter_text)
+    if mapping is None:
+        return None
+    artifacts = {name: substitute(previous[name], mapping) for name in ARTIFACTS}
+    # имя в другом падеже («Петрову» в письме, «Петров» в ответе) или номер в другой записи
+    # («+7 999 123-45-67» вместо «+7 (999) 123-45-67») не заменились — лучше пересчитать
+    if leaked(artifacts, previous["letter_text"], mapping):
+        return None
+    artifacts["ner"] = merge(extract_rules(letter_text), artifacts["ner"])
+    return artifacts
+
+
+class NearDup:
+    """Индекс + хранилище артефактов: поиск дубликата и перенос его результатов."""
+
+    def __init__(self, index=None):
+        self.index = index if index is not None else NearDupIndex(NEAR_DUP_INDEX)
+        self.reused = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def find(self, letter_text, store, exclude=None):
+        """(letter_id дубликата, сходство, артефакты для нового письма) или None."""
+        for letter_id, score in self.index.query(letter_text, exclude=exclude):
+            artifacts = reuse(letter_text, store.letter(letter_id))
+            with self._lock:
+                if artifacts is None:
+                    self.rejected += 1
+                    continue
+                self.reused += 1
+            return letter_id, score, artifacts
+        return None
+
+    def add(self, letter_id, letter_text):
+        self.index.add(letter_id, letter_text)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self.index.snapshot(), "reused": self.reused, "rejected": self.rejected}
+
+
+_near_dup = None
+_near_dup_lock = threading.Lock()
+
+
+def get_near_dup() -> NearDup:
+    global _near_dup
+    with _near_dup_lock:
+        if _near_dup is None:
+            _near_dup = NearDup()
+        return _near_dup
+
+
+def stats() -> dict:
+    return get_near_dup().stats() if _near_dup is not None else {}
+
+
+# ------------------------
+# CLI
+# ------------------------
+def build(letters_root="letters") -> dict:
+    """Индексирует письма из letters/ с готовыми результатами всех этапов."""
+    near_dup = get_near_dup()
+    added = 0
+    for path in sorted(p for p in Path(letters_root).iterdir() if p.is_dir()):
+        artifacts = read_letter_dir(path)
+        if "letter_text" in artifacts and all(name in artifacts for name in ARTIFACTS):
+            if path.name not in near_dup.index.signatures:
+                near_dup.add(path.name, artifacts["letter_text"])
+                added += 1
+    return {"added": added, "letters": len(near_dup.index.signatures)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Почти одинаковые письма: индекс MinHash/LSH")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_build = sub.add_parser("build", help="проиндексировать готовые письма")
+    p_build.add_argument("--letters", default="letters")
+    p_query = sub.add_parser("query", help="найти похожее письмо")
+    p_query.add_argument("path")
+    p_query.add_argument("--threshold", type=float, default=None)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        print(build(args.letters))
+    else:
+        text = Path(args.path).read_text(encoding="utf-8").strip()
+        print(mask(text)[0])
+        matches = get_near_dup().index.query(text, threshold=args.threshold)
+        if not matches:
+            sys.exit("Похожих писем нет")
+        for letter_id, score in matches[:5]:
+            print(f"{letter_id}\t{score:.2f}")
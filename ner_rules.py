@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+# ner_rules.py
+# Детерминированное извлечение сущностей регулярными выражениями.
+# Покрывает то, что хорошо формализуется: номера договоров, сроки,
+# ссылки на НПА, e-mail и телефоны. ФИО и организации ищутся только по
+# явным шаблонам (Иванов И.И., ПАО «...»), остальное остаётся LLM.
+import re
+
+MONTHS = {
+    "января": 1, "февраля": 2, "марта": 3, "апреля": 4, "мая": 5, "июня": 6,
+    "июля": 7, "августа": 8, "сентября": 9, "октября": 10, "ноября": 11, "декабря": 12,
+}
+
+DATE = r"\d{1,2}\.\d{1,2}\.\d{4}|\d{1,2}\s+(?:" + "|".join(MONTHS) + r")\s+\d{4}"
+
+# -----------------------------
+# Шаблоны
+# -----------------------------
+EMAIL_RE = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)*\.[A-Za-zА-Яа-я]{2,}")
+
+PHONE_RE = re.compile(r"(?<![\d\w])(?:\+7|8)[\s\-]*\(?\d{3,4}\)?[\s\-]*\d{2,3}[\s\-]*\d{2}[\s\-]*\d{2}(?!\d)")
+
+CONTRACT_RE = re.compile(
+    r"(?:договор|соглашени|контракт)\w*"
+    r"(?:\s+[а-яё]+){0,3}?"                       # «кредитного», «банковского обслуживания»
+    r"\s*№\s*([A-Za-zА-ЯЁа-яё0-9][\w./\-]*\w)",
+    re.IGNORECASE,
+)
+
+LAW_REF_RES = [
+    # Указание / Положение / Инструкция Банка России №55-У от 10.04.2024
+    re.compile(
+        r"(?:Указани|Положени|Инструкци|Письм|Предписани)\w*\s+(?:Банка России|ЦБ РФ|ЦБ)"
+        r"\s*(?:от\s+(?:" + DATE + r")\s*)?№\s*[\w\-/]+(?:\s+от\s+(?:" + DATE + r"))?",
+        re.IGNORECASE,
+    ),
+    # Федеральный закон от 02.12.1990 № 395-1 / № 115-ФЗ «О ...»
+    re.compile(
+        r"Федеральн\w+\s+закон\w*\s*(?:от\s+(?:" + DATE + r")\s*)?№\s*\d+(?:-\d+)?(?:-ФЗ)?(?:\s+«[^»]{1,200}»)?",
+        re.IGNORECASE,
+    ),
+    # 115-ФЗ без слов «Федеральный закон»
+    re.compile(r"(?<![\w\-])\d{1,4}-ФЗ\b"),
+    # ст. 395 ГК РФ, статья 16 Закона о защите прав потребителей
+    re.compile(r"(?:ст\.|статьи|статья|статьей|статьёй)\s*\d+(?:\.\d+)?\s+(?:ГК|НК|ТК|КоАП|АПК|ГПК|УК)\s*РФ"),
+    re.compile(r"Закон\w*\s+(?:РФ\s+)?«?о\s+защите\s+прав\s+потребителей»?", re.IGNORECASE),
+]
+
+ABSOLUTE_DEADLINE_RE = re.compile(
+    r"(?:не\s+позднее|не\s+позже|в\s+срок\s+до|срок(?:ом)?\s+до|до)\s+(" + DATE + r")",
+    re.IGNORECASE,
+)
+
+RELATIVE_DEADLINE_RE = re.compile(
+    r"(?:в\s+течени[еи]|в\s+срок|не\s+позднее|в\s+пределах)\s+"
+    r"(?:\d+|одного|двух|трёх|трех|пяти|десяти|тридцати)\s*(?:\(\w+\)\s*)?"
+    r"(?:рабоч\w+\s+|календарн\w+\s+|банковск\w+\s+)?"
+    r"(?:дн\w+|день|час\w*|недел\w+|месяц\w*)"
+    r"(?:\s+(?:с\s+момента|с\s+даты|со\s+дня)\s+[а-яё]+)?",
+    re.IGNORECASE,
+)
+
+PERSON_RES = [
+    re.compile(r"\b[А-ЯЁ][а-яё]+(?:-[А-ЯЁ][а-яё]+)?\s+[А-ЯЁ]\.\s?[А-ЯЁ]\.(?!\w)"),     # Иванов И.И.
+    re.compile(r"(?<![\w.])[А-ЯЁ]\.\s?[А-ЯЁ]\.\s?[А-ЯЁ][а-яё]+(?:-[А-ЯЁ][а-яё]+)?\b"),  # И.И. Иванов
+]
+
+ORGANIZATION_RE = re.compile(
+    r"\b(?:ПАО|ОАО|АО|ЗАО|НАО|ООО|НКО|АНО|ФГУП|ГУП|МУП|ИП|КБ|АКБ)\s+(?:«[^»]{1,120}»|\"[^\"]{1,120}\")"
+)
+
+
+# -----------------------------
+# Вспомогательные функции
+# -----------------------------
+def normalize_date(text: str) -> str:
+    """«20 марта 2023» / «5.3.2023» → «20.03.2023»."""
+    text = " ".join(text.split())
+    if "." in text:
+        d, m, y = text.split(".")
+    else:
+        d, month, y = text.split(" ")
+        m = MONTHS[month.lower()]
+    return f"{int(d):02d}.{int(m):02d}.{y}"
+
+
+def phone_digits(phone: str) -> str:
+    digits = re.sub(r"\D", "", phone)
+    return "7" + digits[1:] if len(digits) == 11 and digits[0] == "8" else digits
+
+
+def unique(items, key=lambda x: x):
+    """Убирает дубликаты, сохраняя порядок."""
+    seen = set()
+    result = []
+    for item in items:
+        k = key(item)
+        if k not in seen:
+            seen.add(k)
+            result.append(item)
+    return result
+
+
+def strip_tail(text: str) -> str:
+    return " ".join(text.split()).rstrip(".,;:")
+
+
+# -----------------------------
+# Извлечение
+# -----------------------------
+def extract_deadlines(text: str) -> list:
+    found = []
+    for m in ABSOLUTE_DEADLINE_RE.finditer(text):
+        found.append((m.start(), {"text": strip_tail(m.group(0)), "date": normalize_date(m.group(1)), "type": "absolute"}))
+    for m in RELATIVE_DEADLINE_RE.finditer(text):
+        found.append((m.start(), {"text": strip_tail(m.group(0)), "date": None, "type": "relative"}))
+    found.sort(key=lambda x: x[0])
+    return unique((d for _, d in found), key=lambda d: (d["text"].lower(), d["date"]))
+
+
+def extract_law_refs(text: str) -> list:
+    spans = []
+    for regex in LAW_REF_RES:
+        for m in regex.finditer(text):
+            spans.append((m.start(), m.end()))
+    # более длинная ссылка поглощает вложенную (115-ФЗ внутри «Федеральный закон ... 115-ФЗ»)
+    spans.sort(key=lambda s: (s[0], -s[1]))
+    refs = []
+    last_end = -1
+    for start, end in spans:
+        if start >= last_end:
+            refs.append(strip_tail(text[start:end]))
+            last_end = end
+    return unique(refs)
+
+
+def extract_rules(text: str) -> dict:
+    """Сущности, найденные правилами, в схеме ner_output.json."""
+    persons = [" ".join(m.group(0).split()) for regex in PERSON_RES for m in regex.finditer(text)]
+    return {
+        "contract_numbers": unique(strip_tail(m.group(1)) for m in CONTRACT_RE.finditer(text)),
+        "deadlines": extract_deadlines(text),
+        "law_refs": extract_law_refs(text),
+        "contacts": {
+            "emails": unique((m.group(0).rstrip(".") for m in EMAIL_RE.finditer(text)), key=str.lower),
+            "phones": unique((strip_tail(m.group(0)) for m in PHONE_RE.finditer(text)), key=phone_digits),
+            "persons": unique(persons),
+        },
+        "organizations": unique(strip_tail(m.group(0)) for m in ORGANIZATION_RE.finditer(text)),
+    }
+
+
+def is_empty(ner: dict) -> bool:
+    """Правила ничего не нашли."""
+    contacts = ner.get("contacts", {})
+    return not any([
+        ner.get("contract_numbers"), ner.get("deadlines"), ner.get("law_refs"),
+        ner.get("organizations"), contacts.get("emails"), contacts.get("phones"), contacts.get("persons"),
+    ])
+
+
+def merge(base: dict, extra: dict) -> dict:
+    """Объединяет два результата NER без дубликатов (base — в приоритете)."""
+    base_contacts = base.get("contacts", {})
+    extra_contacts = extra.get("contacts", {})
+    return {
+        "contract_numbers": unique(base.get("contract_numbers", []) + extra.get("contract_numbers", []),
+                                   key=lambda x: x.lstrip("№ ").lower()),
+        "deadlines": unique(base.get("deadlines", []) + extra.get("deadlines", []),
+                            key=lambda d: (d.get("date") or d.get("text", "").lower())),
+        "law_refs": unique(base.get("law_refs", []) + extra.get("law_refs", []), key=str.lower),
+        "contacts": {
+            "emails": unique(base_contacts.get("emails", []) + extra_contacts.get("emails", []), key=str.lower),
+            "phones": unique(base_contacts.get("phones", []) + extra_contacts.get("phones", []), key=phone_digits),
+            "persons": unique(base_contacts.get("persons", []) + extra_contacts.get("persons", [])),
+        },
+        "organizations": unique(base.get("organizations", []) + extra.get("organizations", []), key=str.lower),
+    }
+
+
+if __name__ == "__main__":
+    import json
+
+    with open("letter.txt", "r", encoding="utf-8") as f:
+        print(json.dumps(extract_rules(f.read()), ensure_ascii=False, indent=2))
@@ -2,24 +2,26 @@
 import os
 import json
 import re
-from dotenv import load_dotenv
-from openai import OpenAI
-
-# -----------------------------
-# Загружаем ключи и проект
-# -----------------------------
-load_dotenv()
-
-folder_id = os.getenv("folder_id")
-api_key   = os.getenv("api_key")
-
-MODEL = f"gpt://{folder_id}/qwen3-235b-a22b-fp8/latest"
-
-client = OpenAI(
-    base_url="https://rest-assistant.api.cloud.yandex.net/v1",
-    api_key=api_key,
-    project=folder_id
-)
+from llm_client import MODEL, get_client
+from json_extract import extract_json
+from prompt_builder import Prompt
+from chunking import split_letter, section_title, chunk_requests, create_all, acreate_all
+from ner_rules import extract_rules, is_empty, merge
+
+# Режим NER:
+#   hybrid — номера договоров, сроки, НПА, e-mail и телефоны ищут правила (ner_rules.py),
+#            ФИО и организации всегда ищет LLM коротким запросом (правила видят только ФИО
+#            с инициалами и названия в кавычках), найденное правилами добавляется к ответу;
+#            если правила ничего не нашли — полный запрос NER;
+#            длинное письмо уходит в LLM фрагментами параллельно (chunking.py);
+#   llm    — всё извлекает LLM (как раньше);
+#   rules  — без обращения к LLM.
+NER_MODE = os.getenv("NER_MODE", "hybrid")
+
+# По этим ключам в ответе модели ищется объект с сущностями
+NER_KEYS = {"contract_numbers", "deadlines", "law_refs", "contacts", "organizations"}
+
+client = get_client("ner")
 
 # -----------------------------
 # ВХОДНОЙ ТЕКСТ
@@ -36,81 +38,32 @@ client = OpenAI(
 # Контактное лицо: Иванов И.И., ПАО «Банк Пример»,
 # e-mail: complaints@bank-prim.ru, телефон: +7 (495) 123-45-67.
 # """
-# Загрузка текста письма
-with open("letter.txt", "r", encoding="utf-8") as f:
-    letter_text = f.read().strip()
-
 # -----------------------------
-# PROMPT (system + user)
+# PROMPT
 # -----------------------------
-system_prompt = (
+NER_PROMPT = Prompt(
     "Ты — нейросетевая модель для извлечения структурированной информации (NER) "
     "из деловой переписки на русском языке.\n\n"
     "Твоя задача — по тексту письма вернуть JSON с полями:\n"
     "- contract_numbers: список строк с номерами договоров/соглашений.\n"
-    "- deadlines: список объектов { \"text\": ..., \"date\": ..., \"type\": ... }.\n"
+    "- deadlines: список объектов { \"text\": ..., \"date\": ... или null, \"type\": \"relative\" или \"absolute\" }.\n"
     "- law_refs: список строк с упоминаниями нормативных актов.\n"
     "- contacts: объект { \"emails\": [...], \"phones\": [...], \"persons\": [...] }.\n"
     "- organizations: список строк с названиями организаций.\n\n"
     "Требования:\n"
     "- Если информации нет — верни пустые поля.\n"
     "- Ничего не придумывай.\n"
-    "- Ответ ДОЛЖЕН быть валидным JSON без комментариев."
+    "- Ответ ДОЛЖЕН быть валидным JSON без комментариев и текста вне JSON."
 )
 
-user_prompt = (
-    "Текст письма:\n\n"
-    f"\"\"\"{letter_text}\"\"\"\n\n"
-    "Верни строго JSON:\n\n"
-    "{\n"
-    "  \"contract_numbers\": [ \"...\" ],\n"
-    "  \"deadlines\": [\n"
-    "    {\n"
-    "      \"text\": \"...\",\n"
-    "      \"date\": \"... или null\",\n"
-    "      \"type\": \"relative или absolute\"\n"
-    "    }\n"
-    "  ],\n"
-    "  \"law_refs\": [ \"...\" ],\n"
-    "  \"contacts\": {\n"
-    "    \"emails\": [ \"...\" ],\n"
-    "    \"phones\": [ \"...\" ],\n"
-    "    \"persons\": [ \"...\" ]\n"
-    "  },\n"
-    "  \"organizations\": [ \"...\" ]\n"
-    "}\n\n"
-    "Никакого текста вне JSON."
-)
 
-# -----------------------------
-# ВЫЗОВ YANDEX CLOUD LLM
-# -----------------------------
-response = client.responses.create(
-    model=MODEL,
-    input=[{"role": "system", "content": system_prompt},
-           {"role": "user",   "content": user_prompt}],
-    max_output_tokens=700,
-    temperature=0.0
+# Короткий запрос для гибридного режима: только то, что правила не умеют
+ENTITIES_PROMPT = Prompt(
+    "Ты извлекаешь из деловой переписки на русском языке ФИО людей и названия организаций.\n"
+    "Верни строго JSON: { \"contacts\": { \"persons\": [...] }, \"organizations\": [...] }.\n"
+    "Ничего не придумывай; если информации нет — верни пустые списки. Никакого текста вне JSON."
 )
 
-raw = response.output_text.strip()
-
-# -----------------------------
-# ВЫРЕЗАЕМ JSON
-# -----------------------------
-if raw.startswith("```"):
-    raw = raw.strip("`")
-    if raw.startswith("json"):
-        raw = raw[4:].strip()
-
-start = raw.find("{")
-end = raw.rfind("}")
-if start != -1 and end != -1:
-    raw_json = raw[start:end+1]
-else:
-    raw_json = raw
-
-data = json.loads(raw_json)
 
 # -----------------------------
 # НОРМАЛИЗАЦИЯ ПОЛЕЙ
@@ -121,41 +74,147 @@ def safe_list(x):
 def safe_obj(x):
     return x if isinstance(x, dict) else {}
 
-contract_numbers = safe_list(data.get("contract_numbers"))
-law_refs         = safe_list(data.get("law_refs"))
-organizations    = safe_list(data.get("organizations"))
-contacts         = safe_obj(data.get("contacts"))
-deadlines_raw    = safe_list(data.get("deadlines"))
-
-emails  = safe_list(contacts.get("emails"))
-phones  = safe_list(contacts.get("phones"))
-persons = safe_list(contacts.get("persons"))
-
-deadlines = []
-for d in deadlines_raw:
-    if isinstance(d, dict):
-        deadlines.append({
-            "text": str(d.get("text", "")),
-            "date": d.get("date", None),
-            "type": str(d.get("type", ""))
-        })
-
-result = {
-    "contract_numbers": [str(x) for x in contract_numbers],
-    "deadlines": deadlines,
-    "law_refs": [str(x) for x in law_refs],
-    "contacts": {
-        "emails": [str(x) for x in emails],
-        "phones": [str(x) for x in phones],
-        "persons": [str(x) for x in persons],
-    },
-    "organizations": [str(x) for x in organizations],
-}
+
+def normalize_ner(data: dict) -> dict:
+    """Приводит ответ модели к фиксированной схеме ner_output.json."""
+    contract_numbers = safe_list(data.get("contract_numbers"))
+    law_refs         = safe_list(data.get("law_refs"))
+    organizations    = safe_list(data.get("organizations"))
+    contacts         = safe_obj(data.get("contacts"))
+    deadlines_raw    = safe_list(data.get("deadlines"))
+
+    emails  = safe_list(contacts.get("emails"))
+    phones  = safe_list(contacts.get("phones"))
+    persons = safe_list(contacts.get("persons"))
+
+    deadlines = []
+    for d in deadlines_raw:
+        if isinstance(d, dict):
+            deadlines.append({
+                "text": str(d.get("text", "")),
+                "date": d.get("date", None),
+                "type": str(d.get("type", ""))
+            })
+
+    return {
+        "contract_numbers": [str(x) for x in contract_numbers],
+        "deadlines": deadlines,
+        "law_refs": [str(x) for x in law_refs],
+        "contacts": {
+            "emails": [str(x) for x in emails],
+            "phones": [str(x) for x in phones],
+            "persons": [str(x) for x in persons],
+        },
+        "organizations": [str(x) for x in organizations],
+    }
+
 
 # -----------------------------
-# СОХРАНЯЕМ В JSON ФАЙЛ
+# ОСНОВНАЯ ФУНКЦИЯ
 # -----------------------------
-with open("ner_output.json", "w", encoding="utf-8") as f:
-    json.dump(result, f, ensure_ascii=False, indent=2)
+def build_request(letter_text: str, part=None) -> dict:
+    """Запрос NER: инструкции и схема ответа, затем письмо (или его фрагмент part=(i, n))."""
+    return {
+        "model": MODEL,
+        **NER_PROMPT.render((section_title(part), letter_text)),
+        "max_output_tokens": 700,
+        "temperature": 0.0,
+    }
+
+
+def build_entities_request(letter_text: str, part=None) -> dict:
+    """Запрос только за persons / organizations."""
+    return {
+        "model": MODEL,
+        **ENTITIES_PROMPT.render((section_title(part), letter_text)),
+        "max_output_tokens": 200,
+        "temperature": 0.0,
+    }
+
+
+def plan_builder(rules: dict, mode: str):
+    """
+    Какой запрос к LLM нужен после правил: build_request (правила ничего не нашли),
+    build_entities_request (ФИО / организации) или None (NER_MODE=rules).
+    """
+    if mode == "rules":
+        return None
+    if is_empty(rules):
+        return build_request
+    return build_entities_request
+
+
+def plan_request(letter_text: str, rules: dict, mode: str):
+    """Какой запрос к LLM нужен после правил (None — не нужен)."""
+    build = plan_builder(rules, mode)
+    return build(letter_text) if build is not None else None
+
+
+def merge_output(rules: dict, raw: str) -> dict:
+    """Дополняет найденное правилами ответом LLM; битый JSON не роняет этап."""
+    try:
+        return merge(rules, parse_output(raw))
+    except ValueError:
+        return rules
+
+
+def parse_output(raw: str) -> dict:
+    """Вырезает JSON из ответа модели и приводит его к схеме ner_output.json."""
+    data = extract_json(raw, keys=NER_KEYS)
+    if data is None:
+        raise ValueError("в ответе NER нет JSON с сущностями")
+
+    return normalize_ner(data)
+
+
+def merge_chunks(base: dict, raws: list) -> dict:
+    """Ответы по фрагментам длинного письма сводятся в один результат без дубликатов."""
+    for raw in raws:
+        base = merge_output(base, raw)
+    return base
+
+
+def run_ner(letter_text: str, mode=None) -> dict:
+    """Извлекает сущности из письма и возвращает словарь в схеме ner_output.json."""
+    mode = mode or NER_MODE
+    chunks = split_letter(letter_text)
+    if mode == "llm":
+        raws = create_all(client, chunk_requests(build_request, chunks))
+        return parse_output(raws[0]) if len(raws) == 1 else merge_chunks(normalize_ner({}), raws)
+
+    rules = extract_rules(letter_text)
+    build = plan_builder(rules, mode)
+    if build is None:
+        return rules
+    return merge_chunks(rules, create_all(client, chunk_requests(build, chunks)))
+
+
+async def arun(call, letter_text: str, mode=None) -> dict:
+    """run_ner для пакетного режима: call(request) — корутина, возвращающая output_text."""
+    mode = mode or NER_MODE
+    chunks = split_letter(letter_text)
+    if mode == "llm":
+        raws = await acreate_all(call, chunk_requests(build_request, chunks))
+        return parse_output(raws[0]) if len(raws) == 1 else merge_chunks(normalize_ner({}), raws)
+
+    rules = extract_rules(letter_text)
+    build = plan_builder(rules, mode)
+    if build is None:
+        return rules
+    return merge_chunks(rules, await acreate_all(call, chunk_requests(build, chunks)))
+
+
+# -----------------------------
+# ЗАПУСК КАК СКРИПТА
+# -----------------------------
+if __name__ == "__main__":
+    # Загрузка текста письма
+    with open("letter.txt", "r", encoding="utf-8") as f:
+        letter_text = f.read().strip()
+
+    result = run_ner(letter_text)
+
+    with open("ner_output.json", "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
 
-print("Файл сохранён → ner_output.json")
\ No newline at end of file
+    print("Файл сохранён → ner_output.json")
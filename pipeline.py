@@ -1,95 +1,179 @@
 # pipeline.py
+import os
+import sys
 import json
-import subprocess
+import argparse
+from functools import partial
+
+# Этапы импортируются как функции: один процесс, один load_dotenv()
+# и один пул соединений (llm_client.py) вместо отдельного интерпретатора на каждое письмо.
+from ner_yandex import run_ner
+from app_final_yandex import classify_letter
+from llm1_yandex import run_llm1
+from rag1_yandex import run_rag1
+from llm2_yandex import run_llm2
+from rag2_yandex import run_rag2
+from llm3_yandex import run_llm3
+from analysis_yandex import run_analysis
+from scheduler import Stage, run_graph, format_report
+from artifact_store import ArtifactStore, make_letter_id
+from stage_memo import StageMemo, KEYS_ARTIFACT, downstream
+from llm_cache import cache
+import near_dup
+import answer_templates
+import llm_retry
+import rate_limiter
+import prompt_builder
+import metrics
 
 
-def run_script(script_name):
-    """Запускает Python-скрипт как отдельный процесс."""
-    print(f"Запуск: {script_name}")
-    subprocess.run(["python", script_name], check=True)
-
-
-def pipeline(letter_text: str):
-    """Полный пайплайн: письмо → NER → Classifier → LLM1 → LLM2 → LLM3."""
+# ---------------------------------------------------------
+# Граф этапов: входы → выход
+# ---------------------------------------------------------
+# NER, классификатор и LLM1 читают только текст письма и выполняются
+# параллельно; остальные этапы стартуют, как только готовы их входы.
+STAGES = [
+    Stage("NER",        run_ner,         ("letter_text",),                                    "ner"),
+    Stage("Classifier", classify_letter, ("letter_text",),                                    "classification"),
+    Stage("LLM1",       run_llm1,        ("letter_text",),                                    "llm1"),
+    Stage("RAG1",       run_rag1,        ("letter_text", "ner", "classification", "llm1"),    "rag_docs"),
+    Stage("LLM2",       run_llm2,        ("letter_text", "ner", "classification", "llm1"),    "llm2"),
+    Stage("RAG2",       run_rag2,        ("letter_text", "rag_docs", "llm2"),                 "rag_usage"),
+    Stage("LLM3",       run_llm3,        ("llm2",),                                           "llm3"),
+]
+
+# Объединённый режим: NER, классификатор и LLM1 — один запрос к модели
+FUSED_STAGES = [
+    Stage("Analysis",   run_analysis,    ("letter_text",),                    ("ner", "classification", "llm1")),
+] + STAGES[3:]
+
+# ANALYSIS_MODE=fused включает объединённый этап анализа по умолчанию
+ANALYSIS_MODE = os.getenv("ANALYSIS_MODE", "separate")
+
+
+# Этапы, умеющие отдавать ответы по стилям по мере генерации (on_partial)
+STREAMING_STAGES = ("LLM2", "LLM3")
+
+
+def get_stages(fused=None):
+    if fused is None:
+        fused = ANALYSIS_MODE == "fused"
+    return FUSED_STAGES if fused else STAGES
+
+
+def bind_events(stages, on_event):
+    """
+    Включает потоковый режим LLM2/LLM3: каждый готовый стиль ответа
+    отправляется в on_event как {"type": "partial", "stage", "section", "style", "value"}.
+    """
+    bound = []
+    for stage in stages:
+        if stage.name in STREAMING_STAGES:
+            def on_partial(section, style, value, stage_name=stage.name):
+                on_event({"type": "partial", "stage": stage_name,
+                          "section": section, "style": style, "value": value})
+            stage = Stage(stage.name, partial(stage.func, on_partial=on_partial), stage.inputs, stage.output)
+        bound.append(stage)
+    return bound
+
+# Хранилище по умолчанию: в памяти + папка letters/<letter_id>/
+default_store = ArtifactStore(root="letters")
+
+
+def pipeline(letter_text: str, letter_id=None, store=None, max_workers=None, fused=None, on_event=None,
+             from_stage=None):
+    """
+    Полный пайплайн: письмо → (NER | Classifier | LLM1) → RAG1/LLM2 → RAG2/LLM3.
+
+    Результаты этапов передаются в памяти и складываются в store под ключом
+    letter_id (по умолчанию — хеш текста письма), поэтому несколько писем
+    можно обрабатывать одновременно.
+
+    fused=True — NER, классификатор и LLM1 одним запросом (analysis_yandex.py).
+
+    on_event(event) — подписка на ход обработки (для UI): {"type": "stage_done", ...}
+    по каждому этапу и {"type": "partial", ...} по каждому готовому стилю LLM2/LLM3.
+    Во всех событиях есть letter_id; вызывается в т.ч. из рабочих потоков.
+
+    Повторный запуск того же letter_id пересчитывает только этапы, входы которых изменились
+    (stage_memo.py); остальные результаты берутся из store. from_stage="RAG1" — перезапустить
+    этап и всё, что от него зависит, from_stage="all" — весь граф.
+
+    Новое письмо, почти совпадающее с уже обработанным (near_dup.py), получает его результаты
+    с подставленными сущностями, без вызовов LLM.
+    """
+    letter_text = letter_text.strip()
+    letter_id = letter_id or make_letter_id(letter_text)
+    store = store or default_store
+    stages = get_stages(fused)
+    if on_event is not None:
+        emit = lambda event: on_event({"letter_id": letter_id, **event})
+        stages = bind_events(stages, emit)
+    memo = StageMemo(store.letter(letter_id), force=downstream(stages, from_stage))
+    stages = metrics.instrument(memo.wrap(stages), letter_id)
 
     # ---------------------------------------------------------
     # 1. Сохраняем письмо
     # ---------------------------------------------------------
-    with open("letter.txt", "w", encoding="utf-8") as f:
-        f.write(letter_text.strip())
-
-    print("Письмо сохранено в letter.txt")
-
-    # ---------------------------------------------------------
-    # 2. Запуск NER
-    # ---------------------------------------------------------
-    run_script("ner_yandex.py")
-
-    with open("ner_output.json", "r", encoding="utf-8") as f:
-        ner_result = json.load(f)
-
-    # ---------------------------------------------------------
-    # 3. Запуск классификатора
-    # ---------------------------------------------------------
-    run_script("app_final_yandex.py")
-
-    with open("classification_output.json", "r", encoding="utf-8") as f:
-        classifier_result = json.load(f)
-
-    # ---------------------------------------------------------
-    # 4. Запуск LLM1 (извлечение сути)
-    # ---------------------------------------------------------
-    run_script("llm1_yandex.py")
-
-    with open("llm1_output.json", "r", encoding="utf-8") as f:
-        llm1_result = json.load(f)
-
-    # ---------------------------------------------------------
-    # 5. Запуск RAG1 (подбор валидных и рекомендованных документов)
-    # ---------------------------------------------------------
-    run_script("rag1_yandex.py")
-
-    with open("rag_docs_output.json", "r", encoding="utf-8") as f:
-        rag_docs_result = json.load(f)
-
-    # ---------------------------------------------------------
-    # 6. Запуск LLM2 (генерация 4 ответов)
-    # ---------------------------------------------------------
-    # В llm2_yandex.py ты уже читаешь:
-    # - letter.txt
-    # - ner_output.json
-    # - classification_output.json
-    # - llm1_output.json
-    # + ДОБАВИШЬ чтение rag_docs_output.json
-    run_script("llm2_yandex.py")
-
-    with open("llm2_output.json", "r", encoding="utf-8") as f:
-        llm2_result = json.load(f)
-
-    # ---------------------------------------------------------
-    # 7. Запуск RAG2 (анализ использования документов в ответах LLM2)
-    # ---------------------------------------------------------
-    run_script("rag2_yandex.py")
-
-    with open("rag_usage_output.json", "r", encoding="utf-8") as f:
-        rag_usage_result = json.load(f)
-
-    # ---------------------------------------------------------
-    # 8. Запуск LLM3 (комплаенс-проверка)
-    # ---------------------------------------------------------
-    # В llm3_yandex.py нужно читать:
-    # - llm2_output.json  (черновики ответов)
-    # - rag_docs_output.json  (какие документы рекомендовались)
-    # - rag_usage_output.json (как они были использованы)
-    run_script("llm3_yandex.py")
-
-    with open("llm3_output.json", "r", encoding="utf-8") as f:
-        llm3_result = json.load(f)
+    store.put(letter_id, "letter_text", letter_text)
+
+    print(f"Письмо {letter_id} принято")
+
+    # ---------------------------------------------------------
+    # 2. Почти такое же письмо уже обработано — переносим его результаты
+    # ---------------------------------------------------------
+    if near_dup.NEAR_DUP and from_stage is None and not memo.keys:
+        with metrics.stage_scope(letter_id, "near_dup"):
+            found = near_dup.get_near_dup().find(letter_text, store, exclude=letter_id)
+        if found is not None:
+            source_id, score, reused = found
+            print(f"Почти такое же письмо {source_id} (сходство {score:.2f}): результаты перенесены")
+            for name, value in reused.items():
+                store.put(letter_id, name, value)
+            if on_event is not None:
+                for stage in stages:
+                    emit({"type": "stage_done", "stage": stage.name, "artifacts": list(stage.outputs),
+                          "near_duplicate_of": source_id})
+            return reused["llm3"]
+
+    # ---------------------------------------------------------
+    # 3. Выполняем граф этапов
+    # ---------------------------------------------------------
+    def on_stage_done(stage, result):
+        if stage.name in memo.reused:
+            print(f"Этап без изменений: {stage.name}")
+        else:
+            print(f"Этап завершён: {stage.name}")
+            for name, value in stage.artifacts(result):
+                store.put(letter_id, name, value)
+            memo.commit(stage.name)
+            store.put(letter_id, KEYS_ARTIFACT, memo.snapshot())
+        if on_event is not None:
+            emit({"type": "stage_done", "stage": stage.name, "artifacts": list(stage.outputs)})
+
+    artifacts, timings = run_graph(
+        stages,
+        {"letter_text": letter_text},
+        max_workers=max_workers,
+        on_stage_done=on_stage_done,
+    )
+    if near_dup.NEAR_DUP:
+        near_dup.get_near_dup().add(letter_id, letter_text)
+    answer_templates.offer(letter_id, artifacts)
 
     print("\nПайплайн завершён!")
-    print("Финальный результат находится в llm3_output.json")
+    print(format_report(stages, timings))
+    print(f"Пересчитано этапов: {len(stages) - len(memo.reused)} из {len(stages)}"
+          + (f", без изменений: {', '.join(s.name for s in stages if s.name in memo.reused)}" if memo.reused else ""))
+    print(f"Кэш LLM: {cache.stats()}")
+    print(f"Вызовы LLM (повторы, хеджи, задержки): {llm_retry.stats()}")
+    print(f"Лимитер LLM: {rate_limiter.stats()}")
+    print(f"Промпты (токенов на запрос: префикс / данные, факт, доля кэша): {prompt_builder.stats()}")
+    print(f"Почти одинаковые письма: {near_dup.stats()}")
+    print(f"Шаблоны ответов: {answer_templates.stats()}")
+    metrics.write_prometheus()
 
-    return llm3_result
+    return artifacts["llm3"]
 
 
 
@@ -97,12 +181,23 @@ def pipeline(letter_text: str):
 # Пример использования
 # ---------------------------------------------------------
 if __name__ == "__main__":
-
-    with open('tt.txt', 'r', encoding='utf-8') as file:
-        test_letter = file.read()
-    # Теперь переменная content содержит весь текст из файла
+    parser = argparse.ArgumentParser(description="Пайплайн для одного письма")
+    parser.add_argument("path", nargs="?", help="файл с письмом (по умолчанию tt.txt, с --letter — letters/<id>/letter.txt)")
+    parser.add_argument("--letter", help="id письма в letters/: пересчитать только этапы, входы которых изменились")
+    parser.add_argument("--from-stage", help="перезапустить этап и все зависящие от него (all — весь граф)")
+    args = parser.parse_args()
+
+    if args.path or not args.letter:
+        with open(args.path or "tt.txt", "r", encoding="utf-8") as file:
+            test_letter = file.read()
+    else:
+        test_letter = default_store.get(args.letter, "letter_text")
+        if not test_letter:
+            sys.exit(f"Нет письма letters/{args.letter}/letter.txt")
     print(test_letter)
 
-    result = pipeline(test_letter)
+    letter_id = args.letter or make_letter_id(test_letter.strip())
+    result = pipeline(test_letter, letter_id=letter_id, from_stage=args.from_stage)
     print("\n=== Финальный ответ LLM3 ===")
-    print(json.dumps(result, ensure_ascii=False, indent=2))
\ No newline at end of file
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    print(f"Артефакты письма: letters/{letter_id}/ (UI: python build_ui_payload.py --letter {letter_id})")
@@ -0,0 +1,204 @@
+# prompt_builder.py
+# Сборка промптов этапов и локальный подсчёт токенов.
+#
+# Промпт делится на две части:
+#   - instructions — роль, правила и формат ответа этапа. Текст одинаков для всех писем, поэтому
+#     провайдер может закэшировать этот префикс (cached_tokens в usage);
+#   - input — данные письма (текст, результаты прошлых этапов) в конце, JSON без отступов,
+#     без null и пустых списков.
+# Раньше данные шли вперемешку с инструкциями, а схема ответа в LLM2 / LLM3 повторялась дважды.
+#
+# Токены считаются локально до отправки, по правилам токенизатора Qwen3: слово — примерно
+# LLM_CHARS_PER_TOKEN символов на токен (латиница — 4), каждая цифра и знак — отдельный токен,
+# серия пробелов или переводов строк — один токен. Оценка сверяется с usage ответа:
+# stats() показывает по этапам размер неизменной части и данных, фактические и кэшированные токены.
+#
+#   python prompt_builder.py letter.txt     # размер промптов этапов для письма, без запросов к API
+import os
+import re
+import sys
+import json
+import math
+import threading
+
+CHARS_PER_TOKEN       = float(os.getenv("LLM_CHARS_PER_TOKEN", 3))
+LATIN_CHARS_PER_TOKEN = 4.0
+
+_TOKEN_RE = re.compile(r"[^\W\d_]+|\d|\s{2,}|\n|[^\w\s]|_")
+
+
+# ------------------------
+# Подсчёт токенов
+# ------------------------
+def count_tokens(text) -> int:
+    """Оценка числа токенов строки (или списка сообщений / словаря со строками)."""
+    if isinstance(text, dict):
+        return sum(count_tokens(v) for v in text.values())
+    if isinstance(text, (list, tuple)):
+        return sum(count_tokens(v) for v in text)
+    if not isinstance(text, str):
+        return 0
+    tokens = 0
+    for piece in _TOKEN_RE.findall(text):
+        if piece[0].isalpha():
+            per_token = LATIN_CHARS_PER_TOKEN if piece.isascii() else CHARS_PER_TOKEN
+            tokens += math.ceil(len(piece) / per_token)
+        else:
+            tokens += 1
+    return tokens
+
+
+def request_tokens(request: dict) -> tuple:
+    """(токены instructions, токены input) запроса к responses API."""
+    return count_tokens(request.get("instructions")), count_tokens(request.get("input"))
+
+
+# ------------------------
+# Сборка промпта
+# ------------------------
+def _prune(value):
+    """Убирает None, пустые списки и словари (пустые строки остаются: пустой черновик — тоже данные)."""
+    if isinstance(value, dict):
+        pruned = {k: _prune(v) for k, v in value.items()}
+        return {k: v for k, v in pruned.items() if v is not None and v != [] and v != {}}
+    if isinstance(value, list):
+        return [v for v in (_prune(v) for v in value) if v is not None and v != [] and v != {}]
+    return value
+
+
+def compact_json(value, prune=True) -> str:
+    """JSON в одну строку без пробелов после разделителей."""
+    return json.dumps(_prune(value) if prune else value, ensure_ascii=False, separators=(",", ":"))
+
+
+def render_sections(sections) -> str:
+    """[(заголовок, значение), ...] → «=== ЗАГОЛОВОК ===» и значение; словари и списки — compact_json."""
+    parts = []
+    for title, value in sections:
+        if not isinstance(value, str):
+            value = compact_json(value)
+        parts.append(f"=== {title} ===\n{value.strip()}")
+    return "\n\n".join(parts)
+
+
+class Prompt:
+    """Неизменная часть промпта этапа; данные письма подставляет render()."""
+
+    def __init__(self, instructions: str):
+        self.instructions = instructions.strip()
+
+    def render(self, *sections) -> dict:
+        """Поля instructions и input для client.responses.create."""
+        return {"instructions": self.instructions, "input": render_sections(sections)}
+
+
+# ------------------------
+# Учёт по этапам
+# ------------------------
+class PromptStats:
+    def __init__(self):
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def _stage(self, stage):
+        return self.stages.setdefault(stage or "default", {
+            "requests": 0, "prefix_tokens": 0, "data_tokens": 0,
+            "responses": 0, "estimated": 0, "input_tokens": 0, "cached_tokens": 0,
+        })
+
+    def request(self, stage, request: dict) -> int:
+        """Учитывает запрос до отправки; возвращает оценку токенов промпта."""
+        prefix, data = request_tokens(request)
+        with self._lock:
+            s = self._stage(stage)
+            s["requests"] += 1
+            s["prefix_tokens"] += prefix
+            s["data_tokens"] += data
+        return prefix + data
+
+    def usage(self, stage, estimated, response):
+        """Сверяет оценку с usage ответа (ответы без usage не учитываются)."""
+        usage = getattr(response, "usage", None)
+        input_tokens = getattr(usage, "input_tokens", None) if usage is not None else None
+        if not input_tokens:
+            return
+        details = getattr(usage, "input_tokens_details", None)
+        with self._lock:
+            s = self._stage(stage)
+            s["responses"] += 1
+            s["estimated"] += estimated
+            s["input_tokens"] += input_tokens
+            s["cached_tokens"] += getattr(details, "cached_tokens", 0) or 0
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            result = {}
+            for stage, s in self.stages.items():
+                n, m = s["requests"], s["responses"]
+                result[stage] = {
+                    "requests": n,
+                    "prefix_tokens": round(s["prefix_tokens"] / n) if n else 0,
+                    "data_tokens": round(s["data_tokens"] / n) if n else 0,
+                    "input_tokens": round(s["input_tokens"] / m) if m else None,
+                    "estimate_ratio": round(s["input_tokens"] / s["estimated"], 2) if s["estimated"] else None,
+                    "cached_share": round(s["cached_tokens"] / s["input_tokens"], 2) if s["input_tokens"] else None,
+                }
+            return result
+
+
+# Один учёт на процесс (как llm_retry.stats / rate_limiter.stats)
+prompt_stats = PromptStats()
+
+
+def stats() -> dict:
+    return prompt_stats.snapshot()
+
+
+# ------------------------
+# Размер промптов этапов для письма
+# ------------------------
+def stage_requests(letter_text: str) -> dict:
+    """Запросы всех LLM-этапов для письма; результаты прошлых этапов — значения по умолчанию."""
+    import ner_yandex
+    import app_final_yandex
+    import llm1_yandex
+    import analysis_yandex
+    import rag1_yandex
+    import rag2_yandex
+    import llm2_yandex
+    import llm3_yandex
+
+    ner = ner_yandex.normalize_ner({})
+    classification = dict(app_final_yandex.DEFAULT_CLASSIFICATION)
+    llm1 = llm1_yandex.parse_output("")
+    docs = rag1_yandex.parse_output("")
+    answers = {"answers": {style: letter_text[:1500] for style in llm2_yandex.STYLES}}
+    return {
+        "ner": ner_yandex.build_request(letter_text),
+        "ner_entities": ner_yandex.build_entities_request(letter_text),
+        "classifier": app_final_yandex.build_request(letter_text),
+        "llm1": llm1_yandex.build_request(letter_text),
+        "analysis": analysis_yandex.build_request(letter_text),
+        "rag1": rag1_yandex.build_request(letter_text, ner, classification, llm1),
+        "llm2": llm2_yandex.build_request(letter_text, ner, classification, llm1),
+        "llm2_style": llm2_yandex.build_style_request("official", letter_text, ner, classification, llm1),
+        "llm2_adapt": llm2_yandex.build_adapt_request(answers, letter_text, ner, classification, llm1),
+        "rag2": rag2_yandex.build_request(letter_text, docs, answers),
+        "llm3": llm3_yandex.build_request(answers),
+        "llm3_style": llm3_yandex.build_style_request("official", answers["answers"]["official"]),
+    }
+
+
+if __name__ == "__main__":
+    # запросов к API нет, ключи нужны только чтобы импортировать модули этапов
+    os.environ.setdefault("api_key", "-")
+    os.environ.setdefault("folder_id", "-")
+    path = sys.argv[1] if len(sys.argv) > 1 else "letter.txt"
+    with open(path, "r", encoding="utf-8") as f:
+        letter = f.read().strip()
+
+    print(f"{'этап':<14}{'префикс':>9}{'данные':>9}{'всего':>8}{'символов':>10}")
+    for stage, request in stage_requests(letter).items():
+        prefix, data = request_tokens(request)
+        chars = len(request.get("instructions") or "") + len(request.get("input") or "")
+        print(f"{stage:<14}{prefix:>9}{data:>9}{prefix + data:>8}{chars:>10}")
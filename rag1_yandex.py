@@ -1,53 +1,27 @@
 import os
 import json
-import re
-from dotenv import load_dotenv
-from openai import OpenAI
+from llm_cache import cache
+from llm_client import MODEL, get_client
+from json_extract import extract_json
+from prompt_builder import Prompt
+from chunking import condense
+import metrics
+import doc_index
+import vector_store
 
-# ------------------------
-# Загружаем API ключи
-# ------------------------
-load_dotenv()
-
-folder_id = os.getenv("folder_id")
-api_key   = os.getenv("api_key")
+# Режим RAG1:
+#   index — поиск по локальному BM25-индексу документов (doc_index.py), без LLM;
+#   vector — семантический поиск по векторному хранилищу документов и прошлых писем (vector_store.py);
+#   llm   — модель описывает типы документов (как раньше);
+#   auto  — index, если есть корпус документов (DOCS_DIR), иначе llm.
+RAG1_MODE = os.getenv("RAG1_MODE", "auto")
 
-MODEL = f"gpt://{folder_id}/qwen3-235b-a22b-fp8/latest"
-
-client = OpenAI(
-    base_url="https://rest-assistant.api.cloud.yandex.net/v1",
-    api_key=api_key,
-    project=folder_id
-)
-
-# ------------------------
-# Входные данные
-# ------------------------
-
-# Текст письма
-with open("letter.txt", "r", encoding="utf-8") as f:
-    letter_text = f.read().strip()
-
-# NER
-with open("ner_output.json", "r", encoding="utf-8") as f:
-    ner_result = json.load(f)
-
-# Классификатор
-with open("classification_output.json", "r", encoding="utf-8") as f:
-    classifier_result = json.load(f)
-
-# LLM1 (core_request / requirements / expectations)
-with open("llm1_output.json", "r", encoding="utf-8") as f:
-    llm1_result = json.load(f)
-
-ner_json        = json.dumps(ner_result, ensure_ascii=False, indent=2)
-classifier_json = json.dumps(classifier_result, ensure_ascii=False, indent=2)
-llm1_json       = json.dumps(llm1_result, ensure_ascii=False, indent=2)
+client = get_client("rag1")
 
 # ------------------------
 # PROMPT: подбор документов
 # ------------------------
-prompt = f"""
+RAG1_PROMPT = Prompt("""
 Ты — эксперт по внутренним документам крупного банка (регламенты, методики, НПА, шаблоны писем, кейсы переписки).
 
 ТВОЯ ЗАДАЧА:
@@ -62,134 +36,142 @@ prompt = f"""
 - Вместо этого ты описываешь документы ТИПАМИ и ЧЕЛОВЕЧЕСКИ-ПОНЯТНЫМИ ОБОЗНАЧЕНИЯМИ, чтобы их потом можно было сопоставить с реальными документами в системе Банка.
 - НЕ нужно выдумывать конкретные номера указаний, приказов и т.п., если их нет во входных данных. Если номер/название НПА есть во входных данных (NER.law_refs), можно его использовать.
 
+ВХОДНЫЕ ДАННЫЕ (после инструкций; пустые поля опущены):
+- ТЕКСТ ПИСЬМА.
+- NER: contract_numbers (номера договоров), deadlines (сроки), law_refs (ссылки на НПА), contacts, organizations.
+- КЛАССИФИКАТОР: type (тип письма), urgency (срочность), formality, departments (вовлечённые подразделения),
+  legal_risk (есть/нет юридический риск).
+- LLM1: core_request (суть запроса), requirements (что требует автор), expectations (чего он ожидает).
+
 ФОРМАТ ВЫВОДА:
 Верни ОДИН валидный JSON вида:
 
-{{
+{
   "valid_docs": [
-    {{
+    {
       "code": "string, короткий код документа (например, 'POLICY_COMPLAINTS', 'LAW_FROM_LETTER')",
       "kind": "law | policy | methodology | standard | guideline",
       "name": "человеко-понятное название документа",
       "reason": "зачем этот документ нужен для ответа на данное письмо",
       "priority": "high | medium | low"
-    }}
+    }
   ],
   "recommended_docs": [
-    {{
+    {
       "code": "string, короткий код (например, 'TPL_COMPLAINT_REFUND', 'CASE_SIMILAR_COMPLAINT')",
       "kind": "template | case | faq | playbook | example",
       "name": "человеко-понятное название/тип материала",
       "reason": "как это поможет сформировать ответ",
       "priority": "high | medium | low"
-    }}
+    }
   ]
-}}
+}
 
 Никакого другого текста, комментариев или Markdown добавлять нельзя.
+""")
+
+
+def build_request(letter_text: str, ner_result: dict, classifier_result: dict, llm1_result: dict) -> dict:
+    """Промпт RAG1: инструкции, затем письмо и результаты NER, классификатора и LLM1."""
+    return {
+        "model": MODEL,
+        **RAG1_PROMPT.render(
+            ("ТЕКСТ ПИСЬМА", condense(letter_text)),
+            ("NER", ner_result),
+            ("КЛАССИФИКАТОР", classifier_result),
+            ("LLM1", llm1_result),
+        ),
+        "max_output_tokens": 600,
+        "temperature": 0.0,
+    }
 
---------------------------------
-ВХОДНЫЕ ДАННЫЕ О ПИСЬМЕ
---------------------------------
-
-=== ТЕКСТ ПИСЬМА ===
-{letter_text}
-
-=== РЕЗУЛЬТАТ NER (JSON) ===
-{ner_json}
-
-=== РЕЗУЛЬТАТ КЛАССИФИКАТОРА (JSON) ===
-{classifier_json}
-
-=== РЕЗЮМЕ ОТ LLM1 (JSON) ===
-{llm1_json}
-
-Пояснение по полям:
-- NER может содержать:
-  - contract_numbers (номера договоров),
-  - deadlines (сроки и дедлайны),
-  - law_refs (ссылки на НПА),
-  - contacts, organizations.
-- Классификатор:
-  - type (тип письма: жалоба, регуляторный запрос, уведомление и т.п.),
-  - urgency (срочность),
-  - formality,
-  - departments (какие подразделения вовлечены),
-  - legal_risk (есть/нет юридический риск).
-- LLM1:
-  - core_request (суть запроса),
-  - requirements (что конкретно требует автор),
-  - expectations (чего он ожидает).
-
-ЕЩЁ РАЗ: верни ТОЛЬКО JSON строго указанной структуры и ничего больше.
-""".strip()
 
-# ------------------------
-# Вызов Яндекс LLM
-# ------------------------
-response = client.responses.create(
-    model=MODEL,
-    input=prompt,
-    max_output_tokens=600,
-    temperature=0.0
-)
+def parse_output(raw: str) -> dict:
+    """Достаёт из ответа valid_docs / recommended_docs."""
+    best_obj = extract_json(raw, keys={"valid_docs", "recommended_docs"})
 
-raw = response.output_text.strip()
+    # ------------------------
+    # Если JSON не найден
+    # ------------------------
+    if best_obj is None:
+        metrics.note("fallbacks")
+        best_obj = {
+            "valid_docs": [],
+            "recommended_docs": []
+        }
 
-# ------------------------
-# Чистим ```json обёртки, если есть
-# ------------------------
-text = raw
-
-if text.startswith("```"):
-    parts = text.split("```")
-    if len(parts) >= 2:
-        text = parts[1].strip()
-        first_newline = text.find("\n")
-        if first_newline != -1 and not text.lstrip().startswith("{"):
-            maybe_lang = text[:first_newline].lower()
-            if "json" in maybe_lang:
-                text = text[first_newline + 1:].strip()
+    best_obj.setdefault("valid_docs", [])
+    best_obj.setdefault("recommended_docs", [])
 
-# ------------------------
-# Ищем JSON-объекты
-# ------------------------
-candidates = re.findall(r"\{.*?\}", text, flags=re.DOTALL)
-target_keys = {"valid_docs", "recommended_docs"}
-
-valid_objects = []
-for js in candidates:
-    try:
-        obj = json.loads(js)
-        valid_objects.append(obj)
-    except Exception:
-        continue
-
-best_obj = None
-if valid_objects:
-    for obj in valid_objects:
-        if any(k in obj for k in target_keys):
-            best_obj = obj
-            break
-    if best_obj is None:
-        best_obj = valid_objects[0]
+    return best_obj
+
+
+def memo_version() -> str:
+    """
+    Для stage_memo: режим после auto и то, по чему ищет RAG1, — корпус документов (index)
+    или векторное хранилище (vector: добавленные / удалённые строки, эмбеддер).
+    """
+    mode = resolve_mode()
+    if mode == "vector":
+        return f"{mode}:{vector_store.store_version()}"
+    if mode == "index":
+        return f"{mode}:{doc_index.corpus_signature()}"
+    return mode
+
+
+def resolve_mode(mode=None) -> str:
+    mode = mode or RAG1_MODE
+    if mode == "auto":
+        return "index" if doc_index.corpus_available() else "llm"
+    return mode
 
-# ------------------------
-# Если JSON не найден
-# ------------------------
-if best_obj is None:
-    best_obj = {
-        "valid_docs": [],
-        "recommended_docs": []
-    }
 
-best_obj.setdefault("valid_docs", [])
-best_obj.setdefault("recommended_docs", [])
+def search_docs(mode, letter_text, ner_result, llm1_result):
+    backend = vector_store if mode == "vector" else doc_index
+    return backend.search_docs(letter_text, ner_result, llm1_result)
+
+
+def run_rag1(letter_text: str, ner_result: dict, classifier_result: dict, llm1_result: dict, mode=None) -> dict:
+    """Подбирает валидные и рекомендованные документы для ответа на письмо."""
+    mode = resolve_mode(mode)
+    if mode in ("index", "vector"):
+        return search_docs(mode, letter_text, ner_result, llm1_result)
+    return parse_output(cache.create(client, build_request(letter_text, ner_result, classifier_result, llm1_result)))
+
+
+async def arun(call, letter_text: str, ner_result: dict, classifier_result: dict, llm1_result: dict,
+               mode=None) -> dict:
+    """run_rag1 для пакетного режима: в режимах index / vector запроса к модели нет."""
+    mode = resolve_mode(mode)
+    if mode in ("index", "vector"):
+        return search_docs(mode, letter_text, ner_result, llm1_result)
+    return parse_output(await call(build_request(letter_text, ner_result, classifier_result, llm1_result)))
+
 
 # ------------------------
-# Сохраняем в JSON файл
+# Запуск как скрипта
 # ------------------------
-with open("rag_docs_output.json", "w", encoding="utf-8") as f:
-    json.dump(best_obj, f, ensure_ascii=False, indent=2)
+if __name__ == "__main__":
+    # Текст письма
+    with open("letter.txt", "r", encoding="utf-8") as f:
+        letter_text = f.read().strip()
+
+    # NER
+    with open("ner_output.json", "r", encoding="utf-8") as f:
+        ner_result = json.load(f)
+
+    # Классификатор
+    with open("classification_output.json", "r", encoding="utf-8") as f:
+        classifier_result = json.load(f)
+
+    # LLM1 (core_request / requirements / expectations)
+    with open("llm1_output.json", "r", encoding="utf-8") as f:
+        llm1_result = json.load(f)
+
+    best_obj = run_rag1(letter_text, ner_result, classifier_result, llm1_result)
+
+    # Сохраняем в JSON файл
+    with open("rag_docs_output.json", "w", encoding="utf-8") as f:
+        json.dump(best_obj, f, ensure_ascii=False, indent=2)
 
-print("Файл сохранён → rag_docs_output.json")
+    print("Файл сохранён → rag_docs_output.json")
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+# rag2_rules.py
+# Детерминированный анализ использования документов в черновиках ответов (RAG2).
+# Для каждого стиля ответа ищутся коды документов RAG1, номера актов (№55-У, 115-ФЗ,
+# ст. 395 ГК РФ) и совпадения названий документов по биграммам лемм. Ссылки на акты,
+# которых нет ни в списке документов, ни в самом письме, считаются галлюцинациями.
+# Если совпадение неуверенное, стиль помечается низкой уверенностью — его проверяет LLM.
+import re
+
+from doc_index import tokenize
+from ner_rules import extract_law_refs
+
+STYLES = ["official", "business", "client_friendly", "simple"]
+
+USED_THRESHOLD      = 0.6    # совпадение названия ≥ — документ использован
+AMBIGUOUS_THRESHOLD = 0.3    # между порогами — решить не можем
+CONFIDENT           = 0.75   # уверенность стиля ниже — нужен LLM
+
+# Идентификаторы актов: 55-У, 115-ФЗ, 395-1, 6406-У, ст. 395 ГК РФ
+ACT_ID_RE = re.compile(r"(?<![\w\-])(\d{1,5}(?:-\d+)?-(?:ФКЗ|ФЗ|У|П|И|Т|Р))(?![\wА-Яа-я])", re.IGNORECASE)
+ARTICLE_RE = re.compile(r"(?:ст\.|стать\w+)\s*(\d+(?:\.\d+)?)\s+(ГК|НК|ТК|КоАП|АПК|ГПК|УК)", re.IGNORECASE)
+# Упоминания внутренних документов без номера — для предупреждения в комментарии
+GENERIC_RE = re.compile(r"действующ\w+\s+законодательств\w+|нормативн\w+\s+(?:акт\w+|баз\w+)", re.IGNORECASE)
+
+
+# -----------------------------
+# Вспомогательные функции
+# -----------------------------
+def act_ids(text: str) -> set:
+    """Номера актов и статей кодексов в нормальной форме: {"55-У", "СТ395ГК"}."""
+    ids = {m.group(1).upper() for m in ACT_ID_RE.finditer(text)}
+    ids |= {f"СТ{m.group(1)}{m.group(2).upper()}" for m in ARTICLE_RE.finditer(text)}
+    return ids
+
+
+def bigrams(tokens: list) -> set:
+    return {a + " " + b for a, b in zip(tokens, tokens[1:])}
+
+
+def overlap(name_tokens: list, text_tokens: set, text_bigrams: set) -> float:
+    """Доля названия, найденная в тексте: биграммы, а для коротких названий — отдельные леммы."""
+    if not name_tokens:
+        return 0.0
+    unigram = sum(t in text_tokens for t in name_tokens) / len(name_tokens)
+    if len(name_tokens) < 3:
+        return unigram
+    name_bigrams = bigrams(name_tokens)
+    return max(len(name_bigrams & text_bigrams) / len(name_bigrams), 0.8 * unigram)
+
+
+def collect_docs(rag_docs: dict) -> list:
+    docs = []
+    for section in ("valid_docs", "recommended_docs"):
+        for doc in (rag_docs or {}).get(section) or []:
+            if isinstance(doc, dict) and doc.get("code"):
+                name = doc.get("name") or ""
+                docs.append({
+                    **doc,
+                    "_tokens": tokenize(name),
+                    "_ids": act_ids(name + " " + (doc.get("reason") or "")),
+                })
+    return docs
+
+
+def empty_analysis(comment="") -> dict:
+    return {"used_docs": [], "missing_docs": [], "hallucinated_refs": [], "comment": comment}
+
+
+# -----------------------------
+# Анализ одного ответа
+# -----------------------------
+def analyze_answer(answer: str, docs: list, letter_ids: set) -> dict:
+    text = answer or ""
+    tokens = tokenize(text)
+    text_tokens, text_bigrams = set(tokens), bigrams(tokens)
+    text_ids = act_ids(text)
+    lowered = text.lower()
+
+    used, ambiguous = [], []
+    for doc in docs:
+        if doc["code"].lower() in lowered or doc["_ids"] & text_ids:
+            used.append(doc["code"])
+            continue
+        score = overlap(doc["_tokens"], text_tokens, text_bigrams)
+        if score >= USED_THRESHOLD:
+            used.append(doc["code"])
+        elif score >= AMBIGUOUS_THRESHOLD:
+            ambiguous.append(doc["code"])
+
+    known_ids = set(letter_ids)
+    for doc in docs:
+        known_ids |= doc["_ids"]
+
+    hallucinated, unsure_refs = [], []
+    for ref in extract_law_refs(text):
+        ids = act_ids(ref)
+        if ids:
+            if not ids <= known_ids:
+                hallucinated.append(f"ссылка «{ref}» отсутствует в списке документов и в письме")
+            continue
+        # акт без номера («Закон о защите прав потребителей») — сравниваем с названиями
+        ref_tokens = tokenize(ref)
+        best = max((overlap(ref_tokens, set(d["_tokens"]), bigrams(d["_tokens"])) for d in docs), default=0.0)
+        if best < AMBIGUOUS_THRESHOLD:
+            hallucinated.append(f"ссылка «{ref}» отсутствует в списке документов")
+        elif best < USED_THRESHOLD:
+            unsure_refs.append(ref)
+
+    missing = [d["code"] for d in docs
+               if d.get("priority") == "high" and d["code"] not in used and d["code"] not in ambiguous]
+
+    comment_parts = []
+    if used:
+        comment_parts.append(f"опирается на документы: {', '.join(used)}")
+    else:
+        comment_parts.append("явных ссылок на документы из списка нет")
+    if hallucinated:
+        comment_parts.append(f"ссылок вне списка: {len(hallucinated)}")
+    if GENERIC_RE.search(text):
+        comment_parts.append("есть общие ссылки на законодательство без указания акта")
+
+    uncertain = len(ambiguous) + len(unsure_refs)
+    checked = len(docs) + len(unsure_refs) + len(hallucinated)
+    return {
+        "used_docs": used,
+        "missing_docs": missing,
+        "hallucinated_refs": hallucinated,
+        "comment": "; ".join(comment_parts),
+        "confidence": round(1.0 - uncertain / checked, 2) if checked else 1.0,
+    }
+
+
+def analyze(letter_text: str, rag_docs: dict, llm2_result: dict) -> dict:
+    """Результат в схеме rag_usage_output.json + confidence по каждому стилю."""
+    docs = collect_docs(rag_docs)
+    letter_ids = act_ids(letter_text or "")
+    answers = (llm2_result or {}).get("answers") or {}
+    return {"analysis": {style: analyze_answer(answers.get(style) or "", docs, letter_ids) for style in STYLES}}
+
+
+def uncertain_styles(result: dict, threshold=CONFIDENT) -> list:
+    return [style for style, item in result["analysis"].items() if item.get("confidence", 1.0) < threshold]
+
+
+if __name__ == "__main__":
+    import json
+
+    with open("letter.txt", "r", encoding="utf-8") as f:
+        letter_text = f.read().strip()
+    with open("rag_docs_output.json", "r", encoding="utf-8") as f:
+        rag_docs = json.load(f)
+    with open("llm2_output.json", "r", encoding="utf-8") as f:
+        llm2_result = json.load(f)
+
+    print(json.dumps(analyze(letter_text, rag_docs, llm2_result), ensure_ascii=False, indent=2))
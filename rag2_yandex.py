@@ -1,48 +1,27 @@
 import os
 import json
-import re
-from dotenv import load_dotenv
-from openai import OpenAI
+from llm_cache import cache
+from llm_client import MODEL, get_client
+from json_extract import extract_json
+from prompt_builder import Prompt
+from chunking import condense
+import metrics
+from rag2_rules import analyze, uncertain_styles, empty_analysis
 
-# ------------------------
-# Загружаем API ключи
-# ------------------------
-load_dotenv()
+# Режим RAG2:
+#   hybrid — анализ правилами (rag2_rules.py), LLM проверяет только стили с низкой уверенностью;
+#   rules  — без обращения к LLM;
+#   llm    — весь анализ через LLM (как раньше).
+RAG2_MODE = os.getenv("RAG2_MODE", "hybrid")
 
-folder_id = os.getenv("folder_id")
-api_key   = os.getenv("api_key")
+client = get_client("rag2")
 
-MODEL = f"gpt://{folder_id}/qwen3-235b-a22b-fp8/latest"
-
-client = OpenAI(
-    base_url="https://rest-assistant.api.cloud.yandex.net/v1",
-    api_key=api_key,
-    project=folder_id
-)
-
-# ------------------------
-# Входные данные
-# ------------------------
-
-# Исходное письмо
-with open("letter.txt", "r", encoding="utf-8") as f:
-    letter_text = f.read().strip()
-
-# Документы, подобранные RAG1
-with open("rag_docs_output.json", "r", encoding="utf-8") as f:
-    rag_docs = json.load(f)
-
-# Черновики ответов LLM2
-with open("llm2_output.json", "r", encoding="utf-8") as f:
-    llm2_result = json.load(f)
-
-rag_docs_json = json.dumps(rag_docs, ensure_ascii=False, indent=2)
-llm2_json     = json.dumps(llm2_result, ensure_ascii=False, indent=2)
+FAILED_COMMENT = "анализ не удалось выполнить"
 
 # ------------------------
 # PROMPT: анализ использования документов
 # ------------------------
-prompt = f"""
+RAG2_PROMPT = Prompt("""
 Ты — юридический и комплаенс-эксперт крупного банка.
 
 Тебе даются:
@@ -65,34 +44,19 @@ prompt = f"""
 ФОРМАТ ОТВЕТА:
 Верни ОДИН валидный JSON следующего вида:
 
-{{
-  "analysis": {{
-    "official": {{
+{
+  "analysis": {
+    "official": {
       "used_docs": ["КОД_1", "КОД_2"],
       "missing_docs": ["КОД_3"],
       "hallucinated_refs": ["описание проблемы 1", "описание проблемы 2"],
       "comment": "краткий вывод по этому варианту"
-    }},
-    "business": {{
-      "used_docs": [...],
-      "missing_docs": [...],
-      "hallucinated_refs": [...],
-      "comment": "..."
-    }},
-    "client_friendly": {{
-      "used_docs": [...],
-      "missing_docs": [...],
-      "hallucinated_refs": [...],
-      "comment": "..."
-    }},
-    "simple": {{
-      "used_docs": [...],
-      "missing_docs": [...],
-      "hallucinated_refs": [...],
-      "comment": "..."
-    }}
-  }}
-}}
+    },
+    "business": { ...те же четыре поля... },
+    "client_friendly": { ...те же четыре поля... },
+    "simple": { ...те же четыре поля... }
+  }
+}
 
 Где:
 - "used_docs" — список code из входного списка документов (valid_docs/recommended_docs), которые фактически используются или явно подразумеваются в этом варианте ответа.
@@ -101,118 +65,155 @@ prompt = f"""
 - "comment" — короткий текстовый вывод по используемым документам и рискам.
 
 Никакого другого текста, комментариев или Markdown добавлять нельзя.
+""")
+
+
+def build_request(letter_text: str, rag_docs: dict, llm2_result: dict) -> dict:
+    """Промпт RAG2: инструкции, затем письмо, документы RAG1 и черновики LLM2."""
+    return {
+        "model": MODEL,
+        **RAG2_PROMPT.render(
+            ("ИСХОДНОЕ ПИСЬМО", condense(letter_text)),
+            ("СПИСОК ДОКУМЕНТОВ ОТ RAG1", rag_docs),
+            ("ЧЕРНОВИКИ ОТВЕТОВ LLM2", llm2_result),
+        ),
+        "max_output_tokens": 800,
+        "temperature": 0.0,
+    }
 
---------------------------------
-ИСХОДНОЕ ПИСЬМО
---------------------------------
-{letter_text}
-
---------------------------------
-СПИСОК ДОКУМЕНТОВ ОТ RAG1 (JSON)
---------------------------------
-{rag_docs_json}
-
---------------------------------
-ЧЕРНОВИКИ ОТВЕТОВ LLM2 (JSON)
---------------------------------
-{llm2_json}
-""".strip()
-
-# ------------------------
-# Вызов Яндекс LLM
-# ------------------------
-response = client.responses.create(
-    model=MODEL,
-    input=prompt,
-    max_output_tokens=800,
-    temperature=0.0
-)
-
-raw = response.output_text.strip()
 
-# ------------------------
-# Чистим ```json обёртки
-# ------------------------
-text = raw
-
-if text.startswith("```"):
-    parts = text.split("```")
-    if len(parts) >= 2:
-        text = parts[1].strip()
-        first_newline = text.find("\n")
-        if first_newline != -1 and not text.lstrip().startswith("{"):
-            maybe_lang = text[:first_newline].lower()
-            if "json" in maybe_lang:
-                text = text[first_newline + 1:].strip()
+def parse_output(raw: str) -> dict:
+    """Достаёт analysis и дополняет недостающие поля по каждому стилю."""
+    best_obj = extract_json(raw, keys={"analysis"})
 
-# ------------------------
-# Ищем JSON-объекты
-# ------------------------
-candidates = re.findall(r"\{.*?\}", text, flags=re.DOTALL)
-target_keys = {"analysis"}
-
-valid_objects = []
-for js in candidates:
-    try:
-        obj = json.loads(js)
-        valid_objects.append(obj)
-    except Exception:
-        continue
-
-best_obj = None
-if valid_objects:
-    for obj in valid_objects:
-        if any(k in obj for k in target_keys):
-            best_obj = obj
-            break
+    # ------------------------
+    # Если JSON не найден
+    # ------------------------
     if best_obj is None:
-        best_obj = valid_objects[0]
-
-# ------------------------
-# Если JSON не найден
-# ------------------------
-if best_obj is None:
-    best_obj = {
-        "analysis": {
-            "official": {
-                "used_docs": [],
-                "missing_docs": [],
-                "hallucinated_refs": [],
-                "comment": "анализ не удалось выполнить"
-            },
-            "business": {
-                "used_docs": [],
-                "missing_docs": [],
-                "hallucinated_refs": [],
-                "comment": "анализ не удалось выполнить"
-            },
-            "client_friendly": {
-                "used_docs": [],
-                "missing_docs": [],
-                "hallucinated_refs": [],
-                "comment": "анализ не удалось выполнить"
-            },
-            "simple": {
-                "used_docs": [],
-                "missing_docs": [],
-                "hallucinated_refs": [],
-                "comment": "анализ не удалось выполнить"
+        metrics.note("fallbacks")
+        best_obj = {
+            "analysis": {
+                "official": {
+                    "used_docs": [],
+                    "missing_docs": [],
+                    "hallucinated_refs": [],
+                    "comment": FAILED_COMMENT
+                },
+                "business": {
+                    "used_docs": [],
+                    "missing_docs": [],
+                    "hallucinated_refs": [],
+                    "comment": FAILED_COMMENT
+                },
+                "client_friendly": {
+                    "used_docs": [],
+                    "missing_docs": [],
+                    "hallucinated_refs": [],
+                    "comment": FAILED_COMMENT
+                },
+                "simple": {
+                    "used_docs": [],
+                    "missing_docs": [],
+                    "hallucinated_refs": [],
+                    "comment": FAILED_COMMENT
+                }
             }
         }
-    }
-
-analysis = best_obj.setdefault("analysis", {})
-for key in ["official", "business", "client_friendly", "simple"]:
-    analysis.setdefault(key, {})
-    analysis[key].setdefault("used_docs", [])
-    analysis[key].setdefault("missing_docs", [])
-    analysis[key].setdefault("hallucinated_refs", [])
-    analysis[key].setdefault("comment", "")
-
-# ------------------------
-# Сохраняем в JSON файл
-# ------------------------
-with open("rag_usage_output.json", "w", encoding="utf-8") as f:
-    json.dump(best_obj, f, ensure_ascii=False, indent=2)
 
-print("Файл сохранён → rag_usage_output.json")
+    analysis = best_obj.setdefault("analysis", {})
+    for key in ["official", "business", "client_friendly", "simple"]:
+        if not isinstance(analysis.get(key), dict):
+            analysis[key] = {}
+        analysis[key].setdefault("used_docs", [])
+        analysis[key].setdefault("missing_docs", [])
+        analysis[key].setdefault("hallucinated_refs", [])
+        analysis[key].setdefault("comment", "")
+
+    return best_obj
+
+
+def plan_request(letter_text: str, rag_docs: dict, llm2_result: dict, rules: dict):
+    """Запрос к LLM только с теми черновиками, где правила не уверены (или None)."""
+    styles = uncertain_styles(rules)
+    if not styles:
+        return None
+    answers = (llm2_result or {}).get("answers") or {}
+    return build_request(letter_text, rag_docs, {"answers": {s: answers.get(s, "") for s in styles}})
+
+
+def answered(item) -> bool:
+    """Модель вернула по стилю хоть что-то: документы, ссылки или комментарий."""
+    if not isinstance(item, dict):
+        return False
+    comment = item.get("comment")
+    return bool(isinstance(comment, str) and comment.strip() and comment != FAILED_COMMENT) \
+        or any(item.get(key) for key in ("used_docs", "missing_docs", "hallucinated_refs"))
+
+
+def merge_output(rules: dict, raw: str) -> dict:
+    """
+    Стили, отправленные в LLM, берутся из её ответа, если модель их разобрала;
+    пропущенные или пустые в ответе (и все — при неразобранном ответе) остаются из правил.
+    """
+    best_obj = extract_json(raw, keys={"analysis"})
+    llm = (best_obj or {}).get("analysis")
+    if not isinstance(llm, dict):
+        metrics.note("fallbacks")
+        return rules
+    for style in uncertain_styles(rules):
+        if not answered(llm.get(style)):
+            continue
+        rules["analysis"][style] = {**empty_analysis(), **llm[style],
+                                    "confidence": rules["analysis"][style]["confidence"]}
+    return rules
+
+
+def run_rag2(letter_text: str, rag_docs: dict, llm2_result: dict, mode=None) -> dict:
+    """Анализирует, на какие документы RAG1 опираются черновики LLM2."""
+    mode = mode or RAG2_MODE
+    if mode == "llm":
+        return parse_output(cache.create(client, build_request(letter_text, rag_docs, llm2_result)))
+
+    rules = analyze(letter_text, rag_docs, llm2_result)
+    request = plan_request(letter_text, rag_docs, llm2_result, rules) if mode == "hybrid" else None
+    if request is None:
+        return rules
+    return merge_output(rules, cache.create(client, request))
+
+
+async def arun(call, letter_text: str, rag_docs: dict, llm2_result: dict, mode=None) -> dict:
+    """run_rag2 для пакетного режима."""
+    mode = mode or RAG2_MODE
+    if mode == "llm":
+        return parse_output(await call(build_request(letter_text, rag_docs, llm2_result)))
+
+    rules = analyze(letter_text, rag_docs, llm2_result)
+    request = plan_request(letter_text, rag_docs, llm2_result, rules) if mode == "hybrid" else None
+    if request is None:
+        return rules
+    return merge_output(rules, await call(request))
+
+
+# ------------------------
+# Запуск как скрипта
+# ------------------------
+if __name__ == "__main__":
+    # Исходное письмо
+    with open("letter.txt", "r", encoding="utf-8") as f:
+        letter_text = f.read().strip()
+
+    # Документы, подобранные RAG1
+    with open("rag_docs_output.json", "r", encoding="utf-8") as f:
+        rag_docs = json.load(f)
+
+    # Черновики ответов LLM2
+    with open("llm2_output.json", "r", encoding="utf-8") as f:
+        llm2_result = json.load(f)
+
+    best_obj = run_rag2(letter_text, rag_docs, llm2_result)
+
+    # Сохраняем в JSON файл
+    with open("rag_usage_output.json", "w", encoding="utf-8") as f:
+        json.dump(best_obj, f, ensure_ascii=False, indent=2)
+
+    print("Файл сохранён → rag_usage_output.json")
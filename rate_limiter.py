@@ -0,0 +1,216 @@
+# rate_limiter.py
+# Ограничение частоты запросов к Yandex responses API на стороне клиента.
+# Квоты каталога — запросы в секунду и токены в минуту — общие для всех этапов и писем,
+# поэтому лимитер один на процесс. Без него параллельные письма упираются в квоту
+# и получают пачки 429, а повторы только усиливают нагрузку.
+#
+# Два «ведра» (token bucket):
+#   - запросы: LLM_RPS в секунду, всплеск до LLM_RPS_BURST;
+#   - токены: LLM_TPM в минуту, всплеск до LLM_TPM_BURST. Стоимость запроса оценивается заранее
+#     локальным подсчётом токенов промпта (prompt_builder.count_tokens) плюс max_output_tokens,
+#     а после ответа уточняется по usage.
+# Запрос не отклоняется, а ждёт своей очереди: место в ведре резервируется сразу,
+# вызывающий спит ровно столько, сколько нужно до пополнения.
+#
+#   LLM_RPS=10, LLM_TPM=0 — ноль отключает соответствующее ведро
+import os
+import time
+import asyncio
+import threading
+from collections import deque
+
+from prompt_builder import request_tokens
+
+RPS             = float(os.getenv("LLM_RPS", 10))
+RPS_BURST       = float(os.getenv("LLM_RPS_BURST", 0)) or max(RPS, 1.0)
+TPM             = float(os.getenv("LLM_TPM", 0))
+TPM_BURST       = float(os.getenv("LLM_TPM_BURST", 0)) or TPM / 6   # ~10 секунд квоты
+DEFAULT_OUTPUT_TOKENS = 1000
+
+
+# ------------------------
+# Оценка стоимости запроса
+# ------------------------
+def estimate_tokens(request: dict, prompt_tokens=None) -> int:
+    """Токены промпта (instructions + input; если уже посчитаны — prompt_tokens) плюс максимум ответа."""
+    if prompt_tokens is None:
+        prompt_tokens = sum(request_tokens(request))
+    return prompt_tokens + int(request.get("max_output_tokens") or DEFAULT_OUTPUT_TOKENS)
+
+
+def usage_tokens(response):
+    """Фактический расход токенов из ответа (или None, если usage нет)."""
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return None
+    total = getattr(usage, "total_tokens", None)
+    if total is None:
+        total = (getattr(usage, "input_tokens", 0) or 0) + (getattr(usage, "output_tokens", 0) or 0)
+    return total or None
+
+
+# ------------------------
+# Ведро
+# ------------------------
+class TokenBucket:
+    """rate единиц в секунду, не больше capacity в запасе. Уровень может уйти в минус — это очередь."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount, now) -> float:
+        """Списывает amount и возвращает, сколько секунд ждать до его покрытия."""
+        self._refill(now)
+        self.level -= amount
+        return max(0.0, -self.level / self.rate)
+
+    def available(self, amount, now) -> bool:
+        self._refill(now)
+        return self.level >= amount
+
+    def refund(self, amount):
+        self.level = min(self.capacity, self.level + amount)
+
+
+class RateLimiter:
+    def __init__(self, rps=RPS, rps_burst=RPS_BURST, tpm=TPM, tpm_burst=TPM_BURST):
+        self.requests = TokenBucket(rps, rps_burst) if rps > 0 else None
+        self.tokens = TokenBucket(tpm / 60, max(tpm_burst, 1.0)) if tpm > 0 else None
+        self.rps = rps
+        self.tpm = tpm
+        self._lock = threading.Lock()
+        self._paused_until = 0.0
+        self._window = deque()          # (время, запросов, токенов) за последнюю минуту
+        self.waiting = 0
+        self.queued = 0                 # запросов, которым пришлось ждать
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.requests is not None or self.tokens is not None
+
+    def _prune(self, now):
+        """
+        Убирает из окна записи старше минуты; вызывается под self._lock.
+        Окно упорядочено почти по времени (резерв записан на момент отправки, после ожидания),
+        так что запись за более поздней уходит при одном из следующих вызовов.
+        """
+        while self._window and self._window[0][0] < now - 60:
+            self._window.popleft()
+
+    def _reserve(self, cost, now) -> float:
+        """Резервирует запрос и cost токенов; вызывается под self._lock."""
+        self._prune(now)
+        wait = max(0.0, self._paused_until - now)
+        if self.requests is not None:
+            wait = max(wait, self.requests.reserve(1, now))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.reserve(min(cost, self.tokens.capacity), now))
+        self._window.append((now + wait, 1, cost))
+        if wait > 0:
+            self.queued += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+        return wait
+
+    def try_acquire(self, cost) -> bool:
+        """Без ожидания: резервирует место, только если оно есть прямо сейчас (для хеджей)."""
+        if not self.enabled:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            if now < self._paused_until:
+                return False
+            if self.requests is not None and not self.requests.available(1, now):
+                return False
+            if self.tokens is not None and not self.tokens.available(min(cost, self.tokens.capacity), now):
+                return False
+            self._reserve(cost, now)
+        return True
+
+    def acquire(self, cost) -> float:
+        """Ждёт своей очереди; возвращает время ожидания, сек."""
+        if not self.enabled:
+            return 0.0
+        with self._lock:
+            wait = self._reserve(cost, time.monotonic())
+        if wait > 0:
+            with self._lock:
+                self.waiting += 1
+            try:
+                time.sleep(wait)
+            finally:
+                with self._lock:
+                    self.waiting -= 1
+        return wait
+
+    async def aacquire(self, cost) -> float:
+        if not self.enabled:
+            return 0.0
+        with self._lock:
+            wait = self._reserve(cost, time.monotonic())
+        if wait > 0:
+            with self._lock:
+                self.waiting += 1
+            try:
+                await asyncio.sleep(wait)
+            finally:
+                with self._lock:
+                    self.waiting -= 1
+        return wait
+
+    def settle(self, estimated, actual):
+        """Уточняет расход по usage ответа: переоценка возвращается в ведро, недооценка списывается."""
+        if actual is None or not self.enabled:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if self.tokens is not None:
+                diff = estimated - actual
+                if diff > 0:
+                    self.tokens.refund(diff)
+                else:
+                    self.tokens.reserve(-diff, now)
+            self._prune(now)
+            self._window.append((now, 0, actual - estimated))
+
+    def pause(self, seconds):
+        """Сервер ответил 429: новые запросы не отправляются seconds секунд."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            self._window = deque(item for item in self._window if item[0] >= now - 60)
+            sent = [(n, c) for t, n, c in self._window if t <= now]
+            requests = sum(n for n, _ in sent)
+            tokens = sum(c for _, c in sent)
+            return {
+                "rps_limit": self.rps or None,
+                "tpm_limit": self.tpm or None,
+                "requests_last_min": requests,
+                "tokens_last_min": tokens,
+                "rps_utilisation": round(requests / 60 / self.rps, 2) if self.rps else None,
+                "tpm_utilisation": round(tokens / self.tpm, 2) if self.tpm else None,
+                "waiting": self.waiting,
+                "queued": self.queued,
+                "wait_total": round(self.wait_total, 2),
+                "wait_max": round(self.wait_max, 2),
+            }
+
+
+# Один лимитер на процесс: квота каталога общая для всех этапов
+limiter = RateLimiter()
+
+
+def stats() -> dict:
+    return limiter.stats()
@@ -0,0 +1,169 @@
+# scheduler.py
+# Исполнитель графа этапов: каждый этап объявляет входы и выход,
+# независимые этапы выполняются параллельно в пуле потоков.
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass
+from typing import Callable
+
+
+@dataclass
+class Stage:
+    """
+    Этап пайплайна: func(*inputs) -> значение артефакта output.
+
+    output может быть кортежем имён — тогда func возвращает dict {имя: значение}
+    (так объединённый этап анализа отдаёт ner, classification и llm1 разом).
+    """
+    name: str
+    func: Callable
+    inputs: tuple
+    output: object
+
+    @property
+    def outputs(self) -> tuple:
+        return self.output if isinstance(self.output, tuple) else (self.output,)
+
+    def artifacts(self, result):
+        """Пары (имя артефакта, значение) из результата func."""
+        if isinstance(self.output, tuple):
+            return [(name, result[name]) for name in self.output]
+        return [(self.output, result)]
+
+
+def check_graph(stages, initial):
+    """Проверяет, что у каждого входа есть источник и выходы не дублируются."""
+    produced = set(initial)
+    for stage in stages:
+        for name in stage.outputs:
+            if name in produced:
+                raise ValueError(f"Артефакт '{name}' производится дважды")
+            produced.add(name)
+    for stage in stages:
+        missing = [i for i in stage.inputs if i not in produced]
+        if missing:
+            raise ValueError(f"Этап {stage.name}: нет источника для {missing}")
+
+
+def run_graph(stages, artifacts: dict, max_workers=None, on_stage_done=None):
+    """
+    Выполняет этапы по готовности входов.
+
+    artifacts — исходные артефакты (например, {"letter_text": ...}); дополняется
+    выходами этапов. on_stage_done(stage, result) вызывается в основном потоке
+    сразу после завершения этапа.
+
+    Возвращает (artifacts, timings), где timings[name] = (start, end) в секундах
+    от начала запуска.
+    """
+    check_graph(stages, artifacts)
+
+    artifacts = dict(artifacts)
+    pending = list(stages)
+    running = {}
+    timings = {}
+    t0 = time.perf_counter()
+
+    def call(stage, args):
+        start = time.perf_counter() - t0
+        result = stage.func(*args)
+        return result, start, time.perf_counter() - t0
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(stages)) as pool:
+        while pending or running:
+            for stage in [s for s in pending if all(i in artifacts for i in s.inputs)]:
+                pending.remove(stage)
+                args = [artifacts[i] for i in stage.inputs]
+                running[pool.submit(call, stage, args)] = stage
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                try:
+                    result, start, end = future.result()
+                except Exception:
+                    for other in running:
+                        other.cancel()
+                    raise
+                artifacts.update(stage.artifacts(result))
+                timings[stage.name] = (start, end)
+                if on_stage_done is not None:
+                    on_stage_done(stage, result)
+
+    return artifacts, timings
+
+
+async def run_graph_async(stages, artifacts: dict, on_stage_done=None):
+    """
+    Асинхронный вариант run_graph: stage.func — корутинная функция.
+
+    Используется пакетным режимом (batch.py), где несколько писем делят
+    один цикл событий и один AsyncOpenAI-клиент.
+    """
+    check_graph(stages, artifacts)
+
+    artifacts = dict(artifacts)
+    pending = list(stages)
+    running = {}
+    timings = {}
+    t0 = time.perf_counter()
+
+    async def call(stage, args):
+        start = time.perf_counter() - t0
+        result = await stage.func(*args)
+        return result, start, time.perf_counter() - t0
+
+    try:
+        while pending or running:
+            for stage in [s for s in pending if all(i in artifacts for i in s.inputs)]:
+                pending.remove(stage)
+                args = [artifacts[i] for i in stage.inputs]
+                running[asyncio.ensure_future(call(stage, args))] = stage
+
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                stage = running.pop(task)
+                result, start, end = task.result()
+                artifacts.update(stage.artifacts(result))
+                timings[stage.name] = (start, end)
+                if on_stage_done is not None:
+                    on_stage_done(stage, result)
+    finally:
+        for task in running:
+            task.cancel()
+
+    return artifacts, timings
+
+
+def critical_path(stages, timings):
+    """
+    Самая длинная по времени цепочка зависимых этапов.
+
+    Возвращает (список имён этапов, суммарная длительность в секундах).
+    """
+    producer = {name: s for s in stages for name in s.outputs}
+    best = {}
+
+    def longest(stage):
+        if stage.name not in best:
+            start, end = timings[stage.name]
+            deps = [longest(producer[i]) for i in stage.inputs if i in producer]
+            path, total = max(deps, key=lambda x: x[1], default=([], 0.0))
+            best[stage.name] = (path + [stage.name], total + (end - start))
+        return best[stage.name]
+
+    return max((longest(s) for s in stages if s.name in timings),
+               key=lambda x: x[1], default=([], 0.0))
+
+
+def format_report(stages, timings):
+    """Текстовый отчёт: длительность каждого этапа и критический путь."""
+    lines = []
+    for stage in stages:
+        if stage.name in timings:
+            start, end = timings[stage.name]
+            lines.append(f"  {stage.name:<14} {start:7.2f} → {end:7.2f} с  ({end - start:.2f} с)")
+    path, total = critical_path(stages, timings)
+    lines.append(f"Критический путь: {' → '.join(path)} ({total:.2f} с)")
+    return "\n".join(lines)
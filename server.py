@@ -0,0 +1,257 @@
+# server.py
+# Локальный HTTP-сервис для ии_6.html: результаты писем в памяти и ход обработки через SSE.
+# Раньше UI читал ui_payload.json одним fetch — одно письмо и только после всех этапов.
+# Здесь оператор видит анализ сразу после NER / классификатора, а ответы — по мере готовности стилей.
+#
+#   python server.py --port 8000 --store letters     # затем открыть http://localhost:8000/
+#
+# Маршруты:
+#   GET  /                         — ии_6.html
+#   POST /letters                  — принять письмо (текст или {"text": ..., "letter_id": ...}) → {"letter_id"}
+#   GET  /letters                  — письма и их статус
+#   GET  /letters/{id}/payload     — ui_payload письма из памяти (то же, что пишет build_ui_payload.py)
+#   GET  /letters/{id}/events      — SSE: stage_done (с текущим payload), partial (готовый стиль), done / error
+#   GET  /ui_payload.json          — payload последнего письма (совместимость со старым UI)
+#   GET  /metrics                  — метрики этапов в формате Prometheus (metrics.py)
+import json
+import queue
+import argparse
+import threading
+from pathlib import Path
+from urllib.parse import urlparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from pipeline import pipeline
+from artifact_store import ArtifactStore, make_letter_id
+from build_ui_payload import build_payload, UI_STYLES
+import metrics
+
+HTML_PATH = Path(__file__).with_name("ии_6.html")
+KEEPALIVE = 15          # сек между комментариями SSE, чтобы прокси не закрывали соединение
+
+
+# ------------------------
+# Письма и события в памяти
+# ------------------------
+class LetterHub:
+    """Статус, история событий и подписчики SSE по каждому письму."""
+
+    def __init__(self, store, max_letters=2):
+        self.store = store
+        self._letters = {}      # letter_id → {"status", "events", "subscribers"}
+        self._order = []
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(max_letters)
+
+    def _state(self, letter_id):
+        state = self._letters.get(letter_id)
+        if state is None:
+            state = self._letters[letter_id] = {"status": "stored", "events": [], "subscribers": set()}
+        return state
+
+    def publish(self, letter_id, event):
+        with self._lock:
+            state = self._state(letter_id)
+            event = {"id": len(state["events"]) + 1, **event}
+            state["events"].append(event)
+            if event["type"] in ("done", "error"):
+                state["status"] = event["type"]
+            for subscriber in state["subscribers"]:
+                subscriber.put(event)
+
+    def subscribe(self, letter_id, last_id=0):
+        """Очередь новых событий и события после last_id, которые уже были."""
+        subscriber = queue.Queue()
+        with self._lock:
+            state = self._state(letter_id)
+            state["subscribers"].add(subscriber)
+            history = [e for e in state["events"] if e["id"] > last_id]
+        return subscriber, history
+
+    def unsubscribe(self, letter_id, subscriber):
+        with self._lock:
+            self._letters[letter_id]["subscribers"].discard(subscriber)
+
+    def status(self, letter_id):
+        with self._lock:
+            state = self._letters.get(letter_id)
+            return state["status"] if state else None
+
+    def payload(self, letter_id):
+        artifacts = self.store.letter(letter_id)
+        if not artifacts:
+            return None
+        return {"letter_id": letter_id, "status": self.status(letter_id) or "stored", **build_payload(artifacts)}
+
+    def latest(self):
+        with self._lock:
+            return self._order[-1] if self._order else None
+
+    def letters(self):
+        with self._lock:
+            known = {letter_id: state["status"] for letter_id, state in self._letters.items()}
+        return [{"letter_id": letter_id, "status": known.get(letter_id, "stored")} for letter_id in self.store.letters()]
+
+    # ------------------------
+    # Обработка
+    # ------------------------
+    def submit(self, letter_text, letter_id=None):
+        letter_text = letter_text.strip()
+        letter_id = letter_id or make_letter_id(letter_text)
+        with self._lock:
+            state = self._state(letter_id)
+            if state["status"] in ("queued", "running"):
+                return letter_id
+            state["status"], state["events"] = "queued", []
+            self._order.append(letter_id)
+        self.publish(letter_id, {"type": "accepted"})
+        threading.Thread(target=self._run, args=(letter_id, letter_text), daemon=True).start()
+        return letter_id
+
+    def _run(self, letter_id, letter_text):
+        with self._slots:
+            with self._lock:
+                self._letters[letter_id]["status"] = "running"
+            try:
+                pipeline(letter_text, letter_id=letter_id, store=self.store,
+                         on_event=lambda event: self._on_event(letter_id, event))
+            except Exception as e:
+                self.publish(letter_id, {"type": "error", "error": repr(e)})
+                return
+            self.publish(letter_id, {"type": "done", "payload": self.payload(letter_id)})
+
+    def _on_event(self, letter_id, event):
+        event = {k: v for k, v in event.items() if k != "letter_id"}
+        if event["type"] == "stage_done":
+            event["payload"] = self.payload(letter_id)
+        elif event["type"] == "partial":
+            event["ui_style"] = UI_STYLES.get(event["style"])
+        self.publish(letter_id, event)
+
+
+# ------------------------
+# HTTP
+# ------------------------
+class Handler(BaseHTTPRequestHandler):
+    hub: LetterHub = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, value, status=200):
+        body = json.dumps(value, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _not_found(self):
+        self._send_json({"error": "not found"}, 404)
+
+    def do_GET(self):
+        parts = [p for p in urlparse(self.path).path.split("/") if p]
+
+        if not parts:
+            body = HTML_PATH.read_bytes()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif parts == ["ui_payload.json"]:
+            latest = self.hub.latest()
+            payload = self.hub.payload(latest) if latest else None
+            self._send_json(payload) if payload else self._not_found()
+        elif parts == ["metrics"]:
+            body = metrics.render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif parts == ["letters"]:
+            self._send_json(self.hub.letters())
+        elif len(parts) == 3 and parts[0] == "letters" and parts[2] == "payload":
+            payload = self.hub.payload(parts[1])
+            self._send_json(payload) if payload else self._not_found()
+        elif len(parts) == 3 and parts[0] == "letters" and parts[2] == "events":
+            self._stream_events(parts[1])
+        else:
+            self._not_found()
+
+    def do_POST(self):
+        if urlparse(self.path).path.rstrip("/") != "/letters":
+            return self._not_found()
+        raw = self.rfile.read(int(self.headers.get("Content-Length") or 0)).decode("utf-8")
+        letter_id = None
+        if "json" in (self.headers.get("Content-Type") or ""):
+            try:
+                data = json.loads(raw)
+            except ValueError:
+                return self._send_json({"error": "невалидный JSON"}, 400)
+            raw, letter_id = data.get("text") or "", data.get("letter_id")
+        if not raw.strip():
+            return self._send_json({"error": "пустое письмо"}, 400)
+        self._send_json({"letter_id": self.hub.submit(raw, letter_id)}, 202)
+
+    def _stream_events(self, letter_id):
+        if self.hub.status(letter_id) is None and not self.hub.store.letter(letter_id):
+            return self._not_found()
+        last_id = int(self.headers.get("Last-Event-ID") or 0)
+        subscriber, history = self.hub.subscribe(letter_id, last_id)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        try:
+            # письмо уже обработано в прошлом запуске — сразу итоговый payload
+            if self.hub.status(letter_id) in (None, "stored"):
+                history = [{"id": 1, "type": "done", "payload": self.hub.payload(letter_id)}]
+            pending = list(history)
+            while True:
+                if pending:
+                    event = pending.pop(0)
+                else:
+                    try:
+                        event = subscriber.get(timeout=KEEPALIVE)
+                    except queue.Empty:
+                        self.wfile.write(b": keepalive\n\n")
+                        self.wfile.flush()
+                        continue
+                data = json.dumps(event, ensure_ascii=False)
+                self.wfile.write(f"id: {event['id']}\nevent: {event['type']}\ndata: {data}\n\n".encode("utf-8"))
+                self.wfile.flush()
+                if event["type"] in ("done", "error"):
+                    break
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            self.hub.unsubscribe(letter_id, subscriber)
+
+
+def serve(host="127.0.0.1", port=8000, store=None, max_letters=2):
+    Handler.hub = LetterHub(store or ArtifactStore(), max_letters)
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    print(f"UI: http://{host}:{port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="HTTP-сервис для ии_6.html: payload писем и события SSE")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--store", default="letters", help="папка хранилища артефактов (пусто — только память)")
+    parser.add_argument("--max-letters", type=int, default=2, help="писем в обработке одновременно")
+    args = parser.parse_args()
+
+    serve(args.host, args.port, ArtifactStore(root=args.store or None), args.max_letters)
@@ -0,0 +1,153 @@
+# stage_memo.py
+# Инкрементальный перезапуск пайплайна: этап выполняется заново, только если изменились его входы.
+#
+# Для каждого этапа письма хранится ключ — хеш версии этапа и точных значений его входов
+# (артефакт stage_keys, файл letters/<letter_id>/stage_keys.json). Версия этапа — промпты
+# (Prompt.instructions) и настройки модуля этапа: MODEL, *_MODE и другие константы.
+#
+# При повторном запуске этап с тем же ключом и сохранёнными выходами не вызывается, результат
+# берётся из хранилища. Ключи следующих этапов считаются от фактических выходов, как в системе
+# сборки: правка classification_output.json перезапускает только RAG1 → LLM2 → RAG2 → LLM3,
+# а если перезапущенный этап вернул то же, что и раньше, дальше ничего не пересчитывается.
+#
+# Если у этапа есть входы помимо аргументов (кэш шаблонов у LLM2, корпус документов у RAG1),
+# модуль этапа объявляет их сам: memo_version() — часть версии, memo_inputs(*args) — часть ключа.
+#
+# Ключ этапа записывается (commit) только после того, как его выходы сохранены в хранилище:
+# если запуск прервётся между ними, этап при следующем запуске выполнится заново.
+#
+# Изменения кода разбора ответов в ключ не входят — для них from_stage: принудительно
+# перезапустить этап и всё, что от него зависит ("all" — весь граф).
+import sys
+import json
+import hashlib
+import threading
+
+from scheduler import Stage
+from prompt_builder import Prompt
+import metrics
+
+KEYS_ARTIFACT = "stage_keys"
+
+_MISSING = object()
+
+
+# ------------------------
+# Ключ этапа
+# ------------------------
+def _unwrap(func):
+    while hasattr(func, "func"):        # functools.partial (потоковые LLM2 / LLM3)
+        func = func.func
+    return func
+
+
+def _module(func):
+    return sys.modules.get(getattr(_unwrap(func), "__module__", None))
+
+
+def stage_version(func) -> str:
+    """Хеш промптов и констант модуля, где определена функция этапа, и его memo_version()."""
+    module = _module(func)
+    func = _unwrap(func)
+    parts = {"func": getattr(func, "__qualname__", repr(func))}
+    for name, value in sorted(vars(module).items()) if module is not None else []:
+        if isinstance(value, Prompt):
+            parts[name] = value.instructions
+        elif name.isupper() and isinstance(value, (str, int, float, bool)):
+            parts[name] = value
+    if hasattr(module, "memo_version"):
+        parts["memo_version"] = module.memo_version()
+    payload = json.dumps(parts, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:12]
+
+
+def input_key(version: str, args) -> str:
+    payload = json.dumps([version, list(args)], ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def downstream(stages, from_stage) -> set:
+    """Имена этапов, которые перезапускаются принудительно: from_stage и все зависящие от него."""
+    if not from_stage:
+        return set()
+    if from_stage == "all":
+        return {stage.name for stage in stages}
+    by_name = {stage.name.lower(): stage for stage in stages}
+    start = by_name.get(from_stage.lower())
+    if start is None:
+        raise ValueError(f"Нет этапа '{from_stage}', есть: {', '.join(s.name for s in stages)}")
+
+    forced, produced = {start.name}, set(start.outputs)
+    changed = True
+    while changed:
+        changed = False
+        for stage in stages:
+            if stage.name not in forced and produced.intersection(stage.inputs):
+                forced.add(stage.name)
+                produced.update(stage.outputs)
+                changed = True
+    return forced
+
+
+# ------------------------
+# Этапы с запоминанием
+# ------------------------
+class StageMemo:
+    """
+    Ключи и выходы этапов одного письма с прошлого запуска.
+
+    memo = StageMemo(store.letter(letter_id), force=downstream(stages, "RAG1"))
+    stages = memo.wrap(stages)      # этапы с тем же ключом вернут сохранённый результат
+    # после сохранения выходов этапа:
+    memo.commit(stage.name)
+    store.put(letter_id, KEYS_ARTIFACT, memo.snapshot())
+    """
+
+    def __init__(self, previous: dict, force=()):
+        self.previous = previous
+        self.keys = dict(previous.get(KEYS_ARTIFACT) or {})
+        self.force = set(force)
+        self.reused = set()
+        self._pending = {}          # ключи выполненных этапов, выходы которых ещё не сохранены
+        self._lock = threading.Lock()
+
+    def wrap(self, stages) -> list:
+        return [Stage(stage.name, self._memoized(stage), stage.inputs, stage.output) for stage in stages]
+
+    def commit(self, name):
+        """Выходы этапа name сохранены — его новый ключ можно записывать."""
+        with self._lock:
+            if name in self._pending:
+                self.keys[name] = self._pending.pop(name)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.keys)
+
+    def _stored(self, stage):
+        if not all(name in self.previous for name in stage.outputs):
+            return _MISSING
+        if isinstance(stage.output, tuple):
+            return {name: self.previous[name] for name in stage.output}
+        return self.previous[stage.output]
+
+    def _memoized(self, stage):
+        version = stage_version(stage.func)
+        hidden = getattr(_module(stage.func), "memo_inputs", None)
+
+        def func(*args, **kwargs):
+            key = input_key(version, list(args) + ([hidden(*args)] if hidden is not None else []))
+            with self._lock:
+                hit = stage.name not in self.force and self.keys.get(stage.name) == key
+            stored = self._stored(stage) if hit else _MISSING
+            if stored is not _MISSING:
+                with self._lock:
+                    self.reused.add(stage.name)
+                metrics.note("reused")
+                return stored
+            result = stage.func(*args, **kwargs)
+            with self._lock:
+                self._pending[stage.name] = key
+            return result
+
+        return func
@@ -0,0 +1,147 @@
+# streaming.py
+# Потоковая генерация: ответ модели читается по кускам (stream=True),
+# а инкрементальный JSON-парсер отдаёт каждое поле, как только оно закрыто.
+# Так первый стиль ответа LLM2 можно показать до того, как готовы остальные.
+import json
+
+import metrics
+from prompt_builder import prompt_stats, request_tokens
+
+
+class IncrementalJSONParser:
+    """
+    Инкрементальный разбор одного JSON-объекта, приходящего кусками.
+
+    feed(chunk) возвращает список (path, value) для значений на глубине depth,
+    которые полностью пришли в этом куске. Для {"answers": {"official": "..."}}
+    при depth=2 это (("answers", "official"), "..."). Каждый символ
+    просматривается один раз; текст до первой «{» (например, ```json) пропускается.
+    """
+
+    def __init__(self, depth=2):
+        self.depth = depth
+        self.buf = ""
+        self.pos = 0
+        self.started = False
+        self.done = False
+        self.stack = []          # [{"type": "obj"|"arr", "key": ..., "index": ..., "start": ..., "path": ...}]
+        self.in_string = False
+        self.escape = False
+        self.string_start = None
+        self.string_is_key = False
+        self.prim_start = None
+
+    def _value_path(self):
+        path = []
+        for frame in self.stack[1:]:
+            path.append(frame["path"][-1])
+        top = self.stack[-1]
+        path.append(top["key"] if top["type"] == "obj" else top["index"])
+        return tuple(path)
+
+    def _emit(self, path, start, end, out):
+        if len(path) == self.depth:
+            try:
+                out.append((path, json.loads(self.buf[start:end])))
+            except ValueError:
+                pass
+
+    def _finish_primitive(self, end, out):
+        if self.prim_start is not None:
+            self._emit(self._value_path(), self.prim_start, end, out)
+            self.prim_start = None
+
+    def feed(self, chunk: str) -> list:
+        out = []
+        self.buf += chunk
+        buf = self.buf
+
+        for i in range(self.pos, len(buf)):
+            if self.done:
+                break
+            c = buf[i]
+
+            if not self.started:
+                if c == "{":
+                    self.started = True
+                    self.stack.append({"type": "obj", "key": None, "index": 0, "start": i, "path": ()})
+                continue
+
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif c == "\\":
+                    self.escape = True
+                elif c == '"':
+                    self.in_string = False
+                    if self.string_is_key:
+                        self.stack[-1]["key"] = json.loads(buf[self.string_start:i + 1])
+                    else:
+                        self._emit(self._value_path(), self.string_start, i + 1, out)
+                continue
+
+            if c == '"':
+                self.in_string = True
+                self.string_start = i
+                top = self.stack[-1]
+                self.string_is_key = top["type"] == "obj" and top.get("expect_key", True)
+            elif c in "{[":
+                path = self._value_path()
+                self.stack.append({"type": "obj" if c == "{" else "arr", "key": None, "index": 0,
+                                   "start": i, "path": path})
+            elif c in "}]":
+                self._finish_primitive(i, out)
+                frame = self.stack.pop()
+                if not self.stack:
+                    self.done = True
+                else:
+                    self._emit(frame["path"], frame["start"], i + 1, out)
+            elif c == ":":
+                self.stack[-1]["expect_key"] = False
+            elif c == ",":
+                self._finish_primitive(i, out)
+                top = self.stack[-1]
+                if top["type"] == "obj":
+                    top["expect_key"] = True
+                else:
+                    top["index"] += 1
+            elif c.isspace():
+                self._finish_primitive(i, out)
+            elif self.prim_start is None:
+                self.prim_start = i
+
+        self.pos = len(buf)
+        return out
+
+
+# -----------------------------------------
+# Потоковый вызов Responses API
+# -----------------------------------------
+def stream_text(client, request: dict, on_delta) -> str:
+    """client.responses.create(stream=True): on_delta(кусок) на каждый кусок текста; возвращает весь текст."""
+    parts = []
+    for event in client.responses.create(**request, stream=True):
+        if event.type == "response.output_text.delta":
+            parts.append(event.delta)
+            on_delta(event.delta)
+        elif event.type == "response.completed":
+            response = getattr(event, "response", None)
+            metrics.record_usage(response)
+            prompt_stats.usage(getattr(client, "stage", None), sum(request_tokens(request)), response)
+    return "".join(parts)
+
+
+def stream_fields(client, request: dict, on_field, depth=2) -> str:
+    """
+    Потоковый вызов с разбором JSON на лету.
+
+    on_field(path, value) вызывается для каждого закрытого значения на глубине depth,
+    например (("answers", "official"), "текст ответа"). Возвращает полный текст ответа.
+    """
+    parser = IncrementalJSONParser(depth=depth)
+
+    def on_delta(delta):
+        for path, value in parser.feed(delta):
+            on_field(path, value)
+
+    return stream_text(client, request, on_delta)
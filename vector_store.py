@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+# vector_store.py
+# Векторное хранилище для семантического поиска документов и прошлых писем (RAG1).
+#
+# На диске (папка VECTOR_STORE_DIR, по умолчанию vector_store/):
+#   vectors.f32  — матрица эмбеддингов float32 (строка на документ), читается через np.memmap;
+#   meta.jsonl   — метаданные строк в том же порядке: key, code, kind, name, version;
+#   info.json    — эмбеддер, размерность, число строк, удалённые ключи;
+#   ivf.npy / ivf_lists.i32 — (необязательно) центроиды IVF и номер списка для каждой строки.
+#
+# Новые документы дописываются в конец файлов — пересборка не нужна. Изменённый документ
+# добавляется новой строкой, старая строка с тем же key перестаёт участвовать в поиске.
+import os
+import json
+import zlib
+import hashlib
+from pathlib import Path
+
+import numpy as np
+
+from doc_index import tokenize, read_document, build_queries, format_hits
+from artifact_store import read_letter_dir
+
+VECTOR_STORE_DIR = os.getenv("VECTOR_STORE_DIR", "vector_store")
+EMBEDDER         = os.getenv("EMBEDDER", "auto")
+E5_MODEL         = "intfloat/multilingual-e5-small"
+
+BLOCK_ROWS = 65536   # строк матрицы за один проход поиска
+
+
+# ------------------------
+# Эмбеддеры
+# ------------------------
+# Эмбеддер — любой объект с полями name, dim и методом embed(texts, kind) → np.ndarray (n, dim),
+# где kind = "passage" для документов и "query" для запросов. Векторы нормируются в хранилище.
+class HashingEmbedder:
+    """Без зависимостей: хеширование лемм и биграмм лемм в вектор фиксированной длины."""
+
+    def __init__(self, dim=1024):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def embed(self, texts, kind="passage"):
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            tokens = tokenize(text)
+            features = tokens + [a + " " + b for a, b in zip(tokens, tokens[1:])]
+            for feature in features:
+                h = zlib.crc32(feature.encode("utf-8"))
+                out[row, h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        return out
+
+
+class SentenceTransformerEmbedder:
+    """Локальная модель sentence-transformers на CPU (по умолчанию multilingual-e5-small)."""
+
+    def __init__(self, model_name=E5_MODEL, batch_size=32):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.dim = self.model.get_sentence_embedding_dimension()
+        self.name = f"st:{model_name}"
+        self.batch_size = batch_size
+        self.e5 = "e5" in model_name
+
+    def embed(self, texts, kind="passage"):
+        if self.e5:
+            texts = [f"{kind}: {t}" for t in texts]
+        return self.model.encode(texts, batch_size=self.batch_size, convert_to_numpy=True).astype(np.float32)
+
+
+def get_embedder(spec=None):
+    """
+    EMBEDDER=auto     — sentence-transformers, если установлен и модель загрузилась, иначе hashing;
+    EMBEDDER=hashing  — без зависимостей;
+    EMBEDDER=st:<имя модели> — конкретная модель sentence-transformers.
+    """
+    spec = spec or EMBEDDER
+    if spec.startswith("st:"):
+        return SentenceTransformerEmbedder(spec[3:])
+    if spec == "auto":
+        try:
+            return SentenceTransformerEmbedder()
+        except ImportError:
+            return HashingEmbedder()
+        except Exception as e:
+            # пакет есть, но модель не загрузилась (нет сети / кэша модели, несовместимый torch)
+            print(f"Эмбеддер {E5_MODEL} недоступен ({e!r}), используется hashing")
+            return HashingEmbedder()
+    if spec.startswith("hashing"):
+        return HashingEmbedder(int(spec.split("-")[1]) if "-" in spec else 1024)
+    raise ValueError(f"Неизвестный эмбеддер: {spec}")
+
+
+def normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def text_version(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+# ------------------------
+# Хранилище
+# ------------------------
+class VectorStore:
+    """
+    store = VectorStore("vector_store", embedder)
+    store.add([{"key": "doc:laws/55u.md", "code": "CBR_55U", "kind": "law", "name": "...", "text": "..."}])
+    store.search(store.embed_queries(["текст запроса"]), top_k=5)  → [[(meta, score), ...]]
+    """
+
+    def __init__(self, root=VECTOR_STORE_DIR, embedder=None):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.vectors_path = self.root / "vectors.f32"
+        self.meta_path = self.root / "meta.jsonl"
+        self.info_path = self.root / "info.json"
+        self.ivf_path = self.root / "ivf.npy"
+        self.lists_path = self.root / "ivf_lists.i32"
+
+        info = json.loads(self.info_path.read_text(encoding="utf-8")) if self.info_path.exists() else {}
+        self.embedder = embedder or get_embedder(info.get("embedder"))
+        if info and info["embedder"] != self.embedder.name:
+            raise ValueError(f"Хранилище построено эмбеддером {info['embedder']}, а не {self.embedder.name}")
+        self.dim = info.get("dim", self.embedder.dim)
+        self.removed = set(info.get("removed", []))
+
+        self.meta = []
+        if self.meta_path.exists():
+            with self.meta_path.open("r", encoding="utf-8") as f:
+                self.meta = [json.loads(line) for line in f if line.strip()]
+        # строки, дописанные не до конца (сбой между записью векторов и метаданных), отбрасываем
+        rows_on_disk = self.vectors_path.stat().st_size // (4 * self.dim) if self.vectors_path.exists() else 0
+        self.count = min(info.get("count", 0), rows_on_disk, len(self.meta))
+        self.meta = self.meta[:self.count]
+
+        self.centroids = np.load(self.ivf_path) if self.ivf_path.exists() else None
+        self._vectors = None
+        self._lists = None
+        self._live = None
+
+    # ------------------------
+    # Чтение
+    # ------------------------
+    @property
+    def vectors(self):
+        if self._vectors is None or len(self._vectors) != self.count:
+            self._vectors = (np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(self.count, self.dim))
+                             if self.count else np.zeros((0, self.dim), dtype=np.float32))
+        return self._vectors
+
+    @property
+    def lists(self):
+        if self._lists is None or len(self._lists) != self.count:
+            self._lists = np.fromfile(self.lists_path, dtype=np.int32)[:self.count]
+        return self._lists
+
+    @property
+    def live(self):
+        """Маска строк, участвующих в поиске: последняя версия каждого key, не удалённая."""
+        if self._live is None or len(self._live) != self.count:
+            live = np.zeros(self.count, dtype=bool)
+            latest = {}
+            for row, m in enumerate(self.meta):
+                latest[m["key"]] = row
+            for key, row in latest.items():
+                if key not in self.removed:
+                    live[row] = True
+            self._live = live
+        return self._live
+
+    def versions(self, prefix="") -> dict:
+        """key → version для живых строк (нужно, чтобы не переэмбеддить неизменённое)."""
+        return {self.meta[row]["key"]: self.meta[row].get("version")
+                for row in np.flatnonzero(self.live) if self.meta[row]["key"].startswith(prefix)}
+
+    # ------------------------
+    # Запись
+    # ------------------------
+    def _save_info(self):
+        info = {"embedder": self.embedder.name, "dim": self.dim, "count": self.count,
+                "removed": sorted(self.removed)}
+        tmp = self.info_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(info, ensure_ascii=False), encoding="utf-8")
+        tmp.replace(self.info_path)
+
+    def add(self, items, batch_size=64):
+        """Дописывает документы в конец хранилища. items — словари с key, code, kind, name, text."""
+        for start in range(0, len(items), batch_size):
+            batch = items[start:start + batch_size]
+            vectors = normalize(self.embedder.embed([it["text"] for it in batch], kind="passage"))
+            with self.vectors_path.open("ab") as f:
+                f.write(vectors.astype(np.float32).tobytes())
+            if self.centroids is not None:
+                with self.lists_path.open("ab") as f:
+                    f.write(np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32).tobytes())
+            with self.meta_path.open("a", encoding="utf-8") as f:
+                for it in batch:
+                    meta = {k: v for k, v in it.items() if k != "text"}
+                    meta.setdefault("version", text_version(it["text"]))
+                    f.write(json.dumps(meta, ensure_ascii=False) + "\n")
+                    self.meta.append(meta)
+                    self.removed.discard(it["key"])
+            self.count += len(batch)
+            self._save_info()
+        self._live = None
+
+    def remove(self, keys):
+        self.removed.update(keys)
+        self._save_info()
+        self._live = None
+
+    # ------------------------
+    # IVF
+    # ------------------------
+    def build_ivf(self, n_lists=None, iterations=10, sample=50000, seed=0) -> bool:
+        """
+        Грубое разбиение на n_lists кластеров (сферический k-means) — поиск только по ближайшим спискам.
+        Списков не больше, чем строк в выборке; в пустом хранилище IVF не строится (False).
+        """
+        if self.count == 0:
+            return False
+        rng = np.random.default_rng(seed)
+        rows = rng.choice(self.count, size=min(sample, self.count), replace=False)
+        data = np.asarray(self.vectors[np.sort(rows)])
+        n_lists = min(n_lists or max(1, int(np.sqrt(self.count))), len(data))
+        centroids = data[rng.choice(len(data), size=n_lists, replace=False)].copy()
+        for _ in range(iterations):
+            assign = np.argmax(data @ centroids.T, axis=1)
+            for c in range(n_lists):
+                members = data[assign == c]
+                if len(members):
+                    centroids[c] = members.sum(axis=0)
+            centroids = normalize(centroids)
+
+        lists = np.empty(self.count, dtype=np.int32)
+        for start in range(0, self.count, BLOCK_ROWS):
+            lists[start:start + BLOCK_ROWS] = np.argmax(self.vectors[start:start + BLOCK_ROWS] @ centroids.T, axis=1)
+        lists.tofile(self.lists_path)
+        np.save(self.ivf_path, centroids.astype(np.float32))
+        self.centroids = centroids.astype(np.float32)
+        self._lists = None
+        return True
+
+    # ------------------------
+    # Поиск
+    # ------------------------
+    def embed_queries(self, texts):
+        return normalize(self.embedder.embed(texts, kind="query"))
+
+    def search(self, queries, top_k=10, nprobe=8):
+        """
+        queries — (m, dim) нормированные векторы запросов. Возвращает для каждого запроса
+        список [(метаданные, cosine score)] по убыванию.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if not self.count:
+            return [[] for _ in queries]
+        if self.centroids is not None:
+            return [self._search_ivf(q, top_k, nprobe) for q in queries]
+
+        # полный перебор блоками: в памяти не больше BLOCK_ROWS × m оценок
+        best_scores = np.full((0, len(queries)), -np.inf, dtype=np.float32)
+        best_rows = np.zeros((0, len(queries)), dtype=np.int64)
+        live = self.live
+        for start in range(0, self.count, BLOCK_ROWS):
+            scores = np.asarray(self.vectors[start:start + BLOCK_ROWS] @ queries.T)
+            scores[~live[start:start + BLOCK_ROWS]] = -np.inf
+            k = min(top_k, len(scores))
+            rows = np.argpartition(-scores, k - 1, axis=0)[:k]
+            best_scores = np.vstack([best_scores, np.take_along_axis(scores, rows, axis=0)])
+            best_rows = np.vstack([best_rows, rows + start])
+
+        order = np.argsort(-best_scores, axis=0)[:top_k]
+        results = []
+        for j in range(len(queries)):
+            results.append([(self.meta[best_rows[i, j]], float(best_scores[i, j]))
+                            for i in order[:, j] if np.isfinite(best_scores[i, j])])
+        return results
+
+    def _search_ivf(self, query, top_k, nprobe):
+        probe = np.argsort(-(self.centroids @ query))[:nprobe]
+        rows = np.flatnonzero(np.isin(self.lists, probe) & self.live)
+        if not len(rows):
+            return []
+        scores = np.asarray(self.vectors[rows] @ query)
+        top = np.argsort(-scores)[:top_k]
+        return [(self.meta[rows[i]], float(scores[i])) for i in top]
+
+
+# ------------------------
+# Наполнение
+# ------------------------
+def sync_docs(store, docs_dir="docs") -> dict:
+    """Добавляет новые и изменённые документы корпуса, удалённые файлы убирает из поиска."""
+    root = Path(docs_dir)
+    known = store.versions(prefix="doc:")
+    items, seen = [], set()
+    for path in sorted(p for p in root.rglob("*") if p.suffix.lower() in (".txt", ".md") and p.is_file()):
+        doc = read_document(path, root)
+        key = "doc:" + doc.pop("path")
+        seen.add(key)
+        doc["version"] = text_version(doc["text"])
+        if known.get(key) != doc["version"]:
+            items.append({"key": key, **doc, "text": doc["name"] + "\n" + doc["text"]})
+    gone = [key for key in known if key not in seen]
+    store.add(items)
+    if gone:
+        store.remove(gone)
+    return {"added": len(items), "removed": len(gone)}
+
+
+def sync_letters(store, letters_root="letters") -> dict:
+    """Прошлые письма с готовым ответом (letters/<id>/) → kind=case, для поиска похожих кейсов."""
+    known = store.versions(prefix="letter:")
+    items = []
+    for path in sorted(p for p in Path(letters_root).iterdir() if p.is_dir()):
+        artifacts = read_letter_dir(path)
+        if "letter_text" not in artifacts or "llm3" not in artifacts:
+            continue
+        key = "letter:" + path.name
+        text = artifacts["letter_text"]
+        if known.get(key) == text_version(text):
+            continue
+        core = (artifacts.get("llm1") or {}).get("core_request") or " ".join(text.split())[:120]
+        items.append({"key": key, "code": f"CASE_{path.name}", "kind": "case",
+                      "name": f"Похожее письмо: {core}", "text": text})
+    store.add(items)
+    return {"added": len(items)}
+
+
+_store = None
+
+
+def get_store():
+    global _store
+    if _store is None:
+        _store = VectorStore(VECTOR_STORE_DIR)
+    return _store
+
+
+def store_version(root=VECTOR_STORE_DIR) -> str:
+    """Меняется при добавлении и удалении строк и смене эмбеддера: хеш info.json ("" — хранилища нет)."""
+    try:
+        return hashlib.sha1((Path(root) / "info.json").read_bytes()).hexdigest()[:16]
+    except OSError:
+        return ""
+
+
+def store_available(root=VECTOR_STORE_DIR) -> bool:
+    return (Path(root) / "info.json").exists()
+
+
+def search_docs(letter_text, ner_result, llm1_result, top_k=5, store=None) -> dict:
+    """Документы и похожие кейсы для RAG1 по семантической близости — та же схема, что у doc_index."""
+    store = store or get_store()
+    query = "\n".join(text for text, _ in build_queries(letter_text, ner_result, llm1_result) if text)
+    hits = store.search(store.embed_queries([query]), top_k=top_k * 4)[0]
+    return format_hits([(meta, score, f"семантическая близость {score:.2f}") for meta, score in hits if score > 0],
+                       top_k)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Векторное хранилище документов и писем для RAG1")
+    parser.add_argument("command", choices=["add-docs", "add-letters", "build-ivf", "search", "stats"])
+    parser.add_argument("arg", nargs="*", help="папка (add-docs / add-letters) или текст запроса (search)")
+    parser.add_argument("--store", default=VECTOR_STORE_DIR)
+    parser.add_argument("--lists", type=int, default=None, help="число списков IVF")
+    args = parser.parse_args()
+
+    store = VectorStore(args.store)
+    if args.command == "add-docs":
+        print(sync_docs(store, args.arg[0] if args.arg else "docs"))
+    elif args.command == "add-letters":
+        print(sync_letters(store, args.arg[0] if args.arg else "letters"))
+    elif args.command == "build-ivf":
+        if store.build_ivf(args.lists):
+            print(f"IVF: {len(store.centroids)} списков")
+        else:
+            print("IVF не построен: хранилище пустое")
+    elif args.command == "search":
+        for meta, score in store.search(store.embed_queries([" ".join(args.arg)]), top_k=10)[0]:
+            print(f"{score:6.3f}  {meta['code']:<30} {meta['name']}")
+    print(f"{store.embedder.name}: {int(store.live.sum())} строк в поиске из {store.count}, dim={store.dim}")
@@ -0,0 +1,373 @@
+# worker.py
+# Долгоживущий обработчик входящих писем с приоритетами.
+#
+# Письма забираются из папки (*.txt) или передаются через Worker.submit(). Обработка в две фазы:
+#   1. разбор — дешёвые этапы (NER, классификатор, LLM1 или объединённый Analysis) в порядке поступления;
+#   2. ответ  — дорогие RAG1 / LLM2 / RAG2 / LLM3 в порядке приоритета.
+# Приоритет считается по результату разбора: срочность и legal_risk классификатора, тип письма
+# и ближайший срок из NER (класс пересчитывается, пока письмо ждёт: срок приближается).
+# Регуляторный запрос со сроком 3 дня не ждёт за уведомлениями;
+# чтобы низкий приоритет не голодал, ожидание повышает класс на ступень каждые WORKER_AGING секунд.
+#
+#   python worker.py inbox --out letters
+#
+# Обработанные письма переносятся в <inbox>/done/, с ошибкой — в <inbox>/failed/.
+# Глубина очереди и ожидание по классам печатаются каждые --report секунд и пишутся в <inbox>/worker_status.json.
+import os
+import re
+import json
+import time
+import asyncio
+import argparse
+from datetime import datetime
+from pathlib import Path
+
+from batch import build_async_stages
+from scheduler import run_graph_async
+from artifact_store import ArtifactStore, make_letter_id
+from llm_cache import cache
+import llm_retry
+import rate_limiter
+import prompt_builder
+import metrics
+
+AGING         = float(os.getenv("WORKER_AGING", 900))   # сек ожидания на ступень приоритета
+CRITICAL_DAYS = 3                                       # срок ближе — письмо критичное
+HIGH_DAYS     = 10
+
+PRIORITY_CLASSES = ["critical", "high", "normal", "low"]
+
+NUMBER_WORDS = {"одного": 1, "двух": 2, "трёх": 3, "трех": 3, "пяти": 5, "десяти": 10, "тридцати": 30}
+RELATIVE_RE = re.compile(r"(\d+|" + "|".join(NUMBER_WORDS) + r")\s*(?:\(\w+\)\s*)?"
+                         r"(рабоч\w+\s+|банковск\w+\s+|календарн\w+\s+)?(дн|день|час|недел|месяц)", re.IGNORECASE)
+UNIT_DAYS = {"дн": 1, "день": 1, "час": 1 / 24, "недел": 7, "месяц": 30}
+
+
+# ------------------------
+# Приоритет письма
+# ------------------------
+def deadline_due(deadline: dict, received: float):
+    """Момент срока из NER, timestamp (None — срок не разобран); относительный срок — от поступления письма."""
+    if deadline.get("date"):
+        try:
+            return datetime.strptime(deadline["date"], "%d.%m.%Y").timestamp()
+        except ValueError:
+            return None
+    m = RELATIVE_RE.search(deadline.get("text") or "")
+    if not m:
+        return None
+    count = int(m.group(1)) if m.group(1).isdigit() else NUMBER_WORDS[m.group(1).lower()]
+    days = count * UNIT_DAYS[m.group(3).lower()]
+    if m.group(2) and not m.group(2).lower().startswith("календарн"):
+        days *= 7 / 5       # рабочие дни — с запасом на выходные
+    return received + days * 86400
+
+
+def deadline_days(deadline: dict, received: float, now=None):
+    """Сколько дней осталось до срока из NER (None — срок не разобран)."""
+    due = deadline_due(deadline, received)
+    return (due - (now or time.time())) / 86400 if due is not None else None
+
+
+def nearest_due(ner: dict, received: float):
+    dues = [d for d in (deadline_due(x, received) for x in (ner or {}).get("deadlines") or []
+                        if isinstance(x, dict)) if d is not None]
+    return min(dues) if dues else None
+
+
+def priority_class(classification: dict, days_left) -> str:
+    classification = classification or {}
+    urgency = classification.get("urgency")
+    letter_type = classification.get("type")
+    legal_risk = classification.get("legal_risk") == "есть"
+
+    if urgency == "очень срочно" or letter_type == "Регуляторный запрос" \
+            or (days_left is not None and days_left <= CRITICAL_DAYS):
+        return "critical"
+    if urgency == "средне срочно" or legal_risk or letter_type == "Официальная жалоба или претензия" \
+            or (days_left is not None and days_left <= HIGH_DAYS):
+        return "high"
+    if letter_type == "Уведомление или информирование" and days_left is None:
+        return "low"
+    return "normal"
+
+
+# ------------------------
+# Очередь
+# ------------------------
+class Job:
+    def __init__(self, letter_id, letter_text, path=None):
+        self.letter_id = letter_id
+        self.letter_text = letter_text.strip()
+        self.path = path
+        self.received = time.time()
+        self.artifacts = None
+        self.classification = None
+        self.due = None             # ближайший срок из NER, timestamp
+        self.priority = None
+        self.days_left = None
+        self.queued_at = None
+
+    def refresh(self, now):
+        """Дни до срока и класс на момент now: пока письмо ждёт, срок приближается."""
+        self.days_left = (self.due - now) / 86400 if self.due is not None else None
+        self.priority = priority_class(self.classification, self.days_left)
+
+    def sort_key(self, now):
+        """Класс на момент now с поправкой на ожидание, затем ближайший срок, затем порядок поступления."""
+        self.refresh(now)
+        rank = PRIORITY_CLASSES.index(self.priority) - int((now - self.queued_at) / AGING)
+        return (rank, self.due if self.due is not None else float("inf"), self.received)
+
+
+class PriorityQueue:
+    """
+    Очередь дорогих этапов: при каждой выдаче класс и порядок пересчитываются на текущий момент —
+    письмо, чей срок подошёл к CRITICAL_DAYS, пока оно ждало, становится критичным.
+    """
+
+    def __init__(self):
+        self._jobs = []
+        self._cond = asyncio.Condition()
+
+    def __len__(self):
+        return len(self._jobs)
+
+    async def put(self, job):
+        async with self._cond:
+            job.queued_at = time.time()
+            self._jobs.append(job)
+            self._cond.notify()
+
+    async def get(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._jobs)
+            now = time.time()
+            job = min(self._jobs, key=lambda j: j.sort_key(now))
+            self._jobs.remove(job)
+            return job
+
+    def depth(self) -> dict:
+        counts = dict.fromkeys(PRIORITY_CLASSES, 0)
+        now = time.time()
+        for job in self._jobs:
+            job.refresh(now)
+            counts[job.priority] += 1
+        return counts
+
+
+class ClassStats:
+    def __init__(self):
+        self.done = 0
+        self.failed = 0
+        self.wait_total = 0.0       # от поступления до начала фазы ответа
+        self.wait_max = 0.0
+        self.latency_total = 0.0    # от поступления до готового ответа
+
+    def as_dict(self) -> dict:
+        finished = self.done + self.failed
+        return {
+            "done": self.done, "failed": self.failed,
+            "wait_avg": round(self.wait_total / finished, 1) if finished else None,
+            "wait_max": round(self.wait_max, 1),
+            "latency_avg": round(self.latency_total / self.done, 1) if self.done else None,
+        }
+
+
+# ------------------------
+# Обработчик
+# ------------------------
+class Worker:
+    def __init__(self, store=None, concurrency=8, triage_workers=4, answer_workers=2, fused=None,
+                 on_done=None):
+        self.store = store or ArtifactStore()
+        self.semaphore = asyncio.Semaphore(concurrency)
+        stages = build_async_stages(self.semaphore, fused)
+        # фаза разбора — этапы, которым нужен только текст письма
+        self.triage_stages = [s for s in stages if set(s.inputs) == {"letter_text"}]
+        self.answer_stages = [s for s in stages if set(s.inputs) != {"letter_text"}]
+        self.triage_queue = asyncio.Queue()
+        self.answer_queue = PriorityQueue()
+        self.triage_workers = triage_workers
+        self.answer_workers = answer_workers
+        self.on_done = on_done
+        self.stats_by_class = {name: ClassStats() for name in PRIORITY_CLASSES}
+        self.in_progress = 0
+
+    async def submit(self, letter_id, letter_text, path=None) -> Job:
+        job = Job(letter_id, letter_text, path)
+        self.store.put(letter_id, "letter_text", job.letter_text)
+        await self.triage_queue.put(job)
+        return job
+
+    def _save(self, job, stage, result):
+        for name, value in stage.artifacts(result):
+            self.store.put(job.letter_id, name, value)
+
+    async def _triage_loop(self):
+        while True:
+            job = await self.triage_queue.get()
+            try:
+                job.artifacts, _ = await run_graph_async(
+                    metrics.instrument(self.triage_stages, job.letter_id), {"letter_text": job.letter_text},
+                    lambda stage, result: self._save(job, stage, result))
+                job.classification = job.artifacts.get("classification")
+                job.due = nearest_due(job.artifacts.get("ner"), job.received)
+                job.refresh(time.time())
+                await self.answer_queue.put(job)
+            except Exception as e:
+                job.priority = "normal"
+                self._finish(job, error=e)
+            finally:
+                self.triage_queue.task_done()
+
+    async def _answer_loop(self):
+        while True:
+            job = await self.answer_queue.get()
+            waited = time.time() - job.received
+            stats = self.stats_by_class[job.priority]
+            stats.wait_total += waited
+            stats.wait_max = max(stats.wait_max, waited)
+            self.in_progress += 1
+            try:
+                artifacts, _ = await run_graph_async(
+                    metrics.instrument(self.answer_stages, job.letter_id), job.artifacts,
+                    lambda stage, result: self._save(job, stage, result))
+                job.artifacts = artifacts
+                self._finish(job)
+            except Exception as e:
+                self._finish(job, error=e)
+            finally:
+                self.in_progress -= 1
+
+    def _finish(self, job, error=None):
+        stats = self.stats_by_class[job.priority]
+        if error is None:
+            stats.done += 1
+            stats.latency_total += time.time() - job.received
+        else:
+            stats.failed += 1
+            print(f"{job.letter_id}: ошибка — {error!r}")
+        if self.on_done is not None:
+            self.on_done(job, error)
+
+    def stats(self) -> dict:
+        return {
+            "triage_queue": self.triage_queue.qsize(),
+            "answer_queue": self.answer_queue.depth(),
+            "in_progress": self.in_progress,
+            "classes": {name: s.as_dict() for name, s in self.stats_by_class.items()},
+        }
+
+    async def run(self):
+        """Запускает обработчики; работает, пока задачу не отменят."""
+        tasks = [asyncio.ensure_future(self._triage_loop()) for _ in range(self.triage_workers)]
+        tasks += [asyncio.ensure_future(self._answer_loop()) for _ in range(self.answer_workers)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+# ------------------------
+# Папка входящих
+# ------------------------
+def move_to(path: Path, folder: str, name=None):
+    target = path.parent / folder
+    target.mkdir(exist_ok=True)
+    path.replace(target / (name or path.name))
+
+
+def inbox_files(inbox: Path) -> dict:
+    """{(имя, mtime_ns, размер): путь} для *.txt в папке, по времени изменения."""
+    files = []
+    for path in inbox.glob("*.txt"):
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            continue                # файл уже унесли в done/ или failed/
+        files.append(((path.name, st.st_mtime_ns, st.st_size), path))
+    return dict(sorted(files, key=lambda item: item[0][1]))
+
+
+def inbox_letter_id(path: Path, text: str) -> str:
+    """«complaint.txt» → «complaint-3f2a9c1b0d4e»: имя файла для читаемости, хеш текста — для уникальности."""
+    return f"{path.stem}-{make_letter_id(text)}"
+
+
+async def watch_inbox(worker, inbox: Path, poll=2.0):
+    """
+    Новые *.txt в папке ставятся в очередь; файл остаётся на месте до конца обработки.
+    Файл узнаётся по имени, mtime и размеру: письмо, заново выгруженное под тем же именем, —
+    новое письмо. Файлы, ушедшие из папки, забываются, так что seen не растёт.
+    letter_id — имя файла и хеш текста (inbox_letter_id): письмо с тем же именем и другим текстом
+    не затирает артефакты прежнего.
+    """
+    seen = set()
+    while True:
+        files = inbox_files(inbox)
+        for key, path in files.items():
+            if key not in seen:
+                seen.add(key)
+                try:
+                    text = path.read_text(encoding="utf-8")
+                except FileNotFoundError:
+                    continue
+                await worker.submit(inbox_letter_id(path, text), text, path)
+        seen &= files.keys()
+        await asyncio.sleep(poll)
+
+
+def format_stats(stats: dict) -> str:
+    depth = ", ".join(f"{name} {count}" for name, count in stats["answer_queue"].items())
+    waits = ", ".join(f"{name} {s['wait_avg']}" for name, s in stats["classes"].items() if s["wait_avg"] is not None)
+    return (f"разбор: {stats['triage_queue']}, ответ: {depth}, в работе: {stats['in_progress']}; "
+            f"ожидание, с: {waits or '—'}")
+
+
+async def report_loop(worker, status_path: Path, interval):
+    while True:
+        await asyncio.sleep(interval)
+        stats = worker.stats()
+        print(f"[{datetime.now():%H:%M:%S}] {format_stats(stats)}")
+        stats.update(cache=cache.stats(), llm=llm_retry.stats(), limiter=rate_limiter.stats(),
+                     prompts=prompt_builder.stats())
+        status_path.write_text(json.dumps(stats, ensure_ascii=False, indent=2), encoding="utf-8")
+        metrics.write_prometheus()
+
+
+async def main(inbox, out_dir, concurrency, triage_workers, answer_workers, report, poll):
+    inbox = Path(inbox)
+    inbox.mkdir(parents=True, exist_ok=True)
+
+    def on_done(job, error):
+        if job.path is not None and job.path.exists():
+            move_to(job.path, "failed" if error else "done", job.letter_id + job.path.suffix)
+        if error is None:
+            print(f"{job.letter_id} [{job.priority}] готово за {time.time() - job.received:.1f} с")
+
+    worker = Worker(ArtifactStore(root=out_dir), concurrency, triage_workers, answer_workers, on_done=on_done)
+    print(f"Слежу за {inbox}/*.txt (разбор: {triage_workers}, ответ: {answer_workers}, запросов: {concurrency})")
+    await asyncio.gather(
+        worker.run(),
+        watch_inbox(worker, inbox, poll),
+        report_loop(worker, inbox / "worker_status.json", report),
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Обработчик входящих писем с приоритетами")
+    parser.add_argument("inbox", help="папка, куда приходят письма *.txt")
+    parser.add_argument("--out", default="letters", help="хранилище артефактов: папка на каждое письмо")
+    parser.add_argument("--concurrency", type=int, default=8, help="максимум одновременных запросов к LLM")
+    parser.add_argument("--triage", type=int, default=4, help="писем одновременно в фазе разбора")
+    parser.add_argument("--answer", type=int, default=2, help="писем одновременно в фазе ответа")
+    parser.add_argument("--report", type=float, default=30, help="период отчёта об очереди, сек")
+    parser.add_argument("--poll", type=float, default=2, help="период опроса папки, сек")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(main(args.inbox, args.out, args.concurrency, args.triage, args.answer, args.report, args.poll))
+    except KeyboardInterrupt:
+        pass